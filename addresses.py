@@ -0,0 +1,69 @@
+import const
+
+# The address log is a series of snapshots of the user set. A base snapshot holds the whole set, the others only the
+# addresses added and removed since the snapshot before them. Addresses are packed as 20-byte arrays
+
+
+def pack(addresses):
+    return b''.join(bytes.fromhex(address[2:]) for address in addresses)
+
+
+def unpack(data):
+    hex_data = bytes(data).hex()
+    return ['0x' + hex_data[i:i + 40] for i in range(0, len(hex_data), 40)]
+
+
+def diff(previous, current):
+    """
+    Compares two address sets.
+
+    Parameters:
+    previous (list): The addresses of the previous snapshot.
+    current (list): The addresses of the new snapshot.
+
+    Returns:
+    tuple: The addresses added and the addresses removed, in the order of their list.
+    """
+    previous_set = set(previous)
+    current_set = set(current)
+    added = [address for address in dict.fromkeys(current) if address not in previous_set]
+    removed = [address for address in previous if address not in current_set]
+    return added, removed
+
+
+def replay(snapshots):
+    """
+    Rebuilds the address set of the last snapshot.
+
+    Parameters:
+    snapshots (DataFrame): The snapshots up to the block of interest, sorted by block, with the block, base, added
+    and removed columns of StorageBackend.load_address_snapshots.
+
+    Returns:
+    list: The addresses, in the order they first appeared since the last base snapshot. Empty without snapshot.
+    """
+    if snapshots.empty:
+        return []
+
+    # Only the snapshots from the last base on are decoded
+    last_base = snapshots.index[snapshots['base']].max()
+    snapshots = snapshots.loc[last_base:]
+
+    current = dict.fromkeys(unpack(snapshots['added'].iloc[0]))
+    for added, removed in zip(snapshots['added'].iloc[1:], snapshots['removed'].iloc[1:]):
+        for address in unpack(removed):
+            current.pop(address, None)
+        current.update(dict.fromkeys(unpack(added)))
+
+    return list(current)
+
+
+def is_rebase_due(snapshots, changes, size, ratio=const.ADDRESS_LOG_REBASE_RATIO):
+    # Once the deltas since the last base hold more addresses than the set itself, a new base is cheaper to replay
+    if snapshots.empty:
+        return True
+
+    last_base = snapshots.index[snapshots['base']].max()
+    since_base = snapshots.loc[last_base:].iloc[1:]
+    delta_size = (since_base['added'].map(len).sum() + since_base['removed'].map(len).sum()) // 20
+    return delta_size + changes > ratio * size
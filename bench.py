@@ -0,0 +1,329 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import requests
+import concurrency
+import const
+
+# Benchmarks of the ingestion, metrics and rendering paths. The RPC bound cases run against the local stand-in of
+# standin.py, started in its own process so that it does not compete with the measured code for the GIL, or against
+# any --rpc-url. The results are written as JSON, compare two of them to find the regressions between versions:
+#   python bench.py run --output base.json
+#   python bench.py run --output head.json
+#   python bench.py compare base.json head.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    # The stores and caches written while setting the cases up stay out of the working directory
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='bench-') as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(previous)
+
+
+def cold_start():
+    # Every run reads the block timestamps from the chain, as a first refresh would
+    import blocktime
+    blocktime.get_cache().clear()
+
+
+def rpc_requests():
+    import clients
+    return sum(endpoint['requests'] for endpoint in clients.get_pool().stats())
+
+
+def measure(fn, rows, repeat=1, memory=True):
+    """
+    Times a benchmark case.
+
+    Parameters:
+    fn (callable): The measured call, without arguments.
+    rows (int): The rows processed by a call, for the throughput.
+    repeat (int): The number of timed calls.
+    memory (bool): Measure the peak memory in one more call, traced with tracemalloc so that the tracing overhead
+    does not end up in the timings.
+
+    Returns:
+    tuple: The result of the last call and the metrics, the median and min wall time in seconds, the RPC requests
+    of a call, the peak memory in MB and the rows per second.
+    """
+    walls = []
+    for _ in range(repeat):
+        cold_start()
+        requests_before = rpc_requests()
+        started_at = time.perf_counter()
+        result = fn()
+        walls.append(time.perf_counter() - started_at)
+        calls = rpc_requests() - requests_before
+
+    peak_mb = None
+    if memory:
+        cold_start()
+        tracemalloc.start()
+        try:
+            fn()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    wall = float(np.median(walls))
+    return result, {'wall_s': round(wall, 6), 'wall_min_s': round(min(walls), 6), 'rpc_calls': calls,
+                    'peak_mb': None if peak_mb is None else round(peak_mb, 3), 'rows': int(rows),
+                    'rows_per_sec': round(rows / wall, 1) if wall > 0 else None}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((const.STANDIN_HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_standin(tip, args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'standin.py'), '--port', str(port),
+                                '--tip', str(tip), '--latency', str(args.latency), '--jitter', str(args.jitter),
+                                '--error-rate', str(args.error_rate), '--rate-limit-rate', str(args.rate_limit_rate),
+                                '--seed', str(args.seed)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://{const.STANDIN_HOST}:{port}'
+
+    # Ready once it answers, the imports take a few seconds
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.post(f'{url}/rpc/ready', json={'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber',
+                                                     'params': []}, timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('The stand-in server did not start')
+            time.sleep(0.2)
+
+
+def block_list(count):
+    return [const.BLOCK_START + k * const.BLOCK_INTERVAL for k in range(count)]
+
+
+def user_list(count):
+    return [f'0x{i + 1:040x}' for i in range(count)]
+
+
+def run(args):
+    tip = const.BLOCK_START + (max(args.blocks) + 1) * const.BLOCK_INTERVAL
+    process = None
+    if args.rpc_url is None:
+        process, url = start_standin(tip, args)
+        rpc_urls = [f'{url}/rpc/bench{i}' for i in range(args.endpoints)]
+    else:
+        rpc_urls = [args.rpc_url]
+
+    # The pool is built from the environment on the first call, the stand-in replaces the configured endpoints
+    os.environ.pop('INFURA_KEYS', None)
+    os.environ['RPC_URLS'] = ','.join(rpc_urls)
+    # The client throttle is sized for the Infura quota, against the stand-in it would be all the cases measure
+    client_rate_limit = args.client_rate_limit
+    if client_rate_limit is None and args.rpc_url is None:
+        client_rate_limit = float('inf')
+    if client_rate_limit is not None:
+        for rpc_url in rpc_urls:
+            concurrency.get_bucket(rpc_url, client_rate_limit, max(const.RPC_BURST, client_rate_limit))
+    # Every call reaches the RPC, a warm disk cache would hide the cost of a refresh
+    const.CALL_CACHE_ENABLED = args.call_cache
+
+    import charts
+    import utils
+
+    names = const.STRATEGY_NAME
+    strategy_counts = sorted({min(count, len(names)) for count in args.strategies})
+    results = []
+
+    def record(case, metrics, blocks=None, users=None, strategies=None):
+        entry = {'case': case, 'blocks': blocks, 'users': users, 'strategies': strategies, **metrics}
+        results.append(entry)
+        print(f"{case:<24} blocks={blocks} users={users} strategies={strategies} wall={metrics['wall_s']:.4f}s "
+              f"rpc={metrics['rpc_calls']} peak={metrics['peak_mb']}MB", file=sys.stderr)
+
+    def wanted(case):
+        return args.cases is None or case in args.cases
+
+    def timed(case, fn, rows, blocks=None, users=None, strategies=None):
+        # The cases that only feed the next ones run once, untraced
+        if not wanted(case):
+            return fn()
+        result, metrics = measure(fn, rows, args.repeat, args.memory)
+        record(case, metrics, blocks, users, strategies)
+        return result
+
+    try:
+        for count in args.blocks:
+            blocks = block_list(count)
+
+            if wanted('generate_time_series'):
+                timed('generate_time_series', lambda: utils.generate_time_series(blocks), count, blocks=count)
+
+            if wanted('get_data_for_blocks'):
+                # The path of the ingestion worker, Multicall batched when MULTICALL_BATCHING is set
+                timed('get_data_for_blocks', lambda: utils.get_data_for_blocks(blocks), count, blocks=count,
+                      strategies=len(names))
+
+            for n in strategy_counts:
+                selected = names[:n]
+                labels = {'blocks': count, 'strategies': n}
+                silo_df = timed('merge_strategy_data', lambda: utils.merge_strategy_data(
+                    blocks, const.STRATEGY_LIST[:n], const.ORACLE_ADDRESS_LIST[:n], const.CURVE_POOL_LIST[:n],
+                    selected), count, **labels)
+                pps_df = timed('merge_pps_data', lambda: utils.merge_pps_data(blocks, const.COLLATERAL_LIST[:n],
+                                                                              selected), count, **labels)
+                pps_df = utils.add_block_time(pps_df)
+                pps_df = timed('process_dataframe', lambda: utils.process_dataframe(pps_df), count, **labels)
+                master_data = timed('compute_master_data', lambda: utils.compute_master_data(pps_df, silo_df, selected),
+                                    count, **labels)
+
+                # The figure builders without their Streamlit cache, one figure per strategy as on the page
+                if wanted('usage_metrics_figure'):
+                    timed('usage_metrics_figure',
+                          lambda: [charts.usage_metrics_figure.__wrapped__(0, name, None, master_data)
+                                   for name in selected], count, **labels)
+                if wanted('misc_figures'):
+                    timed('misc_figures', lambda: [charts.misc_figures.__wrapped__(0, name, 30, None, master_data)
+                                                   for name in selected], count, **labels)
+                if wanted('risk_history_figure'):
+                    # One column per LTV bucket, like ltvhistory.risk_distribution
+                    distribution = pd.DataFrame(
+                        np.outer(np.linspace(1, 2, count), np.arange(1, len(const.USER_LTV_RISK_BINS) + 1)) * 1e6,
+                        index=blocks, columns=[f'bucket{i}' for i in range(len(const.USER_LTV_RISK_BINS))])
+                    timed('risk_history_figure', lambda: [charts.risk_history_figure.__wrapped__(0, name, distribution)
+                                                          for name in selected], count, **labels)
+
+        if wanted('get_user_position_data') or wanted('position_risk_figure'):
+            latest_strategy_data = utils.merge_strategy_data([tip])
+            for count in args.users:
+                labels = {'users': count, 'strategies': len(names)}
+                user_address_df = pd.DataFrame({'block': [tip], 'user_address_list': [user_list(count)]})
+                user_position_df = timed('get_user_position_data',
+                                         lambda: utils.get_user_position_data(user_address_df, tip), count, **labels)
+
+                if wanted('position_risk_figure'):
+                    user_table = utils.compute_user_ltv(latest_strategy_data, user_address_df, block=tip,
+                                                        user_position_df=user_position_df)
+                    timed('position_risk_figure', lambda: [charts.position_risk_figure.__wrapped__(0, name, user_table)
+                                                           for name in names], count, **labels)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True)
+    report = {'meta': {'commit': commit.stdout.strip() or None,
+                       'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'rpc': 'standin' if args.rpc_url is None else args.rpc_url,
+                       'endpoints': len(rpc_urls),
+                       # Unthrottled is null, JSON has no infinity
+                       'client_rate_limit': None if client_rate_limit == float('inf') else client_rate_limit,
+                       'latency': args.latency, 'repeat': args.repeat,
+                       'multicall_batching': const.MULTICALL_BATCHING, 'fetch_workers': const.FETCH_WORKERS},
+              'results': results}
+
+    output = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    return report
+
+
+def compare(base_report, head_report, threshold=const.BENCH_REGRESSION_THRESHOLD, noise_floor=const.BENCH_NOISE_FLOOR):
+    """
+    Compares the wall times of two benchmark reports.
+
+    Parameters:
+    base_report (dict): The report of the reference version.
+    head_report (dict): The report of the new version.
+    threshold (float): The ratio of the wall times above which a case counts as a regression.
+    noise_floor (float): Seconds, a slowdown smaller than this is never a regression.
+
+    Returns:
+    list: One dict per case found in both reports, with its base and head wall times, their ratio and whether it
+    regressed. The min wall times are compared, they are the least sensitive to a busy machine.
+    """
+    def key(result):
+        return result['case'], result['blocks'], result['users'], result['strategies']
+
+    base = {key(result): result for result in base_report['results']}
+    rows = []
+    for result in head_report['results']:
+        if key(result) not in base:
+            continue
+        base_wall, head_wall = base[key(result)]['wall_min_s'], result['wall_min_s']
+        ratio = head_wall / base_wall if base_wall > 0 else None
+        rows.append({'case': result['case'], 'blocks': result['blocks'], 'users': result['users'],
+                     'strategies': result['strategies'], 'base_s': base_wall, 'head_s': head_wall,
+                     'ratio': None if ratio is None else round(ratio, 3),
+                     'regression': ratio is not None and ratio > threshold and head_wall - base_wall > noise_floor})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the ingestion, metrics and rendering paths.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--blocks', type=int, nargs='+', default=const.BENCH_BLOCK_COUNTS)
+    run_parser.add_argument('--users', type=int, nargs='+', default=const.BENCH_USER_COUNTS)
+    run_parser.add_argument('--strategies', type=int, nargs='+', default=const.BENCH_STRATEGY_COUNTS)
+    run_parser.add_argument('--cases', nargs='+', help='Only these cases, every case by default')
+    run_parser.add_argument('--repeat', type=int, default=1, help='Timed calls per case, the median is reported')
+    run_parser.add_argument('--no-memory', dest='memory', action='store_false', help='Skip the peak memory run')
+    run_parser.add_argument('--call-cache', action='store_true', help='Keep the eth_call disk cache enabled')
+    run_parser.add_argument('--rpc-url', help='RPC endpoint to use instead of starting the stand-in')
+    run_parser.add_argument('--endpoints', type=int, default=1, help='Stand-in endpoints in the provider pool')
+    run_parser.add_argument('--client-rate-limit', type=float,
+                            help='Requests per second per endpoint on the client side, RPC_RATE_LIMIT with --rpc-url '
+                                 'and unthrottled against the stand-in by default')
+    run_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added by the stand-in per request')
+    run_parser.add_argument('--jitter', type=float, default=0.0)
+    run_parser.add_argument('--error-rate', type=float, default=0.0)
+    run_parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='File of the JSON report, stdout by default')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=const.BENCH_REGRESSION_THRESHOLD)
+    compare_parser.add_argument('--noise-floor', type=float, default=const.BENCH_NOISE_FLOOR)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if args.output:
+            args.output = os.path.abspath(args.output)
+        with scratch_dir():
+            run(args)
+    else:
+        with open(args.base) as base_file, open(args.head) as head_file:
+            comparison = compare(json.load(base_file), json.load(head_file), args.threshold, args.noise_floor)
+        print(json.dumps(comparison, indent=1))
+        # A non-zero exit lets a CI job fail on a regression
+        sys.exit(1 if any(row['regression'] for row in comparison) else 0)
@@ -0,0 +1,239 @@
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import concurrency
+import const
+import telemetry
+
+
+class BlockTimestampCache:
+    """
+    Persistent block number -> timestamp map, shared by every pipeline and across runs.
+
+    The timestamps read from a final block are the cache proper, the only ones get_many and the interpolation
+    anchors use. The times stored with the data of a block, which may be interpolated or not final yet, are kept
+    as estimated and only served to the stores reading them back. A timestamp read from the block always
+    replaces an estimated one, never the reverse.
+    """
+
+    def __init__(self, path=const.BLOCK_TIME_CACHE):
+        self.path = path
+        with self.connect() as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS block_timestamps (block INTEGER PRIMARY KEY, '
+                         'timestamp INTEGER NOT NULL, estimated INTEGER NOT NULL DEFAULT 0)')
+            # Caches written before the estimated times were kept
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(block_timestamps)')]
+            if 'estimated' not in columns:
+                conn.execute('ALTER TABLE block_timestamps ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0')
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def get_many(self, block_numbers, include_estimated=False):
+        block_numbers = [int(block_number) for block_number in block_numbers]
+        exact = '' if include_estimated else ' AND estimated = 0'
+        timestamps = {}
+        with self.connect() as conn:
+            # Chunked to stay under the SQLite limit on bound parameters
+            for i in range(0, len(block_numbers), 500):
+                chunk = block_numbers[i:i + 500]
+                timestamps.update(conn.execute(
+                    f'SELECT block, timestamp FROM block_timestamps '
+                    f'WHERE block IN ({", ".join("?" * len(chunk))}){exact}', chunk).fetchall())
+        return timestamps
+
+    def put_many(self, timestamps, estimated=False):
+        if not timestamps:
+            return
+        # An estimated time only fills a block without a timestamp read from the chain
+        conflict = 'WHERE block_timestamps.estimated = 1' if estimated else ''
+        with self.connect() as conn, conn:
+            conn.executemany('INSERT INTO block_timestamps (block, timestamp, estimated) VALUES (?, ?, ?) '
+                             f'ON CONFLICT (block) DO UPDATE SET timestamp = excluded.timestamp, '
+                             f'estimated = excluded.estimated {conflict}',
+                             [(int(block), int(timestamp), int(estimated)) for block, timestamp in timestamps.items()])
+
+    def block_range(self, start_timestamp=None, end_timestamp=None, start_block=None, end_block=None):
+        """
+        Finds the first and last stored block whose timestamp is in a time range.
+
+        Parameters:
+        start_timestamp (int): The earliest timestamp, unbounded when None.
+        end_timestamp (int): The latest timestamp, unbounded when None.
+        start_block (int): The first block considered.
+        end_block (int): The last block considered.
+
+        Returns:
+        tuple: The first and last block, (None, None) when no block matches.
+        """
+        clauses, params = [], []
+        for clause, value in (('timestamp >= ?', start_timestamp), ('timestamp <= ?', end_timestamp),
+                              ('block >= ?', start_block), ('block <= ?', end_block)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(int(value))
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        with self.connect() as conn:
+            return conn.execute(f'SELECT MIN(block), MAX(block) FROM block_timestamps {where}', params).fetchone()
+
+    def clear(self):
+        # Used by the benchmarks, every run reads the chain as a first run would
+        with self.connect() as conn, conn:
+            conn.execute('DELETE FROM block_timestamps')
+
+    def nearest_below(self, block_number):
+        with self.connect() as conn:
+            return conn.execute('SELECT block, timestamp FROM block_timestamps WHERE block < ? AND estimated = 0 '
+                                'ORDER BY block DESC LIMIT 1', (int(block_number),)).fetchone()
+
+    def nearest_above(self, block_number):
+        with self.connect() as conn:
+            return conn.execute('SELECT block, timestamp FROM block_timestamps WHERE block > ? AND estimated = 0 '
+                                'ORDER BY block LIMIT 1', (int(block_number),)).fetchone()
+
+
+# One cache per file, shared by every thread of the process
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(path=const.BLOCK_TIME_CACHE):
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = BlockTimestampCache(path)
+        return _CACHES[path]
+
+
+# The chain tip last read, shared by every call so a run reads it once per block time
+_TIP = {'block': 0, 'checked_at': 0.0}
+_TIP_LOCK = threading.Lock()
+
+
+def is_final(block_number, fetch_tip, finality_depth=const.FINALITY_DEPTH):
+    # A stale tip only underestimates finality, so it is read again at most once per block time, as in callcache
+    with _TIP_LOCK:
+        if block_number <= _TIP['block'] - finality_depth:
+            return True
+        if time.monotonic() - _TIP['checked_at'] < const.BLOCK_TIME:
+            return False
+        _TIP['checked_at'] = time.monotonic()
+    try:
+        tip = fetch_tip()
+    except Exception as e:
+        telemetry.failure('chain_tip', e)
+        return False
+    with _TIP_LOCK:
+        _TIP['block'] = max(_TIP['block'], int(tip))
+        return block_number <= _TIP['block'] - finality_depth
+
+
+def interpolation_error_bound(block_a, timestamp_a, block_b, timestamp_b, block_time=const.BLOCK_TIME):
+    # A block is never faster than one slot, so the time lost to missed slots between two anchors bounds how far any
+    # block in between can be from the straight line joining them
+    return abs((timestamp_b - timestamp_a) - (block_b - block_a) * block_time)
+
+
+def get_block_timestamps(block_numbers, fetch_timestamp, workers=const.FETCH_WORKERS,
+                         interpolate=const.BLOCK_TIME_INTERPOLATION, max_error=const.BLOCK_TIME_MAX_ERROR,
+                         cache=None, fetch_tip=None):
+    """
+    Gets the timestamps of a list of blocks, reading from the cache first and from the chain for the rest.
+
+    Parameters:
+    block_numbers (list): The block numbers.
+    fetch_timestamp (callable): Reads the timestamp of a single block from the chain, None on failure.
+    workers (int): The maximum number of blocks read concurrently.
+    interpolate (bool): Estimate the blocks between two known anchors when the error bound allows it.
+    max_error (int): The worst case error in seconds allowed for an estimated timestamp.
+    cache (BlockTimestampCache): The cache to use, the shared one by default.
+    fetch_tip (callable): Reads the chain tip the finality of a block is measured against. Without it the highest
+        requested block stands in for the tip, which only underestimates finality.
+
+    Returns:
+    dict: The timestamp of every block number, None for a block that could not be read.
+    """
+    cache = cache or get_cache()
+    blocks = sorted({int(block_number) for block_number in block_numbers})
+    if not blocks:
+        return {}
+
+    known = cache.get_many(blocks)
+    telemetry.count('block_time_cache_hits', len(known))
+    estimated = {}
+    failed = set()
+
+    # The blocks near the tip can still be reorged, they are read but not cached
+    if fetch_tip is None:
+        def final(block_number):
+            return block_number <= blocks[-1] - const.FINALITY_DEPTH
+    else:
+        def final(block_number):
+            return is_final(block_number, fetch_tip)
+
+    def fetch(to_fetch):
+        telemetry.count('block_time_fetches', len(to_fetch))
+        fetched = {}
+        for block_number, timestamp in zip(to_fetch, concurrency.map_blocks(fetch_timestamp, to_fetch, workers)):
+            if timestamp is None:
+                failed.add(block_number)
+            else:
+                fetched[block_number] = int(timestamp)
+        known.update(fetched)
+        cache.put_many({block_number: timestamp for block_number, timestamp in fetched.items()
+                        if final(block_number)})
+
+    if not interpolate:
+        fetch([block_number for block_number in blocks if block_number not in known])
+        return {block_number: known.get(block_number) for block_number in blocks}
+
+    # Cached blocks just outside the range serve as anchors too, so an incremental run reads only the new tip
+    anchors = dict(known)
+    for neighbour in (cache.nearest_below(blocks[0]), cache.nearest_above(blocks[-1])):
+        if neighbour is not None:
+            anchors[neighbour[0]] = neighbour[1]
+
+    while True:
+        anchors.update(known)
+        to_fetch = []
+
+        # Walk the runs of unknown blocks between two consecutive anchors
+        previous_anchor, run = None, []
+        for block_number in sorted(set(blocks) | set(anchors)):
+            if block_number in failed or block_number in estimated:
+                continue
+            if block_number not in anchors:
+                run.append(block_number)
+                continue
+            if run:
+                to_fetch += _resolve_run(previous_anchor, run, block_number, anchors, estimated, max_error)
+            previous_anchor, run = block_number, []
+        if run:
+            to_fetch += _resolve_run(previous_anchor, run, None, anchors, estimated, max_error)
+
+        if not to_fetch:
+            break
+
+        # Every round reads one block per unresolved run, concurrently
+        fetch(to_fetch)
+
+    telemetry.count('block_time_interpolated', len(estimated))
+    return {block_number: known.get(block_number, estimated.get(block_number)) for block_number in blocks}
+
+
+def _resolve_run(block_a, run, block_b, anchors, estimated, max_error):
+    # A run without an anchor on one side reads its outermost block, which becomes the anchor
+    if block_a is None:
+        return [run[0]]
+    if block_b is None:
+        return [run[-1]]
+
+    timestamp_a, timestamp_b = anchors[block_a], anchors[block_b]
+    if interpolation_error_bound(block_a, timestamp_a, block_b, timestamp_b) > max_error:
+        # Too many missed slots between the anchors, split the run on its middle block
+        return [run[len(run) // 2]]
+
+    for block_number in run:
+        estimated[block_number] = round(
+            timestamp_a + (block_number - block_a) * (timestamp_b - timestamp_a) / (block_b - block_a))
+    return []
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import const
+import telemetry
+
+
+class CallCache:
+    """
+    Disk-backed store of eth_call results, evicting the least recently used entries above max_bytes.
+    A result is stored under the hash of (chain, to, calldata, block) and never changes once the block is final.
+    """
+
+    def __init__(self, path=const.CALL_CACHE, max_bytes=const.CALL_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        with self.connect() as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS calls '
+                         '(key TEXT PRIMARY KEY, result TEXT NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS calls_used_at ON calls (used_at)')
+            self.size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM calls').fetchone()[0]
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    @staticmethod
+    def make_key(chain_id, transaction, block):
+        # Fields other than to and data (from, gas...) are rare but would change the result, so they are keyed too
+        extra = {field: value for field, value in transaction.items() if field not in ('to', 'data', 'input')}
+        key = [chain_id, str(transaction.get('to', '')).lower(),
+               str(transaction.get('data', transaction.get('input', ''))).lower(), block]
+        if extra:
+            key.append(json.dumps(extra, sort_keys=True, default=str))
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def get(self, key):
+        with self.connect() as conn, conn:
+            row = conn.execute('SELECT result FROM calls WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE calls SET used_at = ? WHERE key = ?', (time.time(), key))
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, result):
+        value = json.dumps(result)
+        with self.lock, self.connect() as conn, conn:
+            previous = conn.execute('SELECT size FROM calls WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO calls (key, result, size, used_at) VALUES (?, ?, ?, ?)',
+                         (key, value, len(value), time.time()))
+            self.size += len(value) - (previous[0] if previous else 0)
+
+            if self.size > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        # Drop the least recently used entries down to 90% of the budget, so eviction does not run on every put
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM calls ORDER BY used_at'):
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        conn.executemany('DELETE FROM calls WHERE key = ?', evicted)
+
+
+# One cache per file, shared by every thread of the process
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(path=const.CALL_CACHE):
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = CallCache(path)
+        return _CACHES[path]
+
+
+def _block_number(block_identifier):
+    # Tags such as 'latest' or 'pending' move with the chain and are never cached
+    if isinstance(block_identifier, int):
+        return block_identifier
+    if isinstance(block_identifier, str) and block_identifier.startswith('0x'):
+        return int(block_identifier, 16)
+    return None
+
+
+def construct_call_cache_middleware(cache=None, finality_depth=const.FINALITY_DEPTH):
+    """
+    Builds a web3 middleware serving historical eth_call results from the disk cache.
+
+    Parameters:
+    cache (CallCache): The cache to use, the shared one by default.
+    finality_depth (int): Calls less than this many blocks behind the chain tip are passed through uncached.
+
+    Returns:
+    callable: The middleware, to be added as the outermost layer so a hit skips the rate limit and retries.
+    """
+
+    # Kept outside the middleware, which web3 may build again for a new request chain
+    state = {'chain_id': None, 'tip': 0, 'tip_checked_at': 0.0}
+    state_lock = threading.Lock()
+
+    def call_cache_middleware(make_request, w3):
+        def chain_id():
+            with state_lock:
+                if state['chain_id'] is None:
+                    state['chain_id'] = int(make_request('eth_chainId', [])['result'], 16)
+                return state['chain_id']
+
+        def is_final(block):
+            # A stale tip only underestimates finality, so it is refreshed at most once per block time
+            with state_lock:
+                if block <= state['tip'] - finality_depth:
+                    return True
+                if time.monotonic() - state['tip_checked_at'] < const.BLOCK_TIME:
+                    return False
+                state['tip_checked_at'] = time.monotonic()
+            response = make_request('eth_blockNumber', [])
+            with state_lock:
+                if 'result' in response:
+                    state['tip'] = max(state['tip'], int(response['result'], 16))
+                return block <= state['tip'] - finality_depth
+
+        def middleware(method, params):
+            if method != 'eth_call' or not const.CALL_CACHE_ENABLED or len(params) < 2:
+                return make_request(method, params)
+
+            block = _block_number(params[1])
+            if block is None or not isinstance(params[0], dict) or not is_final(block):
+                return make_request(method, params)
+
+            store = cache or get_cache()
+            key = store.make_key(chain_id(), params[0], block)
+            result = store.get(key)
+            if result is not None:
+                telemetry.count('call_cache_hits')
+                return {'jsonrpc': '2.0', 'result': result}
+
+            telemetry.count('call_cache_misses')
+            response = make_request(method, params)
+            # Reverts and RPC errors are left out, the next run asks again
+            if 'result' in response and 'error' not in response:
+                store.put(key, response['result'])
+            return response
+
+        return middleware
+
+    return call_cache_middleware
@@ -1,16 +1,23 @@
 import streamlit as st
 # import plotly.express as px
 import plotly.graph_objects as go
+import pandas as pd
 import utils
+import ltvhistory
+import decimation
+import telemetry
+import const
+import clients
 
 
-def instantaneous_data(master_data, asset):
+@telemetry.timed()
+def instantaneous_data(master_data, asset, apr_window=30):
     # Find the row with maximum 'block' value
     max_block_row = master_data.loc[master_data['block'].idxmax()]
 
     st.write(f"## crvUSD - {asset} Silo")
     st.markdown(
-        f"*Data represented here are up to {utils.block_number_to_date(max_block_row['block'])} UTC*")
+        f"*Data represented here are up to {max_block_row['time']} UTC*")
 
     # Create a layout with three columns
     col1, col2, col3 = st.columns(3)
@@ -24,7 +31,8 @@ def instantaneous_data(master_data, asset):
 
     with col2:
         st.write(f"#### Rate Metrics for block: {max_block_row['block']:.0f}")
-        st.write(f"**Collateral APR:** {max_block_row[f'collateralApr_{asset}'] * 100:.4f} %")
+        st.write(f"**Collateral APR ({apr_window}d):** "
+                 f"{max_block_row[utils.collateral_apr_column(asset, apr_window)] * 100:.4f} %")
         st.write(f"**Borrow APY:** {max_block_row[f'borrowApy_{asset}'] * 100:.4f} %")
         st.write(f"**Lend APY:** {max_block_row[f'supplyApy_{asset}'] * 100:.4f} %")
 
@@ -35,21 +43,51 @@ def instantaneous_data(master_data, asset):
         st.write(f"**Normalized:** {max_block_row[f'oracleNormalized{asset}']:.4f}")
 
 
-def usage_metrics(master_data, asset):
+def time_window(master_data, days):
+    # The rows of the last days of history, the whole table when days is None
+    if days is None:
+        return master_data
+    return master_data[master_data['time'] >= master_data['time'].max() - pd.Timedelta(days=days)]
+
+
+def series_trace(x, y, **kwargs):
+    """
+    Builds the trace of a time series, decimated to const.CHART_MAX_POINTS points.
+
+    Parameters:
+    x (pd.Series): The times.
+    y (pd.Series): The values.
+    kwargs: The other attributes of the trace.
+
+    Returns:
+    go.Scatter: The trace, a go.Scattergl when it draws more than const.CHART_WEBGL_THRESHOLD points.
+    """
+    x, y = decimation.decimate(x, y, target=const.CHART_MAX_POINTS, method=const.CHART_DECIMATION)
+    # Decided on the points actually drawn, a decimated series renders as cheaply in SVG, hover and fill included
+    trace = go.Scattergl if len(x) > const.CHART_WEBGL_THRESHOLD else go.Scatter
+    return trace(x=x, y=y, **kwargs)
+
+
+# Figure builders are cached per (snapshot block, asset, time range), so sessions on the same snapshot share the
+# Plotly objects
+@st.cache_data(show_spinner=False, max_entries=64)
+@telemetry.timed()
+def usage_metrics_figure(snapshot_block, asset, days, _master_data):
+    master_data = time_window(_master_data, days)
     fig = go.Figure()
 
     # Add traces for 'reserveSizeUSDC' and 'currentBorrowUSDC' as area charts on the left y-axis
-    fig.add_trace(go.Scatter(x=master_data['time'], y=master_data[f'reserveSize{asset}'],
-                             mode='lines+markers', fill='tozeroy', name='Reserve Size',
-                             yaxis='y', line=dict(color='#6ac69b'), fillcolor='rgba(106, 198, 155, 0.3)'))
-    fig.add_trace(go.Scatter(x=master_data['time'], y=master_data[f'currentBorrow{asset}'],
-                             mode='lines+markers', fill='tozeroy', name='Current Borrow',
-                             yaxis='y', line=dict(color='#127475'), fillcolor='rgba(18, 116, 117, 0.3)'))
+    fig.add_trace(series_trace(master_data['time'], master_data[f'reserveSize{asset}'],
+                               mode='lines+markers', fill='tozeroy', name='Reserve Size',
+                               yaxis='y', line=dict(color='#6ac69b'), fillcolor='rgba(106, 198, 155, 0.3)'))
+    fig.add_trace(series_trace(master_data['time'], master_data[f'currentBorrow{asset}'],
+                               mode='lines+markers', fill='tozeroy', name='Current Borrow',
+                               yaxis='y', line=dict(color='#127475'), fillcolor='rgba(18, 116, 117, 0.3)'))
 
     # Add trace for 'utilizationUSDC' * 100% on the right y-axis
-    fig.add_trace(go.Scatter(x=master_data['time'], y=master_data[f'utilization{asset}'] * 100,
-                             mode='lines', name='Utilization', yaxis='y2',
-                             line=dict(color='#252525')))
+    fig.add_trace(series_trace(master_data['time'], master_data[f'utilization{asset}'] * 100,
+                               mode='lines', name='Utilization', yaxis='y2',
+                               line=dict(color='#252525')))
 
     # Update layout with titles and axis labels
     fig.update_layout(
@@ -63,66 +101,89 @@ def usage_metrics(master_data, asset):
         )
     )
 
+    return fig
+
+
+@telemetry.timed()
+def usage_metrics(master_data, asset, snapshot_block, days=None):
+    fig = usage_metrics_figure(snapshot_block, asset, days, master_data)
+
     # Display the chart
     st.plotly_chart(fig, use_container_width=True)
 
 
-def misc_charts(master_data, asset):
+@st.cache_data(show_spinner=False, max_entries=64)
+@telemetry.timed()
+def misc_figures(snapshot_block, asset, apr_window, days, _master_data):
+    master_data = time_window(_master_data, days)
+    colors = ['#127475', '#6ac69b']  # Custom colors
+
+    # Specify the y-axis columns for the first line chart
+    y_columns_1 = [utils.collateral_apr_column(asset, apr_window), f'borrowApy_{asset}']  # Predefined columns
+    rates_fig = go.Figure()
+    for i, column in enumerate(y_columns_1):
+        rates_fig.add_trace(
+            series_trace(master_data['time'], master_data[column] * 100, name=column,
+                         line=dict(color=colors[i])))
+    rates_fig.update_layout(title='Collateral returns vs Borrow interest rate', xaxis_title='Date', yaxis_title='(%)')
+    rates_fig.update_layout(legend=dict(title='Legend'))  # Add legend title
+
+    # Specify the y-axis columns for the second line chart
+    y_columns_2 = [f'supplyApy_{asset}', f'borrowApy_{asset}']  # Predefined columns
+    lending_fig = go.Figure()
+    for i, column in enumerate(y_columns_2):
+        lending_fig.add_trace(
+            series_trace(master_data['time'], master_data[column] * 100, name=column,
+                         line=dict(color=colors[i])))
+    lending_fig.update_layout(title='Lending returns vs Borrow interest rate', xaxis_title='Date', yaxis_title='(%)')
+    lending_fig.update_layout(legend=dict(title='Legend'))  # Add legend title
+
+    # Specify the y-axis columns for the third line chart
+    y_columns_3 = [f'oracleLow{asset}', f'oracleHigh{asset}']  # Predefined columns
+    oracle_fig = go.Figure()
+    for i, column in enumerate(y_columns_3):
+        oracle_fig.add_trace(
+            series_trace(master_data['time'], master_data[column], name=column, line=dict(color=colors[i])))
+    oracle_fig.update_layout(title='Oracle Low & High (Oracle Low is fetched from Oracle Contract and Oracle High from Pair Contract)', xaxis_title='Date', yaxis_title='Price')
+    oracle_fig.update_layout(legend=dict(title='Legend'))  # Add legend title
+
+    # Specify the y-axis columns for the fourth line chart
+    y_columns_4 = [f'oracleNormalized{asset}']  # Predefined columns
+    normalized_fig = go.Figure()
+    for i, column in enumerate(y_columns_4):
+        normalized_fig.add_trace(
+            series_trace(master_data['time'], master_data[column], name=column, line=dict(color=colors[i])))
+    normalized_fig.update_layout(title='Normalized Oracle', xaxis_title='Date', yaxis_title='Price')
+    normalized_fig.update_layout(legend=dict(title='Legend'))  # Add legend title
+
+    return rates_fig, lending_fig, oracle_fig, normalized_fig
+
+
+@telemetry.timed()
+def misc_charts(master_data, asset, snapshot_block, apr_window=30, days=None):
+    rates_fig, lending_fig, oracle_fig, normalized_fig = misc_figures(snapshot_block, asset, apr_window, days,
+                                                                      master_data)
+
     # Set up a two-column layout with wider columns
     left_column, right_column = st.columns(2)
 
     # First line chart in the left column
     with left_column:
-        # Specify the y-axis columns for the first line chart
-        y_columns_1 = [f'collateralApr_{asset}', f'borrowApy_{asset}']  # Predefined columns
-        fig1 = go.Figure()
-        colors = ['#127475', '#6ac69b']  # Custom colors
-        for i, column in enumerate(y_columns_1):
-            fig1.add_trace(
-                go.Scatter(x=master_data['time'], y=master_data[column] * 100, name=column,
-                           line=dict(color=colors[i])))
-        fig1.update_layout(title='Collateral returns vs Borrow interest rate', xaxis_title='Date', yaxis_title='(%)')
-        fig1.update_layout(legend=dict(title='Legend'))  # Add legend title
-        st.plotly_chart(fig1, use_container_width=True)  # Adjust width to container width
+        st.plotly_chart(rates_fig, use_container_width=True)  # Adjust width to container width
 
     # Second line chart in the right column
     with right_column:
-        # Specify the y-axis columns for the second line chart
-        y_columns_2 = [f'supplyApy_{asset}', f'borrowApy_{asset}']  # Predefined columns
-        fig2 = go.Figure()
-        for i, column in enumerate(y_columns_2):
-            fig2.add_trace(
-                go.Scatter(x=master_data['time'], y=master_data[column] * 100, name=column,
-                           line=dict(color=colors[i])))
-        fig2.update_layout(title='Lending returns vs Borrow interest rate', xaxis_title='Date', yaxis_title='(%)')
-        fig2.update_layout(legend=dict(title='Legend'))  # Add legend title
-        st.plotly_chart(fig2, use_container_width=True)  # Adjust width to container width
+        st.plotly_chart(lending_fig, use_container_width=True)  # Adjust width to container width
 
     with left_column:
-        # Specify the y-axis columns for the first line chart
-        y_columns_1 = [f'oracleLow{asset}', f'oracleHigh{asset}']  # Predefined columns
-        fig1 = go.Figure()
-        colors = ['#127475', '#6ac69b']  # Custom colors
-        for i, column in enumerate(y_columns_1):
-            fig1.add_trace(
-                go.Scatter(x=master_data['time'], y=master_data[column], name=column, line=dict(color=colors[i])))
-        fig1.update_layout(title='Oracle Low & High (Oracle Low is fetched from Oracle Contract and Oracle High from Pair Contract)', xaxis_title='Date', yaxis_title='Price')
-        fig1.update_layout(legend=dict(title='Legend'))  # Add legend title
-        st.plotly_chart(fig1, use_container_width=True)  # Adjust width to container width
+        st.plotly_chart(oracle_fig, use_container_width=True)  # Adjust width to container width
 
     # Second line chart in the right column
     with right_column:
-        # Specify the y-axis columns for the second line chart
-        y_columns_2 = [f'oracleNormalized{asset}']  # Predefined columns
-        fig2 = go.Figure()
-        for i, column in enumerate(y_columns_2):
-            fig2.add_trace(
-                go.Scatter(x=master_data['time'], y=master_data[column], name=column, line=dict(color=colors[i])))
-        fig2.update_layout(title='Normalized Oracle', xaxis_title='Date', yaxis_title='Price')
-        fig2.update_layout(legend=dict(title='Legend'))  # Add legend title
-        st.plotly_chart(fig2, use_container_width=True)  # Adjust width to container width
+        st.plotly_chart(normalized_fig, use_container_width=True)  # Adjust width to container width
 
 
+@telemetry.timed()
 def user_position_table(user_table, asset, column):
     # Filter out rows where USDC_LTV is not null
     filtered_table = user_table[user_table[f'{asset}_LTV'].notnull()]
@@ -164,68 +225,151 @@ def user_position_table(user_table, asset, column):
     column.write(filtered_table_table)
 
 
-def position_risk_chart(filtered_table_graph, asset, column):
-    with column:
-        # Create a new Plotly figure
-        fig = go.Figure()
-
-        # Add scatter trace (scatter plot)
-        fig.add_trace(go.Scatter(
-            x=filtered_table_graph[f'{asset}_liq_price'],
-            y=filtered_table_graph[f'{asset}_collateralBalance'],
-            mode='markers',  # Display markers only
-            name=f'{asset} Collateral Balance',
-            marker=dict(
-                color='blue',
-                size=filtered_table_graph[f'{asset}_collateralBalance'],
-                sizemode='area',
-                # This line is optional. It makes the marker size scale with the area and not the diameter
-                sizeref=2. * max(filtered_table_graph[f'{asset}_collateralBalance']) / (40. ** 2),
-                # This line is optional. It adjusts the size of the markers
-                sizemin=4
-                # This line is optional. It sets a minimum bound on the size of the markers
-            )
-        ))
-
-        # Add vertical line at the 'USDC_share_price' value
-        # Assuming 'USDC_share_price' has only one value
-        share_price_value = filtered_table_graph[f'{asset}_share_price'].iloc[0]
-        fig.add_shape(
-            type="line",
-            x0=share_price_value,
-            y0=0,
-            x1=share_price_value,
-            y1=max(filtered_table_graph[f'{asset}_collateralBalance']),
-            line=dict(
-                color="#6ac69b",
-                width=1,
-                dash="dash",
-            )
-        )
+@st.cache_data(show_spinner=False, max_entries=64)
+@telemetry.timed()
+def position_risk_figure(snapshot_block, asset, _filtered_table_graph):
+    filtered_table_graph = _filtered_table_graph
 
-        # Add annotation for the value of the vertical line
-        fig.add_annotation(
-            x=share_price_value,
-            y=max(filtered_table_graph[f'{asset}_collateralBalance']),
-            text=f"{asset} silo share price: {share_price_value:.4f}",
-            showarrow=True,
-            arrowcolor='#6ac69b',
-            arrowhead=0,
-            ax=0,
-            ay=-20
+    # Create a new Plotly figure
+    fig = go.Figure()
+
+    # Add scatter trace (scatter plot)
+    fig.add_trace(go.Scatter(
+        x=filtered_table_graph[f'{asset}_liq_price'],
+        y=filtered_table_graph[f'{asset}_collateralBalance'],
+        mode='markers',  # Display markers only
+        name=f'{asset} Collateral Balance',
+        marker=dict(
+            color='blue',
+            size=filtered_table_graph[f'{asset}_collateralBalance'],
+            sizemode='area',
+            # This line is optional. It makes the marker size scale with the area and not the diameter
+            sizeref=2. * max(filtered_table_graph[f'{asset}_collateralBalance']) / (40. ** 2),
+            # This line is optional. It adjusts the size of the markers
+            sizemin=4
+            # This line is optional. It sets a minimum bound on the size of the markers
+        )
+    ))
+
+    # Add vertical line at the 'USDC_share_price' value
+    # Assuming 'USDC_share_price' has only one value
+    share_price_value = filtered_table_graph[f'{asset}_share_price'].iloc[0]
+    fig.add_shape(
+        type="line",
+        x0=share_price_value,
+        y0=0,
+        x1=share_price_value,
+        y1=max(filtered_table_graph[f'{asset}_collateralBalance']),
+        line=dict(
+            color="#6ac69b",
+            width=1,
+            dash="dash",
         )
+    )
+
+    # Add annotation for the value of the vertical line
+    fig.add_annotation(
+        x=share_price_value,
+        y=max(filtered_table_graph[f'{asset}_collateralBalance']),
+        text=f"{asset} silo share price: {share_price_value:.4f}",
+        showarrow=True,
+        arrowcolor='#6ac69b',
+        arrowhead=0,
+        ax=0,
+        ay=-20
+    )
 
-        # Update layout
-        fig.update_layout(
-            title=f"{asset} Silo - User Collateral Balance vs. {asset} Silo Share Price",
-            xaxis_title=f"{asset} Share Price",
-            yaxis_title=f"{asset} Collateral Balance",
-            xaxis=dict(
-                range=[0.8, 2]  # Set the range of x-axis to no more than 2
-            )
+    # Update layout
+    fig.update_layout(
+        title=f"{asset} Silo - User Collateral Balance vs. {asset} Silo Share Price",
+        xaxis_title=f"{asset} Share Price",
+        yaxis_title=f"{asset} Collateral Balance",
+        xaxis=dict(
+            range=[0.8, 2]  # Set the range of x-axis to no more than 2
         )
+    )
+
+    return fig
+
 
+@telemetry.timed()
+def position_risk_chart(filtered_table_graph, asset, column, snapshot_block):
+    fig = position_risk_figure(snapshot_block, asset, filtered_table_graph)
+
+    with column:
         st.plotly_chart(fig)
 
         # Add a note below the graph
-        st.markdown('*[Note for above chart]: The relative size of the scatters are asset independent i.e. the reference is different for each chart.*')
\ No newline at end of file
+        st.markdown('*[Note for above chart]: The relative size of the scatters are asset independent i.e. the reference is different for each chart.*')
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+@telemetry.timed()
+def risk_history_figure(snapshot_block, asset, _distribution):
+    distribution = _distribution
+
+    fig = go.Figure()
+
+    # One stacked area per bucket, the closest to liquidation on top
+    for bucket in distribution.columns:
+        fig.add_trace(go.Scatter(x=distribution.index, y=distribution[bucket], mode='lines', stackgroup='debt',
+                                 name=bucket if bucket == ltvhistory.NO_COLLATERAL_BUCKET else f'{bucket} of liq. LTV'))
+
+    fig.update_layout(
+        title=f"{asset} Silo - Debt by Distance to Liquidation",
+        xaxis_title="Block",
+        yaxis_title="Borrow Balance (crvUSD)"
+    )
+
+    return fig
+
+
+@telemetry.timed()
+def risk_history_chart(distribution, asset, column, snapshot_block):
+    # No chart until the history holds at least one block with a debt
+    if distribution.empty:
+        return
+
+    fig = risk_history_figure(snapshot_block, asset, distribution)
+
+    with column:
+        st.plotly_chart(fig, use_container_width=True)
+
+
+def diagnostics_panel(ingestion_status, page_seconds):
+    """
+    Shows where the time of the last ingestion run and of this page went, and what the process has counted so far.
+
+    Parameters:
+    ingestion_status (dict): The committed status of the last ingestion run.
+    page_seconds (dict): The seconds of every section of this page render.
+    """
+    metrics = telemetry.snapshot()
+
+    with st.expander('Diagnostics'):
+        left_column, right_column = st.columns(2)
+
+        with left_column:
+            # Written by the worker, so the stages are there whether it runs in this process or separately
+            st.markdown(f"**Last ingestion run**: {ingestion_status.get('seconds', '-')} s")
+            st.dataframe(pd.DataFrame({'seconds': ingestion_status.get('stages', {})}), use_container_width=True)
+            st.dataframe(pd.DataFrame({'count': ingestion_status.get('counters', {})}), use_container_width=True)
+
+        with right_column:
+            st.markdown(f"**This page**: {round(sum(page_seconds.values()), 3)} s")
+            st.dataframe(pd.DataFrame({'seconds': page_seconds}).round(3), use_container_width=True)
+            st.dataframe(pd.DataFrame({'count': metrics['counters']}), use_container_width=True)
+
+        # The failures the pipelines recovered from, e.g. a block left for a later run, latest first
+        if metrics['failures']:
+            st.dataframe(pd.DataFrame(metrics['failures'][::-1]), use_container_width=True)
+
+        # The totals of this process, slowest stages first. Cached figure builders only count their cache misses
+        timings = pd.DataFrame.from_dict(metrics['timings'], orient='index')
+        if not timings.empty:
+            timings['mean_seconds'] = timings['seconds'] / timings['calls']
+            st.dataframe(timings.sort_values('seconds', ascending=False).round(4), use_container_width=True)
+
+        # The pool only exists in this process when the worker runs in it
+        if const.INGESTION_IN_PROCESS:
+            st.dataframe(pd.DataFrame(clients.get_pool().stats()), use_container_width=True)
@@ -0,0 +1,82 @@
+import os
+import random
+import threading
+from web3 import Web3
+import concurrency
+import callcache
+import providers
+
+# The keys and the clients are only built on first use, importing a module never needs the network or a key
+
+
+def get_keys(env_name):
+    """
+    Reads a comma separated list of API keys from the environment.
+
+    Parameters:
+    env_name (str): The environment variable holding the keys.
+
+    Returns:
+    list: The keys.
+    """
+    keys = os.environ.get(env_name)
+
+    if keys is None:
+        raise ValueError(f"{env_name} is not set")
+
+    return keys.split(',')
+
+
+def get_rpc_endpoints():
+    """
+    Lists the RPC endpoints of the pool: one per Infura key, plus every URL of RPC_URLS.
+
+    Returns:
+    list: The providers.Endpoint of every configured key and URL, in a random order per process.
+    """
+    infura_keys = os.environ.get("INFURA_KEYS")
+    rpc_urls = os.environ.get("RPC_URLS")
+
+    if infura_keys is None and rpc_urls is None:
+        raise ValueError("INFURA_KEYS is not set")
+
+    endpoints = [providers.Endpoint(f"https://mainnet.infura.io/v3/{key}", f"infura:{key[:6]}")
+                 for key in (infura_keys.split(',') if infura_keys else [])]
+    endpoints += [providers.Endpoint(url, url.split('/')[2] if '://' in url else url)
+                  for url in (rpc_urls.split(',') if rpc_urls else [])]
+
+    # Processes start their turns at different endpoints, the way the random key selection spread them
+    random.shuffle(endpoints)
+
+    return endpoints
+
+
+# A single client per process, shared by every Streamlit session and the ingestion worker
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_web3():
+    """
+    Returns the Web3 client of the process, built on the first call over the pool of every configured endpoint.
+
+    Returns:
+    Web3: The client with the retry and eth_call cache middlewares.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            client = Web3(providers.ProviderPool(get_rpc_endpoints()))
+            # Rate limits are per endpoint inside the pool, a request is only retried with backoff once every
+            # endpoint failed it
+            client.middleware_onion.add(concurrency.retry_middleware, 'retry')
+            # Outermost, so a historical eth_call already answered costs neither a token nor a request
+            client.middleware_onion.add(callcache.construct_call_cache_middleware(), 'call_cache')
+            _client = client
+
+        return _client
+
+
+def get_pool():
+    return get_web3().provider
@@ -0,0 +1,112 @@
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import HTTPError, ConnectionError, Timeout
+import const
+import telemetry
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Every RPC request takes one token, tokens refill at `rate` per second.
+    """
+
+    def __init__(self, rate=const.RPC_RATE_LIMIT, capacity=const.RPC_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# One bucket per RPC endpoint, shared by every thread of the process
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def get_bucket(key, rate=const.RPC_RATE_LIMIT, capacity=const.RPC_BURST):
+    # The rate and capacity only apply to the first call for a key, the bucket is shared afterwards
+    with _BUCKETS_LOCK:
+        if key not in _BUCKETS:
+            _BUCKETS[key] = TokenBucket(rate, capacity)
+        return _BUCKETS[key]
+
+
+def is_retryable(error):
+    # Rate limits (429) and server side errors (5xx) are transient, anything else is a real failure
+    if isinstance(error, HTTPError):
+        return error.response is not None and (error.response.status_code == 429 or
+                                               error.response.status_code >= 500)
+    return isinstance(error, (ConnectionError, Timeout))
+
+
+def is_rate_limited_response(response):
+    # Infura also reports an exceeded rate limit as a JSON-RPC error with code -32005
+    error = response.get('error') if isinstance(response, dict) else None
+    return isinstance(error, dict) and error.get('code') in (-32005, 429)
+
+
+def retry_middleware(make_request, w3):
+    def middleware(method, params):
+        for attempt in range(const.RPC_MAX_RETRIES + 1):
+            try:
+                response = make_request(method, params)
+            except Exception as e:
+                if attempt == const.RPC_MAX_RETRIES or not is_retryable(e):
+                    raise
+            else:
+                if attempt == const.RPC_MAX_RETRIES or not is_rate_limited_response(response):
+                    return response
+
+            # Exponential backoff with jitter so the workers do not retry in lockstep
+            time.sleep(const.RPC_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    return middleware
+
+
+def record_failure(fn, block_number, error):
+    # A failed block is left for a later run, counted and kept with its error so an outage does not pass for an
+    # empty block
+    telemetry.failure('block_fetch', error, fetch=getattr(fn, '__qualname__', repr(fn)), block=int(block_number))
+
+
+def map_blocks(fn, block_numbers, workers=const.FETCH_WORKERS):
+    """
+    Applies fn to every block number on a bounded thread pool.
+
+    Parameters:
+    fn (callable): The function fetching the data of a single block.
+    block_numbers (list): The block numbers to fetch.
+    workers (int): The maximum number of blocks fetched concurrently.
+
+    Returns:
+    list: The results in the order of block_numbers. A block whose fetch raised is None,
+    which matches the `continue` of the sequential loops. The failure is recorded with its block, see record_failure.
+    """
+
+    def fetch(block_number):
+        try:
+            return fn(block_number)
+        except Exception as e:
+            record_failure(fn, block_number, e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # executor.map yields in submission order, whatever the completion order is
+        return list(executor.map(fetch, block_numbers))
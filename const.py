@@ -1,3 +1,5 @@
+from strategies import STRATEGIES
+
 BLOCK_TIME = 12  # Seconds
 BLOCK_INTERVAL = 1200  # 14400 Secs
 # 1200 Blocks every 4 hours on Average
@@ -5,25 +7,92 @@ BLOCK_START = 19013700  # 15th Jan 2024
 BLOCK_START_PPS = 19013700 - 216000
 
 DATA_PROVIDER = '0x69764E3e0671747A7768A1C1AfB7C0C39868CC9e'
-CURVE_POOL_LIST = ['0x4dece678ceceb27446b35c672dc7d61f30bad69e',
-                   '0x3de254a0f838a844f727fee81040e0fa7884b935',
-                   '0x390f3595bca2df7d23783dfd126427cceb997bf4',
-                   '0x0cd6f267b2086bea681e922e19d40512511be538']
-STRATEGY_LIST = ['0x6311fF24fb15310eD3d2180D3d0507A21a8e5227',
-                 '0x200723063111f9f8f1d44c0F30afAdf0C0b1a04b',
-                 '0x26fe402A57D52c8a323bb6e09f06489C8216aC88',
-                 '0x8dDE9A50a91cc0a5DaBdc5d3931c1AF60408c84D']
-COLLATERAL_LIST = ['0x7cA00559B978CFde81297849be6151d3ccB408A9',
-                   '0xd901DCf4948a29d7D9D7E015AAF61591825AC267',
-                   '0x241AdD131B9aaa7527132b752252b99420937ADc',
-                   '0x8176b059BD8f63aeB7e20282b12D243b4626E2AE']
-ORACLE_ADDRESS_LIST = ['0xA460cc3dC111E42939512B29390e576f8506D213',
-                       '0x71A0478d181D5fD5f14C46617a58D8e3095bbDDb', # '0xE0DD70C18976Ad7334354234c73ce2a4b749F5F0',
-                       '0x6F7C66f09922C04218B54A04261FcA2310c76aDC',
-                       '0x680F851a3796AB1Aa1204cA8dD2214ef170D1A2D']
-STRATEGY_NAME = ['USDC',
-                 'mkUSD',
-                 'USDT',
-                 'FRAX']
+# The per-strategy lists, in the order of strategies.STRATEGIES. Add a silo to the registry rather than here
+CURVE_POOL_LIST = [strategy.curve_pool for strategy in STRATEGIES]
+STRATEGY_LIST = [strategy.address for strategy in STRATEGIES]
+COLLATERAL_LIST = [strategy.collateral for strategy in STRATEGIES]
+ORACLE_ADDRESS_LIST = [strategy.oracle for strategy in STRATEGIES]
+STRATEGY_NAME = [strategy.name for strategy in STRATEGIES]
 LOAD_DF_NAME = ['save_strategy_data', 'saved_pps_data']
 QUERY_ID = "3487124"
+DUNE_RESULT_MAX_AGE = 6 * 3600  # Seconds, a latest query result younger than this is used instead of executing the query
+DUNE_TIMEOUT = 600  # Seconds an execution is polled before it is cancelled
+DUNE_POLL_INTERVAL = 1  # Seconds before the first status poll, doubled after every poll
+DUNE_POLL_MAX_INTERVAL = 30  # Seconds, upper bound of the poll interval
+DUNE_PAGE_SIZE = 10000  # Rows per result page
+DUNE_REQUEST_TIMEOUT = 30  # Seconds before a Dune API request is abandoned
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+MULTICALL_BATCHING = True  # Pack every call for a block into a single aggregate3 eth_call
+FETCH_WORKERS = 1  # Blocks fetched concurrently during a backfill, 1 keeps the sequential path for debugging
+RPC_RATE_LIMIT = 10  # Requests per second per RPC endpoint, one endpoint per Infura key or RPC_URLS entry
+RPC_BURST = 20  # Requests allowed in a burst before the rate limit kicks in
+RPC_MAX_RETRIES = 5  # Retries on 429/5xx responses, once every endpoint of the pool failed
+RPC_BACKOFF = 0.5  # Seconds, doubled on every retry
+RPC_TIMEOUT = 30  # Seconds before an RPC request is abandoned
+RPC_POOL_STRATEGY = 'least_load'  # 'least_load' or 'round_robin'
+RPC_POOL_CONNECTIONS = 16  # Keep-alive connections per endpoint
+RPC_POOL_MAX_ERROR_RATE = 0.5  # Smoothed error rate above which an endpoint is ejected
+RPC_POOL_MIN_REQUESTS = 5  # Requests to an endpoint before its error rate can eject it
+RPC_POOL_COOLDOWN = 30  # Seconds an ejected endpoint is left out, doubled while it keeps failing
+RPC_POOL_MAX_COOLDOWN = 600  # Seconds, upper bound of the doubled cooldown
+STANDIN_HOST = '127.0.0.1'  # Interface of the local RPC and Dune stand-in, see standin.py
+STANDIN_PORT = 8545
+STANDIN_USERS = 500  # Synthetic users of the stand-in, also the rows of its Dune query
+BENCH_BLOCK_COUNTS = [1, 10, 100, 1000, 10000]  # Block counts swept by bench.py
+BENCH_USER_COUNTS = [10, 100, 1000, 10000, 50000]  # User counts swept by bench.py
+BENCH_STRATEGY_COUNTS = [1, 2, 4]  # Strategy counts swept by bench.py, capped to the registry
+BENCH_REGRESSION_THRESHOLD = 1.2  # Ratio of the wall times above which bench.py compare reports a regression
+BENCH_NOISE_FLOOR = 0.01  # Seconds, a smaller slowdown is never reported as a regression
+JSON_LOGS = False  # Print the ingestion stage timings and run summaries as one JSON object per line
+METRICS_HOST = '127.0.0.1'  # Interface of the Prometheus metrics endpoint of the ingestion worker
+METRICS_PORT = None  # Port of the metrics endpoint, None leaves it off unless worker.py is given --metrics-port
+METRICS_PREFIX = 'sturdy'  # Prefix of the exported metric names
+DIAGNOSTICS_PANEL = False  # Show the stage timings and counters below the dashboard, also enabled by ?diagnostics=1
+RECENT_FAILURES = 100  # Recovered failures kept with their context for the diagnostics panel
+CHART_DECIMATION = 'lttb'  # 'lttb', 'minmax', or None to send every row of a series to the browser
+CHART_MAX_POINTS = 1000  # Points per series after decimation, about the width of a chart in pixels
+# Points drawn by a trace above which it uses WebGL. A decimated series stays below it, only a series left whole with
+# CHART_DECIMATION = None reaches it. Browsers cap the WebGL contexts of a page, so SVG is kept whenever it is enough
+CHART_WEBGL_THRESHOLD = 5000
+CHART_TIME_RANGES = [30, 90, 365, None]  # Days of history the time series charts can show, None for all of it
+INGESTION_INTERVAL = 600  # Seconds between two runs of the ingestion worker
+INGESTION_IN_PROCESS = True  # Start the ingestion worker as a thread of the Streamlit process, set False when worker.py runs separately
+INGESTION_STATUS_FILE = 'ingestion_status.json'
+USER_TABLE_FILE = 'user_tableV1.csv'
+STORAGE_BACKEND = 'parquet'  # 'parquet', 'sqlite' or 'csv'
+STRATEGY_CSV = 'sturdyDataStrategyV1.csv'
+PPS_CSV = 'sturdyDataPpsV1.csv'
+PARQUET_DIR = 'data'
+PARQUET_MAX_PARTITIONS = 64  # Partitions of a table before they are compacted into one
+ADDRESS_LOG_CSV = 'address_log.csv'  # Legacy full address lists, migrated into ADDRESS_LOG_DIR
+# Delta encoded address snapshots, one partition per snapshot. The SQLite backend keeps them in its database
+ADDRESS_LOG_DIR = 'address_log'
+ADDRESS_LOG_FILE = 'address_log.parquet'  # Single file log of the earlier versions, moved into ADDRESS_LOG_DIR
+ADDRESS_LOG_REBASE_RATIO = 1.0  # A full snapshot is stored once the deltas since the last one hold more addresses than the set
+SQLITE_PATH = 'sturdy.sqlite'
+BLOCK_TIME_CACHE = 'block_timestamps.sqlite'
+BLOCK_TIME_INTERPOLATION = True  # Estimate the timestamps of intermediate blocks instead of reading every block
+BLOCK_TIME_MAX_ERROR = 600  # Seconds, worst case error allowed for an interpolated timestamp
+FINALITY_DEPTH = 64  # Blocks, two epochs. Anything newer may still be reorged and is never cached
+CALL_CACHE = 'eth_call_cache.sqlite'
+CALL_CACHE_ENABLED = True  # Serve historical eth_call results from the disk cache
+CALL_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Size of the cached results before the least recently used are evicted
+USER_SCAN_BATCH_SIZE = 200  # getUserPositions calls packed in one aggregate3 call
+USER_SCAN_WORKERS = 4  # aggregate3 batches of user positions in flight
+USER_SCAN_INCREMENTAL = True  # Re-read only the users touched by a pair event since the last scan
+USER_SCAN_FULL_INTERVAL = 7200  # Blocks, about a day. Interest accrues without events, every user is re-read once the last full scan is older
+USER_POSITION_FILE = 'user_positionsV1.csv'
+USER_LOG_BLOCK_RANGE = 5000  # Blocks per eth_getLogs request
+MASTER_DATA_FILE = 'master_dataV1.csv'
+MASTER_DATA_INCREMENTAL = True  # Compute the master rows of the new blocks only, from the pps samples of the APR windows
+APR_WINDOWS = [7, 30, 90]  # Days of the collateral APR lookbacks, 30 feeds collateralApr_ and the spread
+APR_WINDOW_TOLERANCE = 2 * BLOCK_INTERVAL * BLOCK_TIME  # Seconds a lagged pps sample may be older than its window
+GAP_FILL = True  # Re-fetch the grid blocks missing from the stores on every ingestion run
+GAP_REFETCH_LIMIT = 100  # Missing blocks re-fetched per run
+GAP_MAX_ATTEMPTS = 5  # Failed attempts before a missing cell is parked and left to a manual retry
+GAP_RETRY_QUEUE_FILE = 'gap_retry_queue.json'
+FETCH_FAILURE_LOG = 'fetch_failures.jsonl'
+USER_LTV_HISTORY = True  # Snapshot every user position at each ingested block for the liquidation risk history
+USER_LTV_DIR = 'data/user_ltv'
+USER_LTV_BLOCKS_PER_RUN = 50  # Blocks snapshotted per ingestion run, the backfill goes from the newest block back
+USER_LTV_RISK_BINS = [0, 0.5, 0.7, 0.8, 0.9, 0.95, 1]  # Edges of the LTV / liquidation LTV buckets of the risk chart
@@ -0,0 +1,266 @@
+import threading
+from eth_abi import encode, decode
+from eth_utils import function_abi_to_4byte_selector
+from eth_utils.abi import collapse_if_tuple
+from web3 import Web3
+import clients
+
+# ABI for the Multicall3 aggregate3 function
+AGGREGATE3_ABI = [{"inputs": [{"components": [{"internalType": "address", "name": "target", "type": "address"},
+                                              {"internalType": "bool", "name": "allowFailure", "type": "bool"},
+                                              {"internalType": "bytes", "name": "callData", "type": "bytes"}],
+                               "internalType": "struct Multicall3.Call3[]", "name": "calls", "type": "tuple[]"}],
+                   "name": "aggregate3",
+                   "outputs": [{"components": [{"internalType": "bool", "name": "success", "type": "bool"},
+                                               {"internalType": "bytes", "name": "returnData", "type": "bytes"}],
+                                "internalType": "struct Multicall3.Result[]", "name": "returnData",
+                                "type": "tuple[]"}],
+                   "stateMutability": "payable", "type": "function"}]
+
+# ABI for the getUserPositions function
+GET_USER_POSITIONS_ABI = [
+    {"inputs": [{"internalType": "address", "name": "user", "type": "address"}], "name": "getUserPositions",
+     "outputs": [{"components": [{"components": [{"internalType": "address", "name": "vault", "type": "address"},
+                                                 {"internalType": "uint256", "name": "balance",
+                                                  "type": "uint256"}],
+                                  "internalType": "struct IAggregatorDataProvider.UserVaultData[]",
+                                  "name": "userVaultData", "type": "tuple[]"}, {"components": [
+         {"internalType": "address", "name": "strategy", "type": "address"},
+         {"internalType": "uint256", "name": "assetBalance", "type": "uint256"},
+         {"internalType": "uint256", "name": "borrowBalance", "type": "uint256"},
+         {"internalType": "uint256", "name": "collateralBalance", "type": "uint256"}],
+                                     "internalType": "struct IAggregatorDataProvider.UserStrategyData[]",
+                                     "name": "userStrategyData",
+                                     "type": "tuple[]"}],
+                  "internalType": "struct IAggregatorDataProvider.AggregatedUserData", "name": "arg_0",
+                  "type": "tuple"}], "stateMutability": "view", "type": "function"}]
+
+# ABI for the getStrategy function
+GET_STRATEGY_ABI = [
+    {"inputs": [{"internalType": "address", "name": "_strategy", "type": "address"}], "name": "getStrategy",
+     "outputs": [{"components": [{"internalType": "address", "name": "deployedAt", "type": "address"},
+                                 {"internalType": "address", "name": "pair", "type": "address"}, {
+                                     "components": [{"internalType": "address", "name": "asset", "type": "address"},
+                                                    {"internalType": "string", "name": "assetSymbol",
+                                                     "type": "string"},
+                                                    {"internalType": "uint256", "name": "assetDecimals",
+                                                     "type": "uint256"},
+                                                    {"internalType": "address", "name": "collateral",
+                                                     "type": "address"},
+                                                    {"internalType": "string", "name": "collateralSymbol",
+                                                     "type": "string"},
+                                                    {"internalType": "uint256", "name": "collateralDecimals",
+                                                     "type": "uint256"},
+                                                    {"internalType": "address", "name": "rateContract",
+                                                     "type": "address"},
+                                                    {"internalType": "address", "name": "oracle",
+                                                     "type": "address"},
+                                                    {"internalType": "uint256", "name": "depositLimit",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint64", "name": "ratePerSec",
+                                                     "type": "uint64"},
+                                                    {"internalType": "uint64", "name": "fullUtilizationRate",
+                                                     "type": "uint64"},
+                                                    {"internalType": "uint32", "name": "feeToProtocolRate",
+                                                     "type": "uint32"},
+                                                    {"internalType": "uint32", "name": "maxOacleDeviation",
+                                                     "type": "uint32"},
+                                                    {"internalType": "uint256", "name": "lowExchangeRate",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "highExchangeRate",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "maxLTV",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "protocolLiquidationFee",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "totalAsset",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "totalCollateral",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "totalBorrow",
+                                                     "type": "uint256"},
+                                                    {"internalType": "uint256", "name": "version",
+                                                     "type": "uint256"}],
+                                     "internalType": "struct IAggregatorDataProvider.StrategyPairData",
+                                     "name": "pairData", "type": "tuple"}],
+                  "internalType": "struct IAggregatorDataProvider.StrategyData", "name": "arg_0", "type": "tuple"}],
+     "stateMutability": "view", "type": "function"}]
+
+# ABI for the getPrices function
+GET_PRICES_ABI = [
+    {"inputs": [], "name": "getPrices",
+     "outputs": [{"internalType": "bool", "name": "_isBadData", "type": "bool"},
+                 {"internalType": "uint256", "name": "_priceLow", "type": "uint256"},
+                 {"internalType": "uint256", "name": "_priceHigh", "type": "uint256"}],
+     "stateMutability": "view", "type": "function"}]
+
+# ABI for the get_virtual_price function
+GET_VIRTUAL_PRICE_ABI = [
+    {"stateMutability": "view",
+     "type": "function",
+     "name": "get_virtual_price",
+     "inputs": [],
+     "outputs": [{"name": "arg_0", "type": "uint256"}]}]
+
+# ABI for the previewAddInterest function
+PREVIEW_ADD_INTEREST_ABI = [
+    {"inputs": [], "name": "previewAddInterest",
+     "outputs": [{"internalType": "uint256", "name": "_interestEarned", "type": "uint256"},
+                 {"internalType": "uint256", "name": "_feesAmount", "type": "uint256"},
+                 {"internalType": "uint256", "name": "_feesShare", "type": "uint256"}, {
+                     "components": [{"internalType": "uint32", "name": "lastBlock", "type": "uint32"},
+                                    {"internalType": "uint32", "name": "feeToProtocolRate",
+                                     "type": "uint32"},
+                                    {"internalType": "uint64", "name": "lastTimestamp",
+                                     "type": "uint64"},
+                                    {"internalType": "uint64", "name": "ratePerSec", "type": "uint64"},
+                                    {"internalType": "uint64", "name": "fullUtilizationRate",
+                                     "type": "uint64"}],
+                     "internalType": "struct SturdyPairCore.CurrentRateInfo",
+                     "name": "_newCurrentRateInfo", "type": "tuple"}, {
+                     "components": [{"internalType": "uint128", "name": "amount", "type": "uint128"},
+                                    {"internalType": "uint128", "name": "shares", "type": "uint128"}],
+                     "internalType": "struct VaultAccount", "name": "_totalAsset", "type": "tuple"}, {
+                     "components": [{"internalType": "uint128", "name": "amount", "type": "uint128"},
+                                    {"internalType": "uint128", "name": "shares", "type": "uint128"}],
+                     "internalType": "struct VaultAccount", "name": "_totalBorrow", "type": "tuple"}],
+     "stateMutability": "view", "type": "function"}]
+
+# ABI for the currentRateInfo function
+CURRENT_RATE_INFO_ABI = [
+    {"inputs": [], "name": "currentRateInfo",
+     "outputs": [{"internalType": "uint32", "name": "lastBlock", "type": "uint32"},
+                 {"internalType": "uint32", "name": "feeToProtocolRate", "type": "uint32"},
+                 {"internalType": "uint64", "name": "lastTimestamp", "type": "uint64"},
+                 {"internalType": "uint64", "name": "ratePerSec", "type": "uint64"},
+                 {"internalType": "uint64", "name": "fullUtilizationRate", "type": "uint64"}],
+     "stateMutability": "view", "type": "function"}]
+
+# ABI for the pricePerShare function
+PRICE_PER_SHARE_ABI = [
+    {"stateMutability": "view",
+     "type": "function",
+     "name": "pricePerShare",
+     "inputs": [],
+     "outputs": [{"name": "arg_0", "type": "uint256"}]}]
+
+ABIS = {
+    'getUserPositions': GET_USER_POSITIONS_ABI,
+    'getStrategy': GET_STRATEGY_ABI,
+    'getPrices': GET_PRICES_ABI,
+    'get_virtual_price': GET_VIRTUAL_PRICE_ABI,
+    'previewAddInterest': PREVIEW_ADD_INTEREST_ABI,
+    'currentRateInfo': CURRENT_RATE_INFO_ABI,
+    'pricePerShare': PRICE_PER_SHARE_ABI,
+    'aggregate3': AGGREGATE3_ABI
+}
+
+
+def _checksum_addresses(abi_outputs, values):
+    # Mirror web3's return normalizers so decoded addresses match a direct contract call
+    normalized = []
+    for output, value in zip(abi_outputs, values):
+        if output['type'] == 'address':
+            normalized.append(Web3.to_checksum_address(value))
+        elif output['type'] == 'tuple':
+            normalized.append(tuple(_checksum_addresses(output['components'], value)))
+        elif output['type'] == 'tuple[]':
+            normalized.append(tuple(tuple(_checksum_addresses(output['components'], item)) for item in value))
+        else:
+            normalized.append(value)
+    return normalized
+
+
+def _has_address(abi_params):
+    return any(param['type'].startswith('address') or _has_address(param.get('components', []))
+               for param in abi_params)
+
+
+class AbiFunction:
+    """
+    A function of a registered ABI, with its selector and its input and output types computed once.
+    """
+
+    def __init__(self, fn_abi):
+        self.abi = fn_abi
+        self.name = fn_abi['name']
+        self.selector = function_abi_to_4byte_selector(fn_abi)
+        self.input_types = [collapse_if_tuple(param) for param in fn_abi['inputs']]
+        self.output_types = [collapse_if_tuple(param) for param in fn_abi['outputs']]
+        # Only the outputs holding an address need the checksum pass
+        self.checksum_outputs = _has_address(fn_abi['outputs'])
+
+    def encode(self, args=()):
+        """
+        Builds the calldata of a call, without going through a web3 contract object.
+
+        Parameters:
+        args (list): The arguments of the call.
+
+        Returns:
+        str: The 0x-prefixed calldata.
+        """
+        return '0x' + (self.selector + encode(self.input_types, list(args))).hex()
+
+    def decode(self, return_data):
+        """
+        Decodes the return data of a call the same way ContractFunction.call() does it.
+
+        Parameters:
+        return_data (bytes): The raw return data.
+
+        Returns:
+        The decoded value, unwrapped when the function has a single output.
+        """
+        decoded = decode(self.output_types, bytes(return_data))
+        if self.checksum_outputs:
+            decoded = _checksum_addresses(self.abi['outputs'], decoded)
+
+        # A single return value is unwrapped, the same way ContractFunction.call() does it
+        if len(decoded) == 1:
+            return decoded[0]
+
+        return tuple(decoded)
+
+
+# Every function of ABIS, parsed once at import. The ABI names are also the function names
+FUNCTIONS = {abi_name: AbiFunction(next(item for item in abi if item['name'] == abi_name))
+             for abi_name, abi in ABIS.items()}
+
+
+def get_function(abi_name):
+    return FUNCTIONS[abi_name]
+
+
+# Checksumming hashes the address, the result of every address seen so far is kept
+_checksum_cache = {}
+
+
+def to_checksum_address(address):
+    if address not in _checksum_cache:
+        _checksum_cache[address] = Web3.to_checksum_address(address)
+    return _checksum_cache[address]
+
+# Contract objects are built once per (address, ABI) and shared by every Streamlit session and the ingestion worker
+_contracts = {}
+_contracts_lock = threading.Lock()
+
+
+def get_contract(address, abi_name):
+    """
+    Returns the web3 contract handle of an address, built on the first call.
+
+    Parameters:
+    address (str): The contract address, in any case.
+    abi_name (str): The key of the ABI in ABIS.
+
+    Returns:
+    Contract: The contract bound to the client of this process.
+    """
+    key = (address.lower(), abi_name)
+
+    with _contracts_lock:
+        if key not in _contracts:
+            _contracts[key] = clients.get_web3().eth.contract(address=to_checksum_address(address),
+                                                              abi=ABIS[abi_name])
+        return _contracts[key]
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import const
+
+
+def lttb_indices(x, y, target):
+    """
+    Picks the points of a series kept by Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept, the others are split in target - 2 buckets and each bucket keeps the point
+    forming the largest triangle with the point kept before it and the average of the next bucket. The shape of the
+    line is kept, peaks included, with a fixed number of points.
+
+    Parameters:
+    x (np.ndarray): The x values as floats, sorted.
+    y (np.ndarray): The y values as floats.
+    target (int): The number of points kept.
+
+    Returns:
+    np.ndarray: The sorted indices of the kept points.
+    """
+    n = len(x)
+    if target >= n or target < 3:
+        return np.arange(n)
+
+    # Bucket i covers [edges[i], edges[i + 1]), the last point is a bucket of its own
+    edges = np.linspace(1, n - 1, target - 1).astype(int)
+    # The averages of every bucket and of the last point, computed at once rather than in the loop
+    sizes = np.diff(np.append(edges, n))
+    average_x = np.add.reduceat(x, edges) / sizes
+    average_y = np.add.reduceat(y, edges) / sizes
+
+    kept = np.empty(target, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+
+    selected_x, selected_y = x[0], y[0]
+    for i in range(target - 2):
+        start, end = edges[i], edges[i + 1]
+        bucket_x, bucket_y = x[start:end], y[start:end]
+
+        # Twice the area of the triangle, the factor does not change the largest
+        areas = np.abs((selected_x - average_x[i + 1]) * (bucket_y - selected_y) -
+                       (selected_x - bucket_x) * (average_y[i + 1] - selected_y))
+        selected = start + areas.argmax()
+        kept[i + 1] = selected
+        selected_x, selected_y = x[selected], y[selected]
+
+    return kept
+
+
+def minmax_indices(y, target):
+    """
+    Picks the lowest and highest point of every bucket of a series.
+
+    Parameters:
+    y (np.ndarray): The y values as floats.
+    target (int): The number of points kept, two per bucket.
+
+    Returns:
+    np.ndarray: The sorted indices of the kept points.
+    """
+    n = len(y)
+    # The first and last points are added to the extremes, the total stays within target
+    buckets = (target - 2) // 2
+    if target >= n or buckets < 1:
+        return np.arange(n)
+
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    kept = [index for start, end in zip(edges[:-1], edges[1:]) if end > start
+            for index in (start + int(np.argmin(y[start:end])), start + int(np.argmax(y[start:end])))]
+    # Kept whatever their value, so the line spans the whole range
+    return np.unique([0, n - 1] + kept)
+
+
+def decimate(x, y, target=const.CHART_MAX_POINTS, method=const.CHART_DECIMATION):
+    """
+    Reduces a series to at most target points before it is sent to the browser.
+
+    Parameters:
+    x (pd.Series): The x values, times or numbers, sorted.
+    y (pd.Series): The y values.
+    target (int): The number of points kept.
+    method (str): 'lttb', 'minmax', or None to keep every point.
+
+    Returns:
+    tuple: The kept x and y values, the series unchanged when it already fits.
+    """
+    if method is None or len(x) <= target:
+        return x, y
+
+    x_values = x.to_numpy(dtype='datetime64[ns]').astype('int64').astype(float) \
+        if pd.api.types.is_datetime64_any_dtype(x) else x.to_numpy(dtype=float)
+    y_values = y.to_numpy(dtype=float)
+
+    # A missing value has no place in a triangle or a bucket extreme, they are left out
+    present = np.flatnonzero(~(x.isna() | y.isna()).to_numpy())
+
+    if method == 'lttb':
+        kept = present[lttb_indices(x_values[present], y_values[present], target)]
+    elif method == 'minmax':
+        kept = present[minmax_indices(y_values[present], target)]
+    else:
+        raise ValueError(f'Unknown decimation method: {method}')
+
+    return x.iloc[kept], y.iloc[kept]
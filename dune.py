@@ -0,0 +1,225 @@
+import datetime
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import clients
+import const
+import telemetry
+
+# Overridden to point the client at a local stand-in, see standin.py
+DUNE_API_URL = os.environ.get("DUNE_API_URL", "https://api.dune.com/api/v1/")
+
+# Invalid key (401), credits used up (402) and rate limited (429) are problems of the key, the next one is tried
+KEY_ERRORS = (401, 402, 429)
+
+FAILED_STATES = ('QUERY_STATE_FAILED', 'QUERY_STATE_CANCELLED', 'QUERY_STATE_EXPIRED')
+
+
+def parse_time(value):
+    # Dune returns RFC 3339 times with nanoseconds, the fraction does not matter for the staleness check
+    return datetime.datetime.fromisoformat(value.split('.')[0].rstrip('Z')).replace(tzinfo=datetime.timezone.utc)
+
+
+class DuneClient:
+    """
+    Dune API client rotating over the DUNE_KEYS.
+    """
+
+    def __init__(self, keys=None):
+        self.keys = list(keys) if keys is not None else clients.get_keys("DUNE_KEYS")
+        # Processes start at different keys, the way the random key selection spread them
+        self.key_index = random.randrange(len(self.keys))
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+    def request(self, method, path, params=None):
+        """
+        Sends a request with the current key, moving on to the next key when the current one is refused.
+
+        Parameters:
+        method (str): 'GET' or 'POST'.
+        path (str): The path after the API URL.
+        params (dict): The query string parameters.
+
+        Returns:
+        dict: The JSON response.
+        """
+        for attempt in range(len(self.keys)):
+            with self.lock:
+                key_index = self.key_index
+            response = self.session.request(method, DUNE_API_URL + path, params=params,
+                                            headers={"x-dune-api-key": self.keys[key_index]},
+                                            timeout=const.DUNE_REQUEST_TIMEOUT)
+            telemetry.count('dune_requests')
+            telemetry.count('dune_bytes_read', len(response.content))
+
+            if response.status_code in KEY_ERRORS and attempt < len(self.keys) - 1:
+                with self.lock:
+                    # Another thread may have rotated already
+                    if self.key_index == key_index:
+                        self.key_index = (key_index + 1) % len(self.keys)
+                telemetry.count('dune_key_rotations')
+                telemetry.log('dune_key_rotated', key_index=key_index, status_code=response.status_code)
+                continue
+
+            response.raise_for_status()
+            return response.json()
+
+    def get_rows(self, path, response=None):
+        """
+        Reads every page of a result.
+
+        Parameters:
+        path (str): The path of the result.
+        response (dict): The first page when it was already read.
+
+        Returns:
+        list: The rows of every page.
+        """
+        params = {"limit": const.DUNE_PAGE_SIZE}
+        if response is None:
+            response = self.request('GET', path, params)
+        rows = list(response['result']['rows'])
+
+        # The next page starts at next_offset until there is none
+        while response.get('next_offset') is not None:
+            response = self.request('GET', path, dict(params, offset=response['next_offset']))
+            rows += response['result']['rows']
+
+        return rows
+
+    @telemetry.timed()
+    def get_latest_result(self, query_id, max_age=const.DUNE_RESULT_MAX_AGE):
+        """
+        Reads the latest result of a query, without executing it.
+
+        Parameters:
+        query_id (str): The Dune query ID.
+        max_age (int): Seconds, an older result counts as stale.
+
+        Returns:
+        list: The rows of the latest result, None when there is none or it is stale.
+        """
+        path = f"query/{query_id}/results"
+        try:
+            response = self.request('GET', path, {"limit": const.DUNE_PAGE_SIZE})
+        except requests.exceptions.HTTPError as e:
+            # A query that was never executed has no latest result
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+        ended_at = response.get('execution_ended_at')
+        if ended_at is None:
+            return None
+
+        # The age is known from the first page, the other pages of a stale result are not read
+        age = (datetime.datetime.now(datetime.timezone.utc) - parse_time(ended_at)).total_seconds()
+        return self.get_rows(path, response) if age <= max_age else None
+
+    @telemetry.timed()
+    def execute(self, query_id, engine="free", timeout=const.DUNE_TIMEOUT):
+        """
+        Executes a query and waits for its result, polling with exponential backoff.
+
+        Parameters:
+        query_id (str): The Dune query ID.
+        engine (str): The performance tier of the execution.
+        timeout (int): Seconds after which the execution is cancelled.
+
+        Returns:
+        list: The rows of the result.
+        """
+        execution_id = self.request('POST', f"query/{query_id}/execute", {"performance": engine})['execution_id']
+        deadline = time.monotonic() + timeout
+        interval = const.DUNE_POLL_INTERVAL
+
+        while True:
+            state = self.request('GET', f"execution/{execution_id}/status")['state']
+            if state == 'QUERY_STATE_COMPLETED':
+                return self.get_rows(f"execution/{execution_id}/results")
+            if state in FAILED_STATES:
+                raise RuntimeError(f"Dune execution {execution_id} of query {query_id} ended in {state}")
+
+            if time.monotonic() + interval > deadline:
+                self.request('POST', f"execution/{execution_id}/cancel")
+                raise TimeoutError(f"Dune execution {execution_id} of query {query_id} did not complete in {timeout}s")
+
+            telemetry.count('dune_polls')
+            time.sleep(interval)
+            interval = min(interval * 2, const.DUNE_POLL_MAX_INTERVAL)
+
+    def get_query_rows(self, query_id, engine="free", max_age=const.DUNE_RESULT_MAX_AGE):
+        # A recent enough latest result costs no execution credits
+        rows = self.get_latest_result(query_id, max_age)
+        if rows is None:
+            rows = self.execute(query_id, engine)
+        return rows
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = DuneClient()
+        return _client
+
+
+def get_addresses(query_id=const.QUERY_ID, engine="free"):
+    return [row['address'] for row in get_client().get_query_rows(query_id, engine)]
+
+
+# A single refresh in flight per process, the ingestion runs collect it once it is done
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dune')
+_refresh = None
+_refresh_lock = threading.Lock()
+
+
+def start_refresh(triggered_block, query_id=const.QUERY_ID):
+    """
+    Fetches the addresses of the query in the background.
+
+    Parameters:
+    triggered_block (int): The block the addresses are logged at.
+    query_id (str): The Dune query ID.
+
+    Returns:
+    bool: True when a refresh was started, False when one is already in flight or not collected yet.
+    """
+    global _refresh
+
+    with _refresh_lock:
+        if _refresh is not None:
+            return False
+        _refresh = (triggered_block, _executor.submit(get_addresses, query_id))
+        return True
+
+
+def collect_refresh(wait=False):
+    """
+    Returns the result of the background refresh once it is done.
+
+    Parameters:
+    wait (bool): Block until the refresh in flight is done.
+
+    Returns:
+    tuple: The (triggered block, addresses) of the refresh, None when there is none or it is not done. A refresh that
+    failed raises its error, the next start_refresh tries again.
+    """
+    global _refresh
+
+    with _refresh_lock:
+        if _refresh is None or (not wait and not _refresh[1].done()):
+            return None
+        triggered_block, future = _refresh
+        _refresh = None
+
+    return triggered_block, future.result()
@@ -0,0 +1,173 @@
+import argparse
+import datetime
+import json
+import os
+import pandas as pd
+import concurrency
+import storage
+import telemetry
+import utils
+import const
+
+# First block of the grid of each table, the pps table starts earlier for the APR lookback
+GRID_START = {'strategy': const.BLOCK_START, 'pps': const.BLOCK_START_PPS}
+
+
+def expected_blocks(first_block, last_block, start=const.BLOCK_START, interval=const.BLOCK_INTERVAL):
+    # The start + k * interval grid of the ingestion loop, from the first grid block at or after first_block
+    first_grid_block = start + max(0, (first_block - start + interval - 1) // interval) * interval
+    return range(first_grid_block, last_block + 1, interval)
+
+
+def find_gaps(backend=None):
+    """
+    Compares the stored blocks of each table against the expected block grid.
+
+    Parameters:
+    backend (StorageBackend): The store to check, the configured one by default.
+
+    Returns:
+    dict: The sorted missing blocks of each table, between its first and its last stored block.
+    """
+    backend = backend or storage.get_backend()
+
+    gaps = {}
+    for table, start in GRID_START.items():
+        stored = backend.stored_blocks(table)
+        if not stored:
+            gaps[table] = []
+            continue
+        gaps[table] = sorted(set(expected_blocks(min(stored), max(stored), start)) - stored)
+
+    return gaps
+
+
+def cell_key(table, name, block):
+    return f'{table}:{name}:{block}'
+
+
+def load_retry_queue(file_path=const.GAP_RETRY_QUEUE_FILE):
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def save_retry_queue(queue, file_path=const.GAP_RETRY_QUEUE_FILE):
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump(queue, f, indent=1, sort_keys=True)
+    os.replace(tmp_file_path, file_path)
+
+
+def log_failure(table, name, block, error, file_path=const.FETCH_FAILURE_LOG):
+    # Append-only, one JSON object per failed cell and attempt
+    with open(file_path, 'a') as f:
+        f.write(json.dumps({'time': datetime.datetime.utcnow().isoformat(timespec='seconds'), 'table': table,
+                            'name': name, 'block': int(block), 'error': error}) + '\n')
+
+
+def is_parked(queue, table, block, names=const.STRATEGY_NAME, max_attempts=const.GAP_MAX_ATTEMPTS):
+    # A single cell out of attempts keeps the whole row of the block from being stored
+    return any(queue.get(cell_key(table, name, block), {}).get('attempts', 0) >= max_attempts for name in names)
+
+
+def fetch_snapshot(block_number):
+    # The error is kept for the failure log, concurrency.map_blocks would only give None
+    try:
+        return utils.get_block_snapshot(int(block_number)), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def fill_gaps(workers=const.FETCH_WORKERS, limit=const.GAP_REFETCH_LIMIT, retry_parked=False,
+              names=const.STRATEGY_NAME):
+    """
+    Re-fetches the grid blocks missing from the stores and records the cells that fail again.
+
+    Parameters:
+    workers (int): The number of blocks fetched concurrently.
+    limit (int): The maximum number of blocks re-fetched in this run.
+    retry_parked (bool): Also retry the cells that ran out of attempts.
+    names (list): The strategy names, index-aligned with the strategy and collateral lists.
+
+    Returns:
+    list: The blocks stored by this run, in either table.
+    """
+    backend = storage.get_backend()
+    queue = load_retry_queue()
+
+    pending = {table: {block for block in blocks if retry_parked or not is_parked(queue, table, block)}
+               for table, blocks in find_gaps(backend).items()}
+    block_numbers = sorted(pending['strategy'] | pending['pps'])[:limit]
+    if not block_numbers:
+        return []
+
+    telemetry.count('gap_blocks_refetched', len(block_numbers))
+
+    # One aggregate3 call per block covers both tables, only the tables missing the block are written
+    results = concurrency.map_blocks(fetch_snapshot, block_numbers, workers)
+
+    rows = {'strategy': [[] for _ in names], 'pps': [[] for _ in names]}
+    filled = {'strategy': [], 'pps': []}
+    attempted_at = datetime.datetime.utcnow().isoformat(timespec='seconds')
+
+    for block_number, (snapshot, error) in zip(block_numbers, results):
+        for index, table in enumerate(['strategy', 'pps']):
+            if block_number not in pending[table]:
+                continue
+
+            table_rows = snapshot[index] if snapshot is not None else [None] * len(names)
+            for name, row in zip(names, table_rows):
+                key = cell_key(table, name, block_number)
+                if row is not None:
+                    queue.pop(key, None)
+                    continue
+                cell_error = error or 'call reverted or could not be decoded'
+                entry = queue.setdefault(key, {'attempts': 0})
+                entry.update(attempts=entry['attempts'] + 1, last_error=cell_error, last_attempt=attempted_at)
+                log_failure(table, name, block_number, cell_error)
+
+            if all(row is not None for row in table_rows):
+                filled[table].append(block_number)
+                for i, row in enumerate(table_rows):
+                    rows[table][i].append(row)
+
+    new_strategy_data, new_pps_data = pd.DataFrame(), pd.DataFrame()
+    if filled['strategy']:
+        new_strategy_data = utils.merge_strategy_data(
+            historic_block_list=filled['strategy'],
+            strategy_frames=[pd.DataFrame(strategy_rows) for strategy_rows in rows['strategy']])
+    if filled['pps']:
+        new_pps_data = utils.merge_pps_data(historic_block_list_pps=filled['pps'],
+                                            pps_frames=[pd.DataFrame(pps_rows) for pps_rows in rows['pps']])
+    utils.save_data(new_strategy_data, new_pps_data)
+
+    # Saved after the data, a crash in between only retries cells that are already stored
+    save_retry_queue(queue)
+
+    telemetry.log('gap_fill', refetched=len(block_numbers), strategy_blocks=len(filled['strategy']),
+                  pps_blocks=len(filled['pps']))
+
+    return sorted(set(filled['strategy']) | set(filled['pps']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Finds and re-fetches the blocks missing from the Sturdy data stores.')
+    parser.add_argument('--workers', type=int, default=const.FETCH_WORKERS,
+                        help='Number of blocks fetched concurrently')
+    parser.add_argument('--limit', type=int, default=const.GAP_REFETCH_LIMIT,
+                        help='Maximum number of blocks re-fetched')
+    parser.add_argument('--retry-parked', action='store_true',
+                        help='Also retry the cells that ran out of attempts')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the missing blocks')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        print(find_gaps())
+    else:
+        filled_blocks = fill_gaps(workers=args.workers, limit=args.limit, retry_parked=args.retry_parked)
+        print(f'Filled {len(filled_blocks)} blocks')
+        # The master rows from the first filled block on change with the new data
+        if filled_blocks:
+            utils.update_master_data(recompute_from=min(filled_blocks))
@@ -0,0 +1,301 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+import addresses
+import gaps
+import storage
+import strategies
+import telemetry
+import utils
+import const
+
+# Cell name of the history in the gap retry queue, a failed block is retried as a whole
+RETRY_NAME = 'users'
+
+# Bucket of the positions with a debt and no collateral, whose ltv_ratio is not finite
+NO_COLLATERAL_BUCKET = 'No collateral'
+
+# One row per (block, user, strategy) with an open debt. The ratio of the LTV to the liquidation LTV is derived on load
+SCHEMA = pa.schema([('block', pa.int64()), ('user', pa.binary(20)), ('strategy', pa.string()),
+                    ('borrow', pa.float64()), ('collateral', pa.float64()), ('share_price', pa.float64()),
+                    ('max_ltv', pa.float64()), ('ltv', pa.float64())])
+
+
+def partitions(root=const.USER_LTV_DIR):
+    # part-<first block>-<last block>.parquet, the same layout as the ParquetBackend tables
+    partition_list = []
+    for path in sorted(glob.glob(os.path.join(root, 'part-*.parquet'))):
+        first_block, last_block = os.path.basename(path)[len('part-'):-len('.parquet')].split('-')
+        partition_list.append((int(first_block), int(last_block), path))
+    return partition_list
+
+
+def partition_blocks(path):
+    # The snapshotted blocks are kept in the footer, a block without any open debt has no row but is still done
+    return json.loads(pq.read_schema(path).metadata[b'blocks'])
+
+
+def stored_blocks(root=const.USER_LTV_DIR):
+    return {block for _, _, path in partitions(root) for block in partition_blocks(path)}
+
+
+def write_partition(df, blocks, root=const.USER_LTV_DIR):
+    table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+    table = table.replace_schema_metadata({'blocks': json.dumps(sorted(int(block) for block in blocks))})
+
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, f'part-{int(min(blocks)):010d}-{int(max(blocks)):010d}.parquet')
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def compact(root=const.USER_LTV_DIR):
+    # Merge the partitions written by every run into a single one. The merged partition is in place before the old
+    # ones are removed, so a failed write or a crash never loses the history
+    partition_list = partitions(root)
+    if len(partition_list) < 2:
+        return
+    blocks = [block for _, _, path in partition_list for block in partition_blocks(path)]
+    df = pa.concat_tables([pq.read_table(path) for _, _, path in partition_list]).to_pandas()
+    merged_path = write_partition(df, blocks, root)
+    for _, _, path in partition_list:
+        if path != merged_path:
+            os.remove(path)
+
+
+def position_rows(block, user_position_df, strategy_row, strategy_names=const.STRATEGY_NAME):
+    """
+    Turns the position table of a block into the long rows of the history.
+
+    Parameters:
+    block (int): The block the positions were read at.
+    user_position_df (DataFrame): The positions, as built by build_user_position_frame.
+    strategy_row (Series): The strategy data of the block, with the lowExchangeRate and maxLTV of every strategy.
+    strategy_names (list): The strategy names.
+
+    Returns:
+    DataFrame: One row per user and strategy with a debt, with the LTV computed the way compute_user_ltv does it.
+    """
+    # Sliced as bytes objects, a numpy S20 array would strip the trailing zero bytes of an address
+    packed = addresses.pack(user_position_df['user'])
+    users = np.array([packed[i:i + 20] for i in range(0, len(packed), 20)], dtype=object)
+
+    frames = []
+    for name in strategy_names:
+        borrow = user_position_df[f'{name}_borrowBalance'].to_numpy()
+        collateral = user_position_df[f'{name}_collateralBalance'].to_numpy()
+        share_price = float(strategy_row[f'lowExchangeRate{name}'])
+        has_debt = borrow > 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ltv = borrow[has_debt] * share_price / collateral[has_debt]
+
+        frames.append(pd.DataFrame({'block': int(block), 'user': users[has_debt], 'strategy': name,
+                                    'borrow': borrow[has_debt], 'collateral': collateral[has_debt],
+                                    'share_price': share_price, 'max_ltv': float(strategy_row[f'maxLTV{name}']),
+                                    'ltv': ltv}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def update_user_ltv_history(limit=const.USER_LTV_BLOCKS_PER_RUN, root=const.USER_LTV_DIR, backend=None):
+    """
+    Snapshots every user position at the ingested blocks that are not in the history yet, newest first.
+
+    The blocks already in the footers of the partitions are never read again. A block whose position reads fail is
+    recorded in the gap retry queue and parked after const.GAP_MAX_ATTEMPTS runs, so it does not hold the window
+    and get read again on every run.
+
+    Parameters:
+    limit (int): The maximum number of blocks snapshotted in this run, older blocks are left to the next runs.
+    root (str): The directory of the history.
+    backend (StorageBackend): The store of the strategy data and the address log, the configured one by default.
+
+    Returns:
+    list: The blocks snapshotted by this run.
+    """
+    backend = backend or storage.get_backend()
+
+    address_log_blocks = backend.load_address_snapshots()['block']
+    if address_log_blocks.empty:
+        return []
+
+    # The users are only known from the first address log snapshot on
+    candidates = {block for block in backend.stored_blocks('strategy') if block >= address_log_blocks.min()}
+    queue = gaps.load_retry_queue()
+    block_numbers = sorted((block for block in candidates - stored_blocks(root)
+                            if not gaps.is_parked(queue, 'user_ltv', block, names=[RETRY_NAME])), reverse=True)[:limit]
+    if not block_numbers:
+        return []
+
+    strategy_data = backend.load_strategy(
+        columns=strategies.columns(['lowExchangeRate', 'maxLTV']),
+        start_block=min(block_numbers), end_block=max(block_numbers)).set_index('block')
+
+    frames, done = [], []
+    attempted_at = datetime.datetime.utcnow().isoformat(timespec='seconds')
+    for block in block_numbers:
+        user_address_list = backend.load_address_log(block)['user_address_list'].iloc[0]
+        user_position_df = utils.build_user_position_frame(user_address_list, block)
+
+        # A block with failed position reads is left for a later run rather than stored incomplete
+        key = gaps.cell_key('user_ltv', RETRY_NAME, block)
+        if user_position_df.drop(columns='user').isna().any(axis=None):
+            entry = queue.setdefault(key, {'attempts': 0})
+            entry.update(attempts=entry['attempts'] + 1, last_error='getUserPositions failed',
+                         last_attempt=attempted_at)
+            gaps.log_failure('user_ltv', RETRY_NAME, block, 'getUserPositions failed')
+            continue
+
+        queue.pop(key, None)
+        frames.append(position_rows(block, user_position_df, strategy_data.loc[block]))
+        done.append(block)
+
+    if done:
+        write_partition(pd.concat(frames, ignore_index=True), done, root)
+        if len(partitions(root)) > const.PARQUET_MAX_PARTITIONS:
+            compact(root)
+
+    # Saved after the history, a crash in between only retries blocks that are already stored
+    gaps.save_retry_queue(queue)
+
+    telemetry.count('user_ltv_blocks', len(done))
+
+    return sorted(done)
+
+
+def load_user_ltv(start_block=None, end_block=None, strategy_names=None, root=const.USER_LTV_DIR):
+    """
+    Loads the history of the user positions.
+
+    Parameters:
+    start_block (int): The first block loaded.
+    end_block (int): The last block loaded.
+    strategy_names (list): The strategy names loaded, every strategy when None.
+    root (str): The directory of the history.
+
+    Returns:
+    DataFrame: The rows of the history sorted by block, with the users as 0x strings and the ltv_ratio column, the
+    LTV as a fraction of the liquidation LTV. A ratio of 1 or more is liquidatable.
+    """
+    filters = []
+    if start_block is not None:
+        filters.append(('block', '>=', int(start_block)))
+    if end_block is not None:
+        filters.append(('block', '<=', int(end_block)))
+    if strategy_names is not None:
+        filters.append(('strategy', 'in', list(strategy_names)))
+
+    tables, ranges = [], []
+    for first_block, last_block, path in partitions(root):
+        # Skip the partitions outside of the block range without opening them
+        if (start_block is not None and last_block < start_block) or (end_block is not None and first_block > end_block):
+            continue
+        tables.append(pq.read_table(path, filters=filters or None))
+        ranges.append((first_block, last_block))
+
+    df = pa.concat_tables(tables).to_pandas() if tables else SCHEMA.empty_table().to_pandas()
+    # A compaction briefly leaves the merged partition next to the ones it merges, their rows are read once
+    ranges.sort()
+    if any(first_block <= previous_last for (_, previous_last), (first_block, _) in zip(ranges, ranges[1:])):
+        df = df.drop_duplicates(subset=['block', 'user', 'strategy'], keep='last')
+    df['user'] = addresses.unpack(b''.join(df['user']))
+    df['ltv_ratio'] = df['ltv'] / (df['max_ltv'] / 100)
+
+    return df.sort_values(['block', 'strategy'], kind='stable').reset_index(drop=True)
+
+
+def top_risky_users(n=10, strategy=None, start_block=None, end_block=None):
+    """
+    Finds the users that came closest to liquidation and returns their history.
+
+    Parameters:
+    n (int): The number of users.
+    strategy (str): Only the positions in this strategy, every strategy when None.
+    start_block (int): The first block considered.
+    end_block (int): The last block considered.
+
+    Returns:
+    DataFrame: The rows of the n users with the highest ltv_ratio over the blocks, riskiest user first.
+    """
+    df = load_user_ltv(start_block, end_block, None if strategy is None else [strategy])
+    peak = df.groupby(['user', 'strategy'])['ltv_ratio'].max().nlargest(n)
+
+    rows = df.set_index(['user', 'strategy']).loc[peak.index].reset_index()
+    return rows[['block', 'user', 'strategy', 'borrow', 'collateral', 'ltv', 'ltv_ratio']]
+
+
+def debt_near_liquidation(within=0.1, start_block=None, end_block=None):
+    """
+    Sums the debt of the positions close to liquidation at every block.
+
+    Parameters:
+    within (float): The distance to liquidation, as a fraction of the liquidation LTV. 0.1 selects the positions at
+    90% of their liquidation LTV or more.
+    start_block (int): The first block.
+    end_block (int): The last block.
+
+    Returns:
+    DataFrame: One row per block and one column per strategy with the debt of the selected positions.
+    """
+    df = load_user_ltv(start_block, end_block)
+    near = df[df['ltv_ratio'] >= 1 - within]
+    totals = near.pivot_table(index='block', columns='strategy', values='borrow', aggfunc='sum')
+
+    # The blocks without any position that close still show up, with no debt
+    return totals.reindex(index=sorted(df['block'].unique()), columns=sorted(df['strategy'].unique()),
+                          fill_value=0).fillna(0)
+
+
+def risk_distribution(strategy, bins=const.USER_LTV_RISK_BINS, start_block=None, end_block=None):
+    """
+    Splits the debt of a strategy by distance to liquidation at every block.
+
+    Parameters:
+    strategy (str): The strategy name.
+    bins (list): The ltv_ratio bucket edges, the last bucket is open ended.
+    start_block (int): The first block.
+    end_block (int): The last block.
+
+    Returns:
+    DataFrame: One row per block and one column per ltv_ratio bucket with the debt in the bucket. The positions
+    with a debt and no collateral, whose ratio is not finite, have a bucket of their own, the last one.
+    """
+    df = load_user_ltv(start_block, end_block, [strategy])
+    edges = list(bins) + [np.inf]
+    labels = [f'{lower:.0%}-{upper:.0%}' for lower, upper in zip(edges[:-2], edges[1:-1])] + [f'{edges[-2]:.0%}+']
+    df['bucket'] = pd.cut(df['ltv_ratio'], edges, labels=labels, right=False)
+
+    # pd.cut leaves the infinite and NaN ratios out, they are the positions closest to liquidation
+    df['bucket'] = df['bucket'].cat.add_categories(NO_COLLATERAL_BUCKET)
+    df.loc[~np.isfinite(df['ltv_ratio']), 'bucket'] = NO_COLLATERAL_BUCKET
+
+    return df.pivot_table(index='block', columns='bucket', values='borrow', aggfunc='sum', observed=False).fillna(0)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_risk_distribution_snapshot(snapshot_block):
+    # Cached on the snapshot block, the history only changes with a new ingestion run
+    return {name: risk_distribution(name, end_block=snapshot_block) for name in const.STRATEGY_NAME}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Snapshots the user positions of the ingested blocks.')
+    parser.add_argument('--limit', type=int, default=const.USER_LTV_BLOCKS_PER_RUN,
+                        help='Maximum number of blocks snapshotted')
+    parser.add_argument('--compact', action='store_true', help='Merge the partitions of the history')
+    args = parser.parse_args()
+
+    if args.compact:
+        compact()
+    else:
+        print(f'Snapshotted the user positions of {len(update_user_ltv_history(limit=args.limit))} blocks')
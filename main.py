@@ -1,35 +1,42 @@
+import os
 import streamlit as st
 # import plotly.graph_objs as go
 # import pandas as pd
 import utils
 import charts
 import const
+import worker
+import ltvhistory
+import telemetry
 
-# LOAD past saved files
-saved_strategy_data, saved_pps_data, address_log = utils.load_data()
+# Set the layout width to a wider size
+st.set_page_config(layout="wide")
 
-# Get the latest Block Number to check if enough time has passed to accumulate data for new Blocks
-latest_block_with_data = saved_strategy_data['block'].max()
+# The stores are kept up to date by the ingestion worker, the page only reads the last committed snapshot
+if const.INGESTION_IN_PROCESS:
+    worker.start_background_worker()
 
-historic_block_list = utils.accumulate_block_with_no_data(latest_block_with_data)
+ingestion_status = worker.read_status()
 
-latest_address_block = address_log['block'].max()
+if ingestion_status is None or not os.path.exists(const.USER_TABLE_FILE) or not os.path.exists(const.MASTER_DATA_FILE):
+    st.info('The first data ingestion is still running, please come back in a few minutes.')
+    st.stop()
 
-if int(latest_address_block) + 3600 < int(max(historic_block_list)):
-    dune_usage = 1
-    address_log = utils.update_and_save_address_list(loaded_address_log=address_log,
-                                                     triggered_block=int(max(historic_block_list)),
-                                                     file_path='address_log.csv')
-else:
-    dune_usage = 0
+# Every section of the page is timed, for the diagnostics panel at the bottom
+page_timers = {section: telemetry.timer(f'page.{section}')
+               for section in ('load', 'silo_charts', 'position_risk', 'risk_history')}
 
-if utils.w3.eth.block_number - const.BLOCK_INTERVAL > latest_block_with_data:
-    saved_strategy_data, saved_pps_data = utils.get_data_for_blocks(historic_block_list, saved_strategy_data,
-                                                                    saved_pps_data)
+# Everything below is cached on the latest ingested block and recomputed only once per new snapshot
+snapshot_block = ingestion_status['current_block']
 
-master_data = utils.compute_master_data(utils.process_dataframe(saved_pps_data), saved_strategy_data)
+latest_block_with_data = ingestion_status['latest_block_with_data']
 
-user_table = utils.compute_user_ltv(saved_strategy_data, address_log)
+latest_address_block = ingestion_status['latest_address_block']
+
+# LOAD past saved files
+with page_timers['load']:
+    user_table = utils.load_user_table_snapshot(snapshot_block)
+    master_data = utils.load_master_data_snapshot(snapshot_block)
 
 #### Testing
 # user_table = pd.read_csv('user_tableV1.csv')
@@ -39,39 +46,57 @@ user_table = utils.compute_user_ltv(saved_strategy_data, address_log)
 # user_table.to_csv('user_tableV1.csv', index=False)
 #####
 
-# Set the layout width to a wider size
-st.set_page_config(layout="wide")
-
 # Add title to your Streamlit app
 st.title('Sturdy crvUSD Aggregator Silo Data')
 
-for i in range(len(const.STRATEGY_NAME)):
-    charts.instantaneous_data(master_data, const.STRATEGY_NAME[i])
-    charts.usage_metrics(master_data, const.STRATEGY_NAME[i])
-    charts.misc_charts(master_data, const.STRATEGY_NAME[i])
+# Lookback of the collateral APR shown in the counters and the rate charts
+apr_window = st.radio('Collateral APR lookback', const.APR_WINDOWS, index=const.APR_WINDOWS.index(30),
+                      format_func=lambda window: f'{window} days', horizontal=True)
 
-# Create two columns layout
-left_column, right_column = st.columns(2)
+# History shown by the time series charts, each series is decimated to the same number of points whatever the range
+time_range = st.radio('Time range', const.CHART_TIME_RANGES, index=len(const.CHART_TIME_RANGES) - 1,
+                      format_func=lambda days: 'All' if days is None else f'{days} days', horizontal=True)
 
-charts.position_risk_chart(user_table, const.STRATEGY_NAME[0], left_column)
-charts.position_risk_chart(user_table, const.STRATEGY_NAME[1], right_column)
+with page_timers['silo_charts']:
+    for i in range(len(const.STRATEGY_NAME)):
+        charts.instantaneous_data(master_data, const.STRATEGY_NAME[i], apr_window)
+        charts.usage_metrics(master_data, const.STRATEGY_NAME[i], snapshot_block, time_range)
+        charts.misc_charts(master_data, const.STRATEGY_NAME[i], snapshot_block, apr_window, time_range)
 
-charts.position_risk_chart(user_table, const.STRATEGY_NAME[2], left_column)
-charts.position_risk_chart(user_table, const.STRATEGY_NAME[3], right_column)
+with page_timers['position_risk']:
+    # Create two columns layout
+    left_column, right_column = st.columns(2)
 
+    # The strategies alternate between the two columns, however many the registry holds
+    for i in range(len(const.STRATEGY_NAME)):
+        charts.position_risk_chart(user_table, const.STRATEGY_NAME[i], left_column if i % 2 == 0 else right_column,
+                                   snapshot_block)
 
+    for i in range(len(const.STRATEGY_NAME)):
+        charts.user_position_table(user_table, const.STRATEGY_NAME[i], left_column if i % 2 == 0 else right_column)
 
-charts.user_position_table(user_table, const.STRATEGY_NAME[0], left_column)
-charts.user_position_table(user_table, const.STRATEGY_NAME[1], right_column)
+if const.USER_LTV_HISTORY:
+    with page_timers['risk_history']:
+        risk_distribution = ltvhistory.load_risk_distribution_snapshot(snapshot_block)
 
-charts.user_position_table(user_table, const.STRATEGY_NAME[2], left_column)
-charts.user_position_table(user_table, const.STRATEGY_NAME[3], right_column)
+        left_column, right_column = st.columns(2)
+        for i in range(len(const.STRATEGY_NAME)):
+            charts.risk_history_chart(risk_distribution[const.STRATEGY_NAME[i]], const.STRATEGY_NAME[i],
+                                      left_column if i % 2 == 0 else right_column, snapshot_block)
 
 st.markdown('<p class="center">A Dashboard by <a href="https://twitter.com/LlamaRisk">LlamaRisk</a>! Builder: <a href="https://twitter.com/diligentdeer">DiligentDeer</a>. Credits: <a href="https://twitter.com/0xValJohn">Val</a> & <a href="https://twitter.com/iamllanero">Llanero</a></p>', unsafe_allow_html=True)
 
 st.markdown(f"""
 Latest Block with Data: {latest_block_with_data}
-Current Block: {max(historic_block_list)}
+Current Block: {ingestion_status['current_block']}
 User Address from Block: {latest_address_block}
-Dune Usage: {dune_usage}
+Dune Usage: {ingestion_status['dune_usage']}
+Last Ingestion: {ingestion_status['updated_at']} UTC
 """)
+
+if ingestion_status.get('error'):
+    st.warning(f"The last ingestion run failed, showing the previous snapshot. {ingestion_status['error']}")
+
+if const.DIAGNOSTICS_PANEL or st.query_params.get('diagnostics') == '1':
+    charts.diagnostics_panel(ingestion_status, {section: page_timer.seconds for section, page_timer in
+                                                page_timers.items() if page_timer.seconds is not None})
@@ -0,0 +1,53 @@
+import const
+import clients
+import contracts
+
+
+def encode_call(target, abi_name, args=()):
+    """
+    Builds a single Multicall3 call entry from the precomputed function of the registry.
+
+    Parameters:
+    target (str): The address of the contract to call.
+    abi_name (str): The key of the function in contracts.ABIS.
+    args (list): The arguments of the function call.
+
+    Returns:
+    tuple: The (target, callData, AbiFunction) entry expected by aggregate3.
+    """
+    fn = contracts.get_function(abi_name)
+    return contracts.to_checksum_address(target), fn.encode(args), fn
+
+
+def aggregate3(calls, block, multicall_address=const.MULTICALL3_ADDRESS):
+    """
+    Executes a list of calls in a single Multicall3 aggregate3 eth_call.
+
+    Parameters:
+    calls (list): Entries built with encode_call.
+    block (int): The block at which every call is executed.
+    multicall_address (str): The Multicall3 address.
+
+    Returns:
+    list: One (success, decoded result) tuple per call. The result is None when the call failed.
+    """
+    aggregate = contracts.get_function('aggregate3')
+
+    # allowFailure is set on every call so a single revert does not sink the whole batch. The calldata is built
+    # directly, the request is the same one the aggregate3 contract function would send
+    call_data = aggregate.encode([[(target, True, bytes.fromhex(data[2:])) for target, data, _ in calls]])
+    return_data = clients.get_web3().eth.call(
+        {'to': contracts.to_checksum_address(multicall_address), 'data': call_data}, block_identifier=int(block))
+    results = aggregate.decode(return_data)
+
+    decoded_results = []
+    for (_, _, fn), (success, result_data) in zip(calls, results):
+        if not success or len(result_data) == 0:
+            decoded_results.append((False, None))
+            continue
+        try:
+            decoded_results.append((True, fn.decode(result_data)))
+        except Exception:
+            decoded_results.append((False, None))
+
+    return decoded_results
@@ -0,0 +1,165 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from web3.providers.base import JSONBaseProvider
+import concurrency
+import const
+import telemetry
+
+# Weight of the last request in the smoothed error rate and latency of an endpoint
+SMOOTHING = 0.2
+
+
+class Endpoint:
+    """
+    One RPC endpoint of the pool, with its keep-alive session, its rate limit bucket and its health.
+    """
+
+    def __init__(self, uri, name):
+        self.uri = uri
+        # The name is what gets logged, the URI holds the key
+        self.name = name
+        self.bucket = concurrency.get_bucket(uri)
+
+        # A single session per endpoint, its connections are kept alive and shared by every thread
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=const.RPC_POOL_CONNECTIONS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.error_rate = 0.0
+        self.latency = None
+        self.ejected_until = 0.0
+        self.cooldown = const.RPC_POOL_COOLDOWN
+
+    def post(self, request_data):
+        response = self.session.post(self.uri, data=request_data, timeout=const.RPC_TIMEOUT)
+        response.raise_for_status()
+        telemetry.count('rpc_bytes_read', len(response.content))
+        return response.content
+
+
+class ProviderPool(JSONBaseProvider):
+    """
+    Web3 provider spreading the requests over several RPC endpoints.
+
+    A request goes to the least loaded healthy endpoint, or the next one in turn with the round_robin strategy, and
+    fails over to the other endpoints before an error is returned to the retry middleware. An endpoint that is rate
+    limited, or whose smoothed error rate gets too high, is ejected for a cooldown that doubles while it keeps failing.
+    """
+
+    def __init__(self, endpoints, strategy=const.RPC_POOL_STRATEGY):
+        super().__init__()
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.turn = 0
+
+    def _select(self, tried):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+            if not candidates:
+                return None
+
+            available = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+            # Rotated on every request, so the ties of least_load are also broken in turn
+            self.turn += 1
+            if available:
+                offset = self.turn % len(available)
+                available = available[offset:] + available[:offset]
+
+            if not available:
+                # With every endpoint ejected, the one back first is tried rather than failing outright
+                endpoint = min(candidates, key=lambda candidate: candidate.ejected_until)
+            elif self.strategy == 'round_robin':
+                endpoint = available[0]
+            else:
+                endpoint = min(available, key=lambda candidate: (candidate.in_flight, candidate.latency or 0))
+
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _record(self, endpoint, started_at, failed, eject=False):
+        with self.lock:
+            now = time.monotonic()
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            endpoint.failures += failed
+
+            elapsed = now - started_at
+            endpoint.latency = elapsed if endpoint.latency is None else \
+                (1 - SMOOTHING) * endpoint.latency + SMOOTHING * elapsed
+            endpoint.error_rate = (1 - SMOOTHING) * endpoint.error_rate + SMOOTHING * failed
+
+            unhealthy = endpoint.requests >= const.RPC_POOL_MIN_REQUESTS and \
+                endpoint.error_rate > const.RPC_POOL_MAX_ERROR_RATE
+            if failed and (eject or unhealthy):
+                # Requests already in flight when it was ejected do not extend the cooldown
+                if endpoint.ejected_until <= now:
+                    endpoint.ejected_until = now + endpoint.cooldown
+                    telemetry.count('rpc_endpoint_ejections')
+                    telemetry.log('rpc_endpoint_ejected', endpoint=endpoint.name, cooldown=endpoint.cooldown,
+                                  error_rate=round(endpoint.error_rate, 3))
+                    endpoint.cooldown = min(endpoint.cooldown * 2, const.RPC_POOL_MAX_COOLDOWN)
+            elif not failed and not unhealthy:
+                endpoint.cooldown = const.RPC_POOL_COOLDOWN
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+
+        tried = []
+        outcome = None
+        while True:
+            endpoint = self._select(tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+
+            endpoint.bucket.acquire()
+            started_at = time.monotonic()
+            telemetry.count('rpc_requests')
+            try:
+                response = self.decode_rpc_response(endpoint.post(request_data))
+            except Exception as e:
+                telemetry.count('rpc_failures')
+                self._record(endpoint, started_at, failed=True)
+                outcome = e
+                continue
+
+            # A rate limit means the quota of the key is used up, the endpoint is left out for a while
+            rate_limited = concurrency.is_rate_limited_response(response)
+            telemetry.count('rpc_rate_limited', rate_limited)
+            self._record(endpoint, started_at, failed=rate_limited, eject=rate_limited)
+            if not rate_limited:
+                return response
+            outcome = response
+
+        # Every endpoint failed, the retry middleware backs off before the next round
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def is_connected(self, show_traceback=False):
+        return any(endpoint.ejected_until <= time.monotonic() for endpoint in self.endpoints)
+
+    def stats(self):
+        """
+        Returns the health of every endpoint of the pool.
+
+        Returns:
+        list: One dict per endpoint with its name, request and failure counts, smoothed error rate and latency,
+        requests in flight and whether it is ejected.
+        """
+        with self.lock:
+            now = time.monotonic()
+            return [{'name': endpoint.name, 'requests': endpoint.requests, 'failures': endpoint.failures,
+                     'error_rate': round(endpoint.error_rate, 3),
+                     'latency': round(endpoint.latency, 3) if endpoint.latency is not None else None,
+                     'in_flight': endpoint.in_flight, 'ejected': endpoint.ejected_until > now}
+                    for endpoint in self.endpoints]
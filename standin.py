@@ -0,0 +1,438 @@
+import argparse
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from eth_abi import decode, encode
+import contracts
+import const
+import strategies
+
+# Local stand-in for the RPC endpoints and the Dune API, for offline end-to-end runs and benchmarks. Point the
+# pipeline at it with
+#   RPC_URLS=http://127.0.0.1:8545/rpc/a,http://127.0.0.1:8545/rpc/b
+#   DUNE_KEYS=x DUNE_API_URL=http://127.0.0.1:8545/api/v1/
+# Every path under /rpc/ is a separate endpoint with its own rate limit, like one Infura key each. The chain is
+# synthetic and deterministic: the same call at the same block always returns the same value
+
+# Timestamp of BLOCK_START, the synthetic blocks are BLOCK_TIME apart from it
+BLOCK_START_TIMESTAMP = 1705305600
+
+# Blocks between two position events of a synthetic user
+USER_EVENT_INTERVAL = 50000
+
+# Distinct requests whose occurrence count is kept by the fault draws, the least recently seen are forgotten
+FAULT_MEMORY = 100000
+
+
+def _hash(*key):
+    return int.from_bytes(hashlib.blake2b(repr(key).encode(), digest_size=8).digest(), 'big')
+
+
+def _address(*key):
+    return '0x' + hashlib.blake2b(repr(key).encode(), digest_size=20).hexdigest()
+
+
+class Faults:
+    """
+    Latency and error injection. Every decision is drawn from a hash of the seed, the request and how many times the
+    same request was seen before, so a run is reproducible whatever the thread interleaving, and a retried request
+    gets a new draw. The rate limit is drawn the same way from the number of requests the endpoint served, so a
+    run sees the same refusals whatever its speed.
+
+    latency: Seconds added to every response.
+    jitter: Seconds of extra latency, drawn uniformly up to this value.
+    call_latency: Seconds added per contract call, the calls of an aggregate3 batch included.
+    error_rate: Fraction of the requests answered with an HTTP 503.
+    revert_rate: Fraction of the contract calls that revert.
+    rate_limit_rate: Fraction of the requests of an endpoint refused as rate limited.
+    seed: The seed of the draws.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, call_latency=0.0, error_rate=0.0, revert_rate=0.0,
+                 rate_limit_rate=0.0, seed=0, memory=FAULT_MEMORY):
+        self.latency = latency
+        self.jitter = jitter
+        self.call_latency = call_latency
+        self.error_rate = error_rate
+        self.revert_rate = revert_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.seed = seed
+        self.memory = memory
+        self.lock = threading.Lock()
+        # Occurrence count per request hash, bounded so that a long benchmark does not keep every request it saw
+        self.occurrences = OrderedDict()
+
+    def draw(self, *key):
+        digest = _hash(*key)
+        with self.lock:
+            occurrence = self.occurrences.pop(digest, 0)
+            self.occurrences[digest] = occurrence + 1
+            if len(self.occurrences) > self.memory:
+                self.occurrences.popitem(last=False)
+        return _hash(self.seed, occurrence, digest) / 2 ** 64
+
+    def delay(self, key, calls=1):
+        return self.latency + self.jitter * self.draw('jitter', *key) + self.call_latency * calls
+
+    def is_error(self, key):
+        return self.error_rate > 0 and self.draw('error', *key) < self.error_rate
+
+    def is_revert(self, key):
+        return self.revert_rate > 0 and self.draw('revert', *key) < self.revert_rate
+
+    def is_rate_limited(self, endpoint):
+        return self.rate_limit_rate > 0 and self.draw('rate_limit', endpoint) < self.rate_limit_rate
+
+
+class Chain:
+    """
+    Synthetic chain answering the calls of the pipeline for every strategy of the registry.
+
+    tip: The latest block, None to follow the wall clock from BLOCK_START like mainnet does.
+    users: The number of synthetic users, also the rows of the Dune query.
+    """
+
+    def __init__(self, tip=None, users=const.STANDIN_USERS, faults=None):
+        self.fixed_tip = tip
+        self.users = [_address('user', i) for i in range(users)]
+        self.faults = faults or Faults()
+
+        # Every contract of a strategy resolves to its index, the values are derived from it and the block
+        self.index = {}
+        self.pairs = []
+        for i, strategy in enumerate(strategies.STRATEGIES):
+            pair = _address('pair', strategy.address.lower())
+            self.pairs.append(pair)
+            for address in (strategy.address, strategy.collateral, strategy.oracle, strategy.curve_pool, pair):
+                self.index[address.lower()] = i
+
+        self.handlers = {contracts.get_function(name).selector: (contracts.get_function(name), handler)
+                         for name, handler in [('getStrategy', self.get_strategy), ('getPrices', self.get_prices),
+                                               ('previewAddInterest', self.preview_add_interest),
+                                               ('currentRateInfo', self.current_rate_info),
+                                               ('get_virtual_price', self.get_virtual_price),
+                                               ('pricePerShare', self.price_per_share),
+                                               ('getUserPositions', self.get_user_positions)]}
+
+    def tip(self):
+        if self.fixed_tip is not None:
+            return self.fixed_tip
+        return const.BLOCK_START + int(time.time() - BLOCK_START_TIMESTAMP) // const.BLOCK_TIME
+
+    def timestamp(self, block):
+        return BLOCK_START_TIMESTAMP + (block - const.BLOCK_START) * const.BLOCK_TIME
+
+    def strategy_index(self, address):
+        if address.lower() not in self.index:
+            raise ValueError(f'unknown contract {address}')
+        return self.index[address.lower()]
+
+    # The contract calls, values are smooth functions of the block with a distinct offset per strategy
+
+    def get_strategy(self, to, args, block):
+        i = self.strategy_index(args[0])
+        strategy = strategies.STRATEGIES[i]
+        utilization = 5000 + (block // 1000 + 700 * i) % 4000  # Out of 10000
+        total_asset = (2_000_000 + 250_000 * i) * 10 ** 18 + block * 10 ** 12
+        pair_data = (_address('crvUSD'), 'crvUSD', 18, strategy.collateral, f'yv{strategy.name}', 18,
+                     _address('rate', i), strategy.oracle, 10 ** 24, 158247000 + i * 1000, 3168000000 + i * 1000,
+                     10000, 500, self.price_low(i, block), self.price_low(i, block) + 10 ** 15, 90000 - 5000 * i,
+                     10000, total_asset, total_asset * 13 // 10, total_asset * utilization // 10000, 3)
+        return [(strategy.address, self.pairs[i], pair_data)]
+
+    def price_low(self, i, block):
+        return 10 ** 18 + (block - const.BLOCK_START) * 10 ** 8 + i * 10 ** 15
+
+    def get_prices(self, to, args, block):
+        i = self.strategy_index(to)
+        return [False, self.price_low(i, block), self.price_low(i, block) + 10 ** 15]
+
+    def preview_add_interest(self, to, args, block):
+        i = self.strategy_index(to)
+        rate_per_sec = 158247000 + (block // 1200 + 300 * i) % 1000 * 100000
+        rate_info = (block % 2 ** 32, 10000, self.timestamp(block), rate_per_sec, 3168000000)
+        return [10 ** 18, 10 ** 17, 10 ** 17, rate_info, (10 ** 24, 10 ** 24), (10 ** 23, 10 ** 23)]
+
+    def current_rate_info(self, to, args, block):
+        self.strategy_index(to)
+        return [block % 2 ** 32, 10000, self.timestamp(block), 158247000, 3168000000]
+
+    def get_virtual_price(self, to, args, block):
+        i = self.strategy_index(to)
+        return [10 ** 18 + (block - const.BLOCK_START_PPS) * 10 ** 7 + i * 10 ** 14]
+
+    def price_per_share(self, to, args, block):
+        i = self.strategy_index(to)
+        # About 10% a year, so the APR windows see a steady yield
+        return [10 ** 18 + (block - const.BLOCK_START_PPS) * (38 + 4 * i) * 10 ** 7]
+
+    def get_user_positions(self, to, args, block):
+        user = _hash('user', args[0].lower())
+        positions = []
+        for i, strategy in enumerate(strategies.STRATEGIES):
+            collateral = (user >> (8 * i)) % 10000 * 10 ** 18
+            # About a third of the users borrow in a strategy, at an LTV drifting with the block
+            borrows = (user >> (8 * i + 4)) % 3 == 0
+            ltv = 40 + (user >> (8 * i)) % 40 + (block // 7200) % 10
+            borrow = collateral * ltv // 100 if borrows else 0
+            positions.append((strategy.address, collateral, borrow, collateral))
+        return [([(strategy.collateral, 0) for strategy in strategies.STRATEGIES], positions)]
+
+    def call(self, to, data, block):
+        fn, handler = self.handlers[bytes(data[:4])]
+        args = decode(fn.input_types, bytes(data[4:])) if fn.input_types else ()
+        if self.faults.is_revert((to.lower(), _hash(bytes(data)), block)):
+            raise ValueError('execution reverted')
+        return encode(fn.output_types, handler(to, args, block))
+
+    def aggregate3(self, data, block):
+        fn = contracts.get_function('aggregate3')
+        (calls,) = decode(fn.input_types, bytes(data[4:]))
+        results = []
+        for target, allow_failure, call_data in calls:
+            try:
+                results.append((True, self.call(target, call_data, block)))
+            except Exception:
+                if not allow_failure:
+                    raise
+                results.append((False, b''))
+        return encode(fn.output_types, [results]), len(calls)
+
+    def block_number(self, tag):
+        if tag in ('latest', 'safe', 'finalized', 'pending', None):
+            return self.tip()
+        if tag == 'earliest':
+            return 0
+        return int(tag, 16)
+
+    def get_logs(self, log_filter):
+        # Every synthetic user touches a pair once every USER_EVENT_INTERVAL blocks
+        from_block = self.block_number(log_filter.get('fromBlock'))
+        to_block = self.block_number(log_filter.get('toBlock'))
+        topic = log_filter['topics'][0][0] if log_filter.get('topics') else '0x' + '00' * 32
+        logs = []
+        for user in self.users:
+            offset = _hash('event', user) % USER_EVENT_INTERVAL
+            for block in range(from_block + (offset - from_block) % USER_EVENT_INTERVAL, to_block + 1,
+                               USER_EVENT_INTERVAL):
+                logs.append({'address': self.pairs[_hash('pair', user) % len(self.pairs)], 'topics': [
+                    topic, '0x' + '00' * 12 + user[2:]], 'data': '0x', 'blockNumber': hex(block),
+                    'blockHash': '0x' + _address('block', block)[2:].ljust(64, '0'),
+                    'transactionHash': '0x' + _address('tx', user, block)[2:].ljust(64, '0'),
+                    'transactionIndex': '0x0', 'logIndex': '0x0', 'removed': False})
+        return sorted(logs, key=lambda log: int(log['blockNumber'], 16))
+
+    def rpc(self, method, params):
+        """
+        Answers a JSON-RPC method.
+
+        Parameters:
+        method (str): The method.
+        params (list): Its parameters.
+
+        Returns:
+        tuple: The result and the number of contract calls it took, for the call latency.
+        """
+        if method == 'eth_chainId':
+            return '0x1', 0
+        if method == 'net_version':
+            return '1', 0
+        if method == 'eth_blockNumber':
+            return hex(self.tip()), 0
+        if method == 'eth_getBlockByNumber':
+            block = self.block_number(params[0])
+            if block > self.tip():
+                return None, 0
+            return {'number': hex(block), 'hash': '0x' + _address('block', block)[2:].ljust(64, '0'),
+                    'parentHash': '0x' + _address('block', block - 1)[2:].ljust(64, '0'),
+                    'timestamp': hex(self.timestamp(block)), 'transactions': []}, 0
+        if method == 'eth_getLogs':
+            return self.get_logs(params[0]), 0
+        if method == 'eth_call':
+            transaction, block = params[0], self.block_number(params[1] if len(params) > 1 else 'latest')
+            data = bytes.fromhex(transaction['data'][2:])
+            if data[:4] == contracts.get_function('aggregate3').selector:
+                return_data, calls = self.aggregate3(data, block)
+            else:
+                return_data, calls = self.call(transaction['to'], data, block), 1
+            return '0x' + return_data.hex(), calls
+        raise NotImplementedError(method)
+
+
+class Dune:
+    """
+    Stand-in for the Dune API endpoints used by dune.DuneClient, returning the synthetic users.
+
+    result_age: Seconds since the latest result was computed, None when the query has no latest result.
+    polls: Status polls before an execution completes.
+    """
+
+    def __init__(self, users, result_age=None, polls=2):
+        self.rows = [{'address': user} for user in users]
+        self.result_age = result_age
+        self.polls = polls
+        self.lock = threading.Lock()
+        self.executions = Counter()
+
+    def page(self, params, extra=None):
+        limit = int(params.get('limit', len(self.rows) or 1))
+        offset = int(params.get('offset', 0))
+        body = dict(extra or {}, result={'rows': self.rows[offset:offset + limit]})
+        if offset + limit < len(self.rows):
+            body['next_offset'] = offset + limit
+        return 200, body
+
+    def request(self, method, path, params):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'query' and parts[-1] == 'results':
+            if self.result_age is None:
+                return 404, {'error': 'No execution found'}
+            ended_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.result_age)
+            return self.page(params, {'execution_ended_at': ended_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')})
+        if parts[0] == 'query' and parts[-1] == 'execute':
+            with self.lock:
+                execution_id = f'standin-{len(self.executions)}'
+                self.executions[execution_id] = 0
+            return 200, {'execution_id': execution_id, 'state': 'QUERY_STATE_PENDING'}
+        if parts[0] == 'execution' and parts[1] in self.executions:
+            if parts[-1] == 'status':
+                with self.lock:
+                    self.executions[parts[1]] += 1
+                    done = self.executions[parts[1]] >= self.polls
+                return 200, {'execution_id': parts[1],
+                             'state': 'QUERY_STATE_COMPLETED' if done else 'QUERY_STATE_EXECUTING'}
+            if parts[-1] == 'results':
+                return self.page(params)
+            if parts[-1] == 'cancel':
+                return 200, {'success': True}
+        return 404, {'error': f'Unknown path {path}'}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle every keep-alive response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # One line per request would flood the benchmark output
+        pass
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method):
+        server = self.server
+        path, _, query = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        # The body is hashed, the draws never keep a large aggregate3 or getLogs request
+        key = (method, path, query, _hash(body))
+
+        # The endpoint is the first two path segments, /rpc/<name> or /api/v1
+        endpoint = '/'.join(path.split('/')[:3])
+        if server.faults.is_rate_limited(endpoint):
+            time.sleep(server.faults.delay(key))
+            if path.startswith('/rpc/'):
+                # The way Infura reports it, an HTTP 200 with the -32005 error
+                payload = json.loads(body)
+                request_id = payload.get('id') if isinstance(payload, dict) else None
+                return self.reply(200, {'jsonrpc': '2.0', 'id': request_id,
+                                        'error': {'code': -32005, 'message': 'rate limit exceeded'}})
+            return self.reply(429, {'error': 'Too many requests'})
+        if server.faults.is_error(key):
+            time.sleep(server.faults.delay(key))
+            return self.reply(503, {'error': 'Service unavailable'})
+
+        if path.startswith('/rpc/'):
+            payload = json.loads(body)
+            responses, calls = [], 0
+            for request in payload if isinstance(payload, list) else [payload]:
+                response = {'jsonrpc': '2.0', 'id': request.get('id')}
+                try:
+                    response['result'], request_calls = server.chain.rpc(request['method'], request.get('params', []))
+                    calls += request_calls
+                except NotImplementedError as e:
+                    response['error'] = {'code': -32601, 'message': f'method {e} not found'}
+                except Exception as e:
+                    response['error'] = {'code': 3 if 'reverted' in str(e) else -32000, 'message': str(e)}
+                responses.append(response)
+            time.sleep(server.faults.delay(key, calls))
+            return self.reply(200, responses if isinstance(payload, list) else responses[0])
+
+        if path.startswith('/api/v1/'):
+            params = dict(parameter.split('=', 1) for parameter in query.split('&') if '=' in parameter)
+            time.sleep(server.faults.delay(key))
+            return self.reply(*server.dune.request(method, path[len('/api/v1/'):], params))
+
+        return self.reply(404, {'error': f'Unknown path {path}'})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+def start(host=const.STANDIN_HOST, port=const.STANDIN_PORT, faults=None, tip=None, users=const.STANDIN_USERS,
+          dune_result_age=None, dune_polls=2):
+    """
+    Starts the stand-in server on a background thread.
+
+    Parameters:
+    host (str): The interface to listen on.
+    port (int): The port, 0 picks a free one.
+    faults (Faults): The latency and error injection, none by default.
+    tip (int): The latest block, None to follow the wall clock.
+    users (int): The number of synthetic users.
+    dune_result_age (int): Seconds since the latest Dune result was computed, None for no latest result.
+    dune_polls (int): Status polls before a Dune execution completes.
+
+    Returns:
+    ThreadingHTTPServer: The running server, server_address holds the port and shutdown() stops it.
+    """
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.faults = faults or Faults()
+    server.chain = Chain(tip, users, server.faults)
+    server.dune = Dune(server.chain.users, dune_result_age, dune_polls)
+    threading.Thread(target=server.serve_forever, name='standin', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves a synthetic chain and Dune API for offline runs.')
+    parser.add_argument('--host', default=const.STANDIN_HOST)
+    parser.add_argument('--port', type=int, default=const.STANDIN_PORT)
+    parser.add_argument('--tip', type=int, help='Latest block, follows the wall clock by default')
+    parser.add_argument('--users', type=int, default=const.STANDIN_USERS, help='Synthetic users')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Seconds of random extra latency, at most')
+    parser.add_argument('--call-latency', type=float, default=0.0, help='Seconds added per contract call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with a 503')
+    parser.add_argument('--revert-rate', type=float, default=0.0, help='Fraction of contract calls reverting')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='Fraction of the requests of an endpoint refused as rate limited')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the latency and error draws')
+    parser.add_argument('--dune-result-age', type=int, help='Seconds since the latest Dune result, none by default')
+    parser.add_argument('--dune-polls', type=int, default=2, help='Status polls before a Dune execution completes')
+    args = parser.parse_args()
+
+    standin = start(args.host, args.port,
+                    Faults(args.latency, args.jitter, args.call_latency, args.error_rate, args.revert_rate,
+                           args.rate_limit_rate, args.seed),
+                    args.tip, args.users, args.dune_result_age, args.dune_polls)
+    host, port = standin.server_address[:2]
+    print(f'Serving RPC on http://{host}:{port}/rpc/<name> and Dune on http://{host}:{port}/api/v1/')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.shutdown()
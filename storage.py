@@ -0,0 +1,732 @@
+import argparse
+import ast
+import glob
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import addresses
+import blocktime
+import const
+
+# Raw on-chain integers, kept as exact int64 instead of the lossy floats the CSV round trip produced
+RAW_INTEGER_FIELDS = ['ratePerSec', 'fullUtilizationRate', 'newCurrentRateInfo', 'feeToProtocolRate', 'pps']
+STRING_FIELDS = ['collateral', 'collateralSymbol']
+
+
+def field_of(column, strategy_names=const.STRATEGY_NAME):
+    # Strip the strategy suffix of a wide column, e.g. 'totalAssetUSDC' -> 'totalAsset'
+    for name in strategy_names:
+        if column.endswith(name):
+            return column[:-len(name)]
+    return column
+
+
+def arrow_type(column):
+    if column == 'block':
+        return pa.int64()
+    if column == 'time':
+        return pa.timestamp('ns')
+
+    field = field_of(column)
+    if field in RAW_INTEGER_FIELDS:
+        return pa.int64()
+    if field in STRING_FIELDS:
+        return pa.string()
+    return pa.float64()
+
+
+def typed_frame(df):
+    """
+    Casts a strategy or pps frame to the typed columns of the stores.
+
+    Parameters:
+    df (DataFrame): A wide strategy or pps frame, as built by merge_strategy_data and merge_pps_data.
+
+    Returns:
+    DataFrame: A copy without the stray 'Unnamed: n' index columns and with typed columns.
+    """
+    df = df.loc[:, [column for column in df.columns if not str(column).startswith('Unnamed:')]].copy()
+
+    for column in df.columns:
+        typ = arrow_type(column)
+        if typ == pa.int64():
+            # Nullable so that a missing value does not turn the whole column back into floats
+            df[column] = pd.to_numeric(df[column]).round().astype('Int64')
+        elif typ == pa.timestamp('ns'):
+            df[column] = pd.to_datetime(df[column])
+        elif typ == pa.float64():
+            df[column] = pd.to_numeric(df[column])
+
+    return df
+
+
+# The fields of a strategy, the wide columns are '<field><strategy name>'
+STRATEGY_FIELDS = ['collateral', 'collateralSymbol', 'ratePerSec', 'fullUtilizationRate', 'lowExchangeRate',
+                   'highExchangeRate', 'maxLTV', 'totalAsset', 'totalCollateral', 'totalBorrow', 'newCurrentRateInfo',
+                   'feeToProtocolRate', 'virtualPrice']
+
+
+def requested_strategies(table, columns, strategy_names=const.STRATEGY_NAME):
+    """
+    Works out which strategies and fields a load of the long stores reads.
+
+    Parameters:
+    table (str): 'strategy' or 'pps'.
+    columns (list): The requested wide columns, every column when None.
+    strategy_names (list): The strategy names.
+
+    Returns:
+    tuple: The strategy names and the fields to read. Without any field asked for, every strategy is still read,
+    they all decide which blocks are complete.
+    """
+    fields = ['pps'] if table == 'pps' else STRATEGY_FIELDS
+    if columns is None:
+        return list(strategy_names), list(fields)
+
+    names = [name for name in strategy_names if any(f'{field}{name}' in columns for field in fields)]
+    fields = [field for field in fields if any(f'{field}{name}' in columns for name in names)]
+    return names or list(strategy_names), fields
+
+
+ADDRESS_SNAPSHOT_SCHEMA = pa.schema([('block', pa.int64()), ('base', pa.bool_()), ('added', pa.binary()),
+                                     ('removed', pa.binary())])
+
+
+def _with_block(columns):
+    # Every load returns the block column, whatever the requested columns are
+    return None if columns is None else ['block'] + [column for column in columns if column != 'block']
+
+
+def _select_block_range(df, start_block=None, end_block=None):
+    if start_block is not None:
+        df = df[df['block'] >= start_block]
+    if end_block is not None:
+        df = df[df['block'] <= end_block]
+    return df
+
+
+class StorageBackend:
+    """
+    Interface of the strategy and pps stores. Frames keep the wide layout of merge_strategy_data and merge_pps_data.
+    """
+
+    address_log_dir = const.ADDRESS_LOG_DIR
+    address_log_file = const.ADDRESS_LOG_FILE
+
+    def load_strategy(self, columns=None, start_block=None, end_block=None, start_time=None, end_time=None):
+        if start_time is not None or end_time is not None:
+            start_block, end_block = self.block_range_for_time(start_time, end_time, start_block, end_block)
+        return self.load('strategy', columns, start_block, end_block)
+
+    def load_pps(self, columns=None, start_block=None, end_block=None, start_time=None, end_time=None):
+        if start_time is not None or end_time is not None:
+            start_block, end_block = self.block_range_for_time(start_time, end_time, start_block, end_block)
+        return self.load('pps', columns, start_block, end_block)
+
+    def block_range_for_time(self, start_time=None, end_time=None, start_block=None, end_block=None):
+        # Only the strategy table has a time column, the pps table is selected on the same blocks
+        times = self.load('strategy', columns=['time'], start_block=start_block, end_block=end_block)
+        times = times[pd.to_datetime(times['time']).between(pd.Timestamp(start_time or pd.Timestamp.min),
+                                                           pd.Timestamp(end_time or pd.Timestamp.max))]
+        if times.empty:
+            return 0, -1
+        return int(times['block'].min()), int(times['block'].max())
+
+    def load_address_snapshots(self, end_block=None):
+        """
+        Loads the snapshots of the address log, see addresses.py.
+
+        Parameters:
+        end_block (int): The last block loaded, every snapshot when None.
+
+        Returns:
+        DataFrame: One row per snapshot sorted by block, with the block, base, added and removed columns. The added
+        and removed addresses are packed 20-byte arrays.
+        """
+        paths = [path for first_block, _, path in self.address_log_partitions()
+                 if end_block is None or first_block <= end_block]
+        if not paths:
+            return pd.DataFrame({'block': pd.Series(dtype='int64'), 'base': pd.Series(dtype=bool),
+                                 'added': pd.Series(dtype=object), 'removed': pd.Series(dtype=object)})
+        snapshots = pa.concat_tables([pq.read_table(path) for path in paths]).to_pandas()
+        if end_block is not None:
+            snapshots = snapshots[snapshots['block'] <= end_block]
+        # A compaction briefly leaves the merged partition next to the ones it merges
+        return snapshots.drop_duplicates(subset='block').sort_values('block').reset_index(drop=True)
+
+    def address_log_partitions(self):
+        # part-<first block>-<last block>.parquet, the layout of the ParquetBackend tables
+        self.migrate_address_log_file()
+        partitions = []
+        for path in sorted(glob.glob(os.path.join(self.address_log_dir, 'part-*.parquet'))):
+            first_block, last_block = os.path.basename(path)[len('part-'):-len('.parquet')].split('-')
+            partitions.append((int(first_block), int(last_block), path))
+        return partitions
+
+    def migrate_address_log_file(self):
+        # The single file of the earlier versions, rewritten on every append, becomes the first partition
+        if not os.path.exists(self.address_log_file):
+            return
+        try:
+            snapshots = pq.read_table(self.address_log_file).to_pandas()
+            if not snapshots.empty:
+                self.write_address_partition(snapshots)
+            os.remove(self.address_log_file)
+        except FileNotFoundError:
+            # Moved by the page or the worker in the meantime
+            pass
+
+    def write_address_partition(self, snapshots):
+        os.makedirs(self.address_log_dir, exist_ok=True)
+        path = os.path.join(self.address_log_dir,
+                            f"part-{int(snapshots['block'].min()):010d}-{int(snapshots['block'].max()):010d}.parquet")
+        tmp_path = f'{path}.tmp'
+        pq.write_table(pa.Table.from_pandas(snapshots, schema=ADDRESS_SNAPSHOT_SCHEMA, preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def append_address_snapshot(self, block, base, added, removed):
+        # One partition per snapshot, the snapshots already stored are never rewritten
+        self.write_address_partition(pd.DataFrame({'block': [int(block)], 'base': [base], 'added': [added],
+                                                   'removed': [removed]}))
+        if len(self.address_log_partitions()) > const.PARQUET_MAX_PARTITIONS:
+            self.compact_address_log()
+
+    def compact_address_log(self):
+        # The merged partition is in place before the old ones are removed
+        partitions = self.address_log_partitions()
+        if len(partitions) < 2:
+            return
+        merged_path = self.write_address_partition(self.load_address_snapshots())
+        for _, _, path in partitions:
+            if path != merged_path:
+                os.remove(path)
+
+    def has_address_log(self):
+        return bool(self.address_log_partitions())
+
+    def load_address_log(self, block=None):
+        """
+        Loads the user address set of the address log as of a block.
+
+        Parameters:
+        block (int): The block of interest, the latest snapshot when None.
+
+        Returns:
+        DataFrame: A single row with the block of the last snapshot at or before the block and its user_address_list,
+        no row when there is no such snapshot.
+        """
+        snapshots = self.load_address_snapshots(end_block=block)
+        if snapshots.empty:
+            return pd.DataFrame({'block': pd.Series(dtype='int64'), 'user_address_list': pd.Series(dtype=object)})
+        return pd.DataFrame({'block': [int(snapshots['block'].iloc[-1])],
+                             'user_address_list': [addresses.replay(snapshots)]})
+
+    def append_address_log(self, block, user_address_list):
+        snapshots = self.load_address_snapshots()
+        current = list(dict.fromkeys(address.lower() for address in user_address_list))
+        added, removed = addresses.diff(addresses.replay(snapshots), current)
+
+        if addresses.is_rebase_due(snapshots, len(added) + len(removed), len(current)):
+            self.append_address_snapshot(block, True, addresses.pack(current), b'')
+        else:
+            self.append_address_snapshot(block, False, addresses.pack(added), addresses.pack(removed))
+
+    def append_strategy(self, df):
+        self.append('strategy', df)
+
+    def append_pps(self, df):
+        self.append('pps', df)
+
+    def load(self, table, columns=None, start_block=None, end_block=None):
+        raise NotImplementedError
+
+    def append(self, table, df):
+        raise NotImplementedError
+
+    def latest_block(self, table='strategy'):
+        raise NotImplementedError
+
+    def stored_blocks(self, table):
+        # The blocks holding a complete row of the table
+        return set(self.load(table, columns=['block'])['block'].astype(int))
+
+
+class CsvBackend(StorageBackend):
+    """
+    The original CSV files. Every append re-reads and rewrites the whole file.
+    """
+
+    FILES = {'strategy': const.STRATEGY_CSV, 'pps': const.PPS_CSV}
+
+    def load(self, table, columns=None, start_block=None, end_block=None):
+        columns = _with_block(columns)
+        usecols = None if columns is None else lambda column: column in columns
+        df = pd.read_csv(self.FILES[table], usecols=usecols)
+        df = _select_block_range(df, start_block, end_block)
+        return df if columns is None else df[[column for column in columns if column in df.columns]]
+
+    def append(self, table, df):
+        if df.empty:
+            return
+        saved = pd.read_csv(self.FILES[table])
+        # Kept in block order, a re-fetched gap lands before the rows appended after it
+        saved = pd.concat([saved, df], ignore_index=True).sort_values('block', kind='stable')
+        tmp_file_path = f'{self.FILES[table]}.tmp'
+        saved.to_csv(tmp_file_path, index=False)
+        os.replace(tmp_file_path, self.FILES[table])
+
+    def latest_block(self, table='strategy'):
+        return int(pd.read_csv(self.FILES[table], usecols=['block'])['block'].max())
+
+
+# Parquet footer key of the write time of a partition, in nanoseconds
+WRITTEN_AT_KEY = b'written_at'
+
+
+def written_at(path, schema):
+    # The partitions written before the key was added fall back to the modification time of their file
+    value = (schema.metadata or {}).get(WRITTEN_AT_KEY)
+    return int(value) if value is not None else os.stat(path).st_mtime_ns
+
+
+class ParquetBackend(StorageBackend):
+    """
+    Append-only partitioned Parquet store, in the long layout: every strategy, or collateral for the pps table, has
+    its own directory of partitions holding the fields without the strategy suffix. Every append writes one new
+    partition per strategy named after its block range, so loads only open the strategies asked for and the
+    partitions overlapping the requested range, and only read the requested fields. Loads pivot back to the wide
+    frames, keeping only the blocks where every requested strategy has data, like the inner joins of the merges.
+
+    The rows are keyed by (strategy, block) with one column per field, rather than one row per (strategy, block,
+    metric). The fields keep their own types, raw integers, floats and symbols, where a single value column would
+    hold them all as one type, and a load reads only the columns of the fields asked for. Adding a strategy adds a
+    directory, not columns, and the metrics and charts keep the wide frames they are written against.
+    """
+
+    def __init__(self, root=const.PARQUET_DIR, max_partitions=const.PARQUET_MAX_PARTITIONS,
+                 strategy_names=const.STRATEGY_NAME):
+        self.root = root
+        self.max_partitions = max_partitions
+        self.strategy_names = strategy_names
+        for table in ('strategy', 'pps'):
+            self.migrate_wide_partitions(table)
+
+    def table_dir(self, table, name=None):
+        return os.path.join(self.root, table) if name is None else os.path.join(self.root, table, name)
+
+    def partitions(self, table, name=None):
+        # part-<first block>-<last block>.parquet, zero padded so that the names sort by block. Without a name, the
+        # wide partitions written before the long layout
+        partitions = []
+        for path in sorted(glob.glob(os.path.join(self.table_dir(table, name), 'part-*.parquet'))):
+            first_block, last_block = os.path.basename(path)[len('part-'):-len('.parquet')].split('-')
+            partitions.append((int(first_block), int(last_block), path))
+        return partitions
+
+    def migrate_wide_partitions(self, table):
+        # The wide partitions are split into the strategy directories once, then removed
+        for _, _, path in self.partitions(table):
+            self.append(table, pq.read_table(path).to_pandas(ignore_metadata=True))
+            os.remove(path)
+
+    def is_empty(self):
+        return not any(self.partitions(table, name) for table in ('strategy', 'pps') for name in self.strategy_names)
+
+    def read(self, table, name, columns, start_block=None, end_block=None):
+        filters = []
+        if start_block is not None:
+            filters.append(('block', '>=', int(start_block)))
+        if end_block is not None:
+            filters.append(('block', '<=', int(end_block)))
+
+        tables = []
+        for first_block, last_block, path in self.partitions(table, name):
+            # Skip the partitions outside of the block range without opening them
+            if start_block is not None and last_block < start_block:
+                continue
+            if end_block is not None and first_block > end_block:
+                continue
+
+            schema = pq.read_schema(path)
+            tables.append((written_at(path, schema),
+                           pq.read_table(path, columns=[column for column in columns if column in schema.names],
+                                         filters=filters or None)))
+
+        if not tables:
+            return pd.DataFrame(columns=columns)
+
+        # In write order, so a block appended twice keeps its latest version whatever the names of the partitions.
+        # A gap re-fill sorts before the compacted partition covering it by name, yet is the newer write
+        tables = [arrow_table for _, arrow_table in sorted(tables, key=lambda entry: entry[0])]
+
+        # Plain numpy dtypes for the metrics code, the nullable Int64 of the writer is not restored
+        df = pa.concat_tables(tables, promote_options='default').to_pandas(ignore_metadata=True)
+
+        return df.drop_duplicates(subset='block', keep='last').sort_values('block').reset_index(drop=True)
+
+    def load(self, table, columns=None, start_block=None, end_block=None):
+        columns = _with_block(columns)
+        names, fields = requested_strategies(table, columns, self.strategy_names)
+        with_time = table == 'strategy' and (columns is None or 'time' in columns)
+
+        wide = None
+        for name in names:
+            # The time is the same in every strategy, it is read from the first one
+            df = self.read(table, name, ['block'] + (['time'] if with_time and wide is None else []) + fields,
+                           start_block, end_block)
+            df = df.rename(columns={field: f'{field}{name}' for field in fields})
+            # Every requested strategy must have the block, like the inner joins of merge_strategy_data
+            wide = df if wide is None else pd.merge(wide, df, on='block', how='inner')
+
+        if columns is None:
+            ordered = ['block', 'time'] if table == 'strategy' else ['block']
+            ordered += [f'{field}{name}' for name in names for field in fields]
+            return wide[[column for column in ordered if column in wide.columns]]
+        return wide[[column for column in columns if column in wide.columns]]
+
+    def write_file(self, table, name, df, written_at_ns=None):
+        """
+        Writes the rows of a strategy to the partition file of their block range.
+
+        Parameters:
+        table (str): 'strategy' or 'pps'.
+        name (str): The strategy name.
+        df (DataFrame): The rows, in the long layout of the strategy directories.
+        written_at_ns (int): The write time stored in the footer, now when None.
+
+        Returns:
+        str: The path of the partition.
+        """
+        schema = pa.schema([(column, arrow_type(column)) for column in df.columns])
+        arrow_table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        written_at_ns = time.time_ns() if written_at_ns is None else written_at_ns
+        arrow_table = arrow_table.replace_schema_metadata({**(arrow_table.schema.metadata or {}),
+                                                           WRITTEN_AT_KEY: str(written_at_ns).encode()})
+
+        os.makedirs(self.table_dir(table, name), exist_ok=True)
+        path = os.path.join(self.table_dir(table, name),
+                            f"part-{int(df['block'].min()):010d}-{int(df['block'].max()):010d}.parquet")
+
+        # A partition for the same range replaces the previous one, the rest of the table is never rewritten
+        tmp_path = f'{path}.tmp'
+        pq.write_table(arrow_table, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def write_partition(self, table, name, df):
+        self.write_file(table, name, df)
+        if len(self.partitions(table, name)) > self.max_partitions:
+            self.compact(table, [name])
+
+    def append(self, table, df):
+        if df.empty:
+            return
+
+        df = typed_frame(df)
+        fields = ['pps'] if table == 'pps' else STRATEGY_FIELDS
+        for name in self.strategy_names:
+            name_fields = [field for field in fields if f'{field}{name}' in df.columns]
+            if not name_fields:
+                continue
+            rows = df[['block'] + (['time'] if 'time' in df.columns else []) +
+                      [f'{field}{name}' for field in name_fields]]
+            self.write_partition(table, name, rows.rename(columns={f'{field}{name}': field for field in name_fields}))
+
+    def compact(self, table, names=None):
+        # Merge the small partitions written by every refresh into a single one per strategy. The merged partition is
+        # in place before the old ones are removed, so a failed write or a concurrent load never finds the table empty
+        for name in self.strategy_names if names is None else names:
+            partitions = self.partitions(table, name)
+            if len(partitions) < 2:
+                continue
+            schemas = [(path, pq.read_schema(path)) for _, _, path in partitions]
+            columns = list(dict.fromkeys(column for _, schema in schemas for column in schema.names))
+            df = self.read(table, name, columns)
+            # Stamped with the latest write it merges, a partition appended in the meantime still wins over it
+            merged_path = self.write_file(table, name, df, max(written_at(path, schema) for path, schema in schemas))
+            for _, _, path in partitions:
+                if path != merged_path:
+                    os.remove(path)
+
+    def latest_block(self, table='strategy'):
+        last_blocks = [last_block for name in self.strategy_names for _, last_block, _ in self.partitions(table, name)]
+        if not last_blocks:
+            return None
+        return max(last_blocks)
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Embedded SQLite database. Strategy snapshots are keyed by (strategy, block) and pps by (collateral, block),
+    so writes are idempotent upserts and the latest block is an indexed MAX(). Loads pivot the rows back to the wide
+    frames, keeping only the blocks where every requested strategy has data, like the inner joins of the merges.
+    The times of the blocks are read from and written to the shared block timestamp cache of blocktime.py.
+    """
+
+    def __init__(self, path=const.SQLITE_PATH, strategy_list=const.STRATEGY_LIST,
+                 collateral_list=const.COLLATERAL_LIST, strategy_names=const.STRATEGY_NAME, block_times=None):
+        self.path = path
+        self.block_times = block_times or blocktime.get_cache()
+        self.strategy_names = strategy_names
+        self.strategy_address = dict(zip(strategy_names, strategy_list))
+        self.collateral_address = dict(zip(strategy_names, collateral_list))
+
+        strategy_columns = ',\n'.join(f'{field} {self.sql_type(field)}' for field in STRATEGY_FIELDS)
+        with self.connect() as conn:
+            # WAL lets the page read while the ingestion worker writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS strategy_snapshots (
+                    strategy TEXT NOT NULL,
+                    block INTEGER NOT NULL,
+                    {strategy_columns},
+                    PRIMARY KEY (strategy, block)
+                );
+                CREATE INDEX IF NOT EXISTS strategy_snapshots_block ON strategy_snapshots (block);
+                CREATE TABLE IF NOT EXISTS pps (
+                    collateral TEXT NOT NULL,
+                    block INTEGER NOT NULL,
+                    pps INTEGER,
+                    PRIMARY KEY (collateral, block)
+                );
+                CREATE INDEX IF NOT EXISTS pps_block ON pps (block);
+                CREATE TABLE IF NOT EXISTS address_snapshots (
+                    block INTEGER PRIMARY KEY,
+                    base INTEGER NOT NULL,
+                    added BLOB NOT NULL,
+                    removed BLOB NOT NULL
+                );
+            ''')
+
+        self.migrate_block_timestamps()
+
+    def migrate_block_timestamps(self):
+        # The databases written before the times moved to the shared cache hold them in their own table
+        with self.connect() as conn, conn:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'block_timestamps'").fetchone():
+                times = pd.read_sql_query('SELECT block, time FROM block_timestamps WHERE time IS NOT NULL', conn)
+                self.put_times(times.assign(time=pd.to_datetime(times['time'])))
+                conn.execute('DROP TABLE block_timestamps')
+
+    def put_times(self, times):
+        # Stored as estimated, a timestamp read from the block is never replaced by the time of a data row
+        times = times.dropna()
+        timestamps = pd.to_datetime(times['time']).astype('datetime64[s]').astype('int64')
+        self.block_times.put_many(dict(zip(times['block'], timestamps)), estimated=True)
+
+    @staticmethod
+    def sql_type(field):
+        if field in RAW_INTEGER_FIELDS:
+            return 'INTEGER'
+        if field in STRING_FIELDS:
+            return 'TEXT'
+        return 'REAL'
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def is_empty(self):
+        return self.latest_block() is None and self.latest_block('pps') is None
+
+    @staticmethod
+    def _upsert(conn, table, key_columns, df):
+        columns = list(df.columns)
+        updates = ', '.join(f'{column}=excluded.{column}' for column in columns if column not in key_columns)
+        conn.executemany(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET {updates}',
+            # Plain Python values, sqlite3 does not bind numpy scalars
+            [tuple(None if pd.isna(value) else value.item() if hasattr(value, 'item') else value for value in row)
+             for row in df.itertuples(index=False, name=None)])
+
+    def append(self, table, df):
+        if df.empty:
+            return
+
+        df = typed_frame(df)
+
+        with self.connect() as conn, conn:
+            if table == 'pps':
+                for name, address in self.collateral_address.items():
+                    if f'pps{name}' not in df.columns:
+                        continue
+                    rows = df[['block', f'pps{name}']].rename(columns={f'pps{name}': 'pps'})
+                    rows.insert(0, 'collateral', address)
+                    self._upsert(conn, 'pps', ['collateral', 'block'], rows)
+                return
+
+            for name, address in self.strategy_address.items():
+                fields = [field for field in STRATEGY_FIELDS if f'{field}{name}' in df.columns]
+                if not fields:
+                    continue
+                rows = df[['block'] + [f'{field}{name}' for field in fields]]
+                rows = rows.rename(columns={f'{field}{name}': field for field in fields})
+                rows.insert(0, 'strategy', address)
+                self._upsert(conn, 'strategy_snapshots', ['strategy', 'block'], rows)
+
+        if 'time' in df.columns:
+            self.put_times(df[['block', 'time']])
+
+    @staticmethod
+    def _block_filter(start_block, end_block):
+        clauses, params = [], []
+        if start_block is not None:
+            clauses.append('block >= ?')
+            params.append(int(start_block))
+        if end_block is not None:
+            clauses.append('block <= ?')
+            params.append(int(end_block))
+        return clauses, params
+
+    def load(self, table, columns=None, start_block=None, end_block=None):
+        columns = _with_block(columns)
+        clauses, params = self._block_filter(start_block, end_block)
+
+        # Only the strategies and fields asked for are read
+        names, fields = requested_strategies(table, columns, self.strategy_names)
+        if table == 'pps':
+            key, sql_table = 'collateral', 'pps'
+            key_addresses = [self.collateral_address[name] for name in names]
+        else:
+            key, sql_table = 'strategy', 'strategy_snapshots'
+            key_addresses = [self.strategy_address[name] for name in names]
+
+        clauses.append(f'{key} IN ({", ".join("?" * len(key_addresses))})')
+        query = f'SELECT {", ".join([key, "block"] + fields)} FROM {sql_table} WHERE {" AND ".join(clauses)}'
+
+        with self.connect() as conn:
+            rows = pd.read_sql_query(query, conn, params=params + key_addresses)
+
+        # Every requested strategy must have the block, like the inner joins of merge_strategy_data
+        wide = pd.DataFrame({'block': rows['block'].drop_duplicates()})
+        for name, address in zip(names, key_addresses):
+            group = rows.loc[rows[key] == address, ['block'] + fields]
+            wide = pd.merge(wide, group.rename(columns={field: f'{field}{name}' for field in fields}),
+                            on='block', how='inner')
+
+        if table == 'strategy' and (columns is None or 'time' in columns):
+            timestamps = self.block_times.get_many(wide['block'], include_estimated=True)
+            wide['time'] = pd.to_datetime(wide['block'].map(timestamps), unit='s')
+
+        wide = wide.sort_values('block').reset_index(drop=True)
+
+        if columns is None:
+            ordered = ['block', 'time'] if table == 'strategy' else ['block']
+            ordered += [f'{field}{name}' for name in names for field in fields]
+            return wide[[column for column in ordered if column in wide.columns]]
+
+        return wide[[column for column in columns if column in wide.columns]]
+
+    def latest_block(self, table='strategy'):
+        sql_table = 'strategy_snapshots' if table == 'strategy' else 'pps'
+        with self.connect() as conn:
+            # Served by the block index, no row is loaded
+            return conn.execute(f'SELECT MAX(block) FROM {sql_table}').fetchone()[0]
+
+    def stored_blocks(self, table):
+        # A block missing some strategy or collateral is incomplete, the wide loads would drop it
+        sql_table, key = ('strategy_snapshots', 'strategy') if table == 'strategy' else ('pps', 'collateral')
+        with self.connect() as conn:
+            rows = conn.execute(f'SELECT block FROM {sql_table} GROUP BY block HAVING COUNT(DISTINCT {key}) = ?',
+                                (len(self.strategy_names),)).fetchall()
+        return {block for block, in rows}
+
+    def block_range_for_time(self, start_time=None, end_time=None, start_block=None, end_block=None):
+        first_block, last_block = self.block_times.block_range(
+            start_timestamp=None if start_time is None else pd.Timestamp(start_time).timestamp(),
+            end_timestamp=None if end_time is None else pd.Timestamp(end_time).timestamp(),
+            start_block=start_block, end_block=end_block)
+        if first_block is None:
+            return 0, -1
+        return first_block, last_block
+
+    def load_address_snapshots(self, end_block=None):
+        where, params = ('WHERE block <= ?', [int(end_block)]) if end_block is not None else ('', [])
+        with self.connect() as conn:
+            snapshots = pd.read_sql_query(
+                f'SELECT block, base, added, removed FROM address_snapshots {where} ORDER BY block', conn, params=params)
+        snapshots['base'] = snapshots['base'].astype(bool)
+        return snapshots
+
+    def append_address_snapshot(self, block, base, added, removed):
+        with self.connect() as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO address_snapshots (block, base, added, removed) VALUES (?, ?, ?, ?)',
+                         (int(block), int(base), added, removed))
+
+    def has_address_log(self):
+        with self.connect() as conn:
+            return conn.execute('SELECT 1 FROM address_snapshots LIMIT 1').fetchone() is not None
+
+
+def migrate_from_csv(backend, strategy_csv=const.STRATEGY_CSV, pps_csv=const.PPS_CSV):
+    """
+    One-shot migration of the CSV stores into a Parquet or SQLite backend.
+
+    The pps values that the CSV files already hold as rounded floats (e.g. 1.03E+18) are stored as the nearest
+    int64. The precision lost in the CSV cannot be recovered by the migration.
+    """
+    backend.append_strategy(pd.read_csv(strategy_csv))
+    backend.append_pps(pd.read_csv(pps_csv))
+
+
+def migrate_address_log(backend, address_log_csv=const.ADDRESS_LOG_CSV):
+    # The full address lists of the CSV are stored as snapshots, in block order
+    for block, user_address_list in pd.read_csv(address_log_csv).sort_values('block').itertuples(index=False,
+                                                                                                 name=None):
+        backend.append_address_log(block, ast.literal_eval(user_address_list))
+
+
+def open_backend(name):
+    if name == 'csv':
+        backend = CsvBackend()
+    elif name in ('parquet', 'sqlite'):
+        backend = ParquetBackend() if name == 'parquet' else SqliteBackend()
+        if backend.is_empty() and os.path.exists(const.STRATEGY_CSV):
+            migrate_from_csv(backend)
+    else:
+        raise ValueError(f'Unknown storage backend: {name}')
+
+    if not backend.has_address_log() and os.path.exists(const.ADDRESS_LOG_CSV):
+        migrate_address_log(backend)
+
+    return backend
+
+
+# One backend per name, shared by every thread of the process. The setup and the migration checks run once
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def get_backend(name=const.STORAGE_BACKEND):
+    with _BACKENDS_LOCK:
+        if name not in _BACKENDS:
+            _BACKENDS[name] = open_backend(name)
+        return _BACKENDS[name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manages the strategy and pps stores.')
+    parser.add_argument('command', choices=['migrate', 'compact', 'migrate-addresses'])
+    parser.add_argument('--backend', choices=['parquet', 'sqlite'], default=const.STORAGE_BACKEND)
+    args = parser.parse_args()
+
+    target_backend = ParquetBackend() if args.backend == 'parquet' else SqliteBackend()
+    if args.command == 'migrate':
+        if not target_backend.is_empty():
+            raise SystemExit(f'The {args.backend} store already holds data, remove it to migrate again')
+        migrate_from_csv(target_backend)
+        if not target_backend.has_address_log() and os.path.exists(const.ADDRESS_LOG_CSV):
+            migrate_address_log(target_backend)
+    elif args.command == 'migrate-addresses':
+        if target_backend.has_address_log():
+            raise SystemExit(f'The {args.backend} store already holds an address log, remove it to migrate again')
+        migrate_address_log(target_backend)
+    elif args.backend == 'parquet':
+        target_backend.compact('strategy')
+        target_backend.compact('pps')
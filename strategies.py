@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Strategy:
+    """
+    A Sturdy aggregator silo and the contracts its data is read from.
+
+    name: The suffix of its columns, e.g. 'USDC' in 'totalAssetUSDC'.
+    address: The strategy contract.
+    collateral: The collateral vault, whose pricePerShare is the pps of the silo.
+    oracle: The price oracle of the collateral.
+    curve_pool: The Curve pool of the collateral, read for its virtual price.
+    """
+    name: str
+    address: str
+    collateral: str
+    oracle: str
+    curve_pool: str
+
+
+# Every silo of the dashboard. Ingestion, storage, metrics and charts are driven by this list, a new silo is a new
+# entry. The order is the one of the strategies in the getUserPositions result of the data provider
+STRATEGIES = [
+    Strategy(name='USDC',
+             address='0x6311fF24fb15310eD3d2180D3d0507A21a8e5227',
+             collateral='0x7cA00559B978CFde81297849be6151d3ccB408A9',
+             oracle='0xA460cc3dC111E42939512B29390e576f8506D213',
+             curve_pool='0x4dece678ceceb27446b35c672dc7d61f30bad69e'),
+    Strategy(name='mkUSD',
+             address='0x200723063111f9f8f1d44c0F30afAdf0C0b1a04b',
+             collateral='0xd901DCf4948a29d7D9D7E015AAF61591825AC267',
+             oracle='0x71A0478d181D5fD5f14C46617a58D8e3095bbDDb',  # '0xE0DD70C18976Ad7334354234c73ce2a4b749F5F0',
+             curve_pool='0x3de254a0f838a844f727fee81040e0fa7884b935'),
+    Strategy(name='USDT',
+             address='0x26fe402A57D52c8a323bb6e09f06489C8216aC88',
+             collateral='0x241AdD131B9aaa7527132b752252b99420937ADc',
+             oracle='0x6F7C66f09922C04218B54A04261FcA2310c76aDC',
+             curve_pool='0x390f3595bca2df7d23783dfd126427cceb997bf4'),
+    Strategy(name='FRAX',
+             address='0x8dDE9A50a91cc0a5DaBdc5d3931c1AF60408c84D',
+             collateral='0x8176b059BD8f63aeB7e20282b12D243b4626E2AE',
+             oracle='0x680F851a3796AB1Aa1204cA8dD2214ef170D1A2D',
+             curve_pool='0x0cd6f267b2086bea681e922e19d40512511be538'),
+]
+
+
+def get_strategy(name):
+    for strategy in STRATEGIES:
+        if strategy.name == name:
+            return strategy
+    raise ValueError(f'Unknown strategy: {name}')
+
+
+def columns(fields, names=None):
+    """
+    Builds the wide column names of some fields of some strategies.
+
+    Parameters:
+    fields (list): The field names, e.g. ['totalAsset', 'totalBorrow'].
+    names (list): The strategy names, every strategy when None.
+
+    Returns:
+    list: The '<field><name>' columns, grouped by strategy.
+    """
+    names = [strategy.name for strategy in STRATEGIES] if names is None else names
+    return [f'{field}{name}' for name in names for field in fields]
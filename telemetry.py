@@ -0,0 +1,216 @@
+import collections
+import datetime
+import functools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import const
+
+# Process wide, shared by the ingestion worker, the Streamlit sessions and their threads
+_lock = threading.Lock()
+_timings = {}
+_counters = {}
+_failures = collections.deque(maxlen=const.RECENT_FAILURES)
+
+
+class Timer:
+    """
+    Times a stage of the pipeline, as a context manager or, through timed, a decorator.
+
+    The duration is added to the totals of the stage, and kept on the timer for the caller that needs it for a run.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.started_at
+        record(self.stage, self.seconds, failed=exc_type is not None)
+        return False
+
+
+def timer(stage):
+    return Timer(stage)
+
+
+def timed(stage=None):
+    """
+    Decorator timing every call of a function.
+
+    Parameters:
+    stage (str): The name of the stage, '<module>.<function>' when None.
+
+    Returns:
+    callable: The decorator.
+    """
+
+    def decorator(fn):
+        name = stage or f'{fn.__module__}.{fn.__name__}'
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Timer(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(stage, seconds, failed=False):
+    with _lock:
+        timing = _timings.setdefault(stage, {'calls': 0, 'failures': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        timing['calls'] += 1
+        timing['failures'] += failed
+        timing['seconds'] += seconds
+        timing['max_seconds'] = max(timing['max_seconds'], seconds)
+
+
+def count(name, value=1):
+    """
+    Adds to a counter, e.g. the RPC requests sent or the cache hits.
+
+    Parameters:
+    name (str): The name of the counter.
+    value (int): The amount added.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def failure(name, error, **fields):
+    """
+    Records a failure the caller recovers from, e.g. a block left for a later run.
+
+    Parameters:
+    name (str): What failed, counted as '<name>_failures'.
+    error (Exception): The error.
+    fields: The context of the failure, e.g. the block.
+    """
+    entry = {'time': datetime.datetime.utcnow().isoformat(timespec='seconds'), 'name': name, **fields,
+             'error': repr(error)}
+    with _lock:
+        _counters[f'{name}_failures'] = _counters.get(f'{name}_failures', 0) + 1
+        _failures.append(entry)
+    log('failure', **{key: value for key, value in entry.items() if key != 'time'})
+
+
+def snapshot():
+    """
+    Returns a copy of every timing and counter since the start of the process.
+
+    Returns:
+    dict: 'timings', the calls, failures, total and max seconds per stage, 'counters', and 'failures', the last
+    const.RECENT_FAILURES failures recorded by failure.
+    """
+    with _lock:
+        return {'timings': {stage: dict(timing) for stage, timing in _timings.items()},
+                'counters': dict(_counters), 'failures': list(_failures)}
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        _failures.clear()
+
+
+def log(event, **fields):
+    """
+    Prints a structured log line, one JSON object per line, when const.JSON_LOGS is set.
+
+    Parameters:
+    event (str): What happened, e.g. 'ingestion_stage'.
+    fields: The values of the event.
+    """
+    if not const.JSON_LOGS:
+        return
+    line = {'time': datetime.datetime.utcnow().isoformat(timespec='milliseconds'), 'event': event, **fields}
+    print(json.dumps(line, default=str), flush=True)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(extra=None):
+    """
+    Renders the timings and counters in the Prometheus text exposition format.
+
+    Parameters:
+    extra (dict): Gauges added to the output, name to value, e.g. the last committed block.
+
+    Returns:
+    str: The metrics page.
+    """
+    metrics = snapshot()
+    prefix = const.METRICS_PREFIX
+    lines = []
+
+    for suffix, key, kind, description in (('seconds_total', 'seconds', 'counter', 'Seconds spent in the stage'),
+                                           ('calls_total', 'calls', 'counter', 'Calls of the stage'),
+                                           ('failures_total', 'failures', 'counter', 'Calls of the stage that raised'),
+                                           ('max_seconds', 'max_seconds', 'gauge', 'Slowest call of the stage')):
+        name = f'{prefix}_stage_{suffix}'
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{stage="{_label(stage)}"}} {timing[key]}'
+                  for stage, timing in sorted(metrics['timings'].items())]
+
+    for counter, value in sorted(metrics['counters'].items()):
+        name = f'{prefix}_{_metric_name(counter)}_total'
+        lines += [f'# TYPE {name} counter', f'{name} {value}']
+
+    for gauge, value in sorted((extra or {}).items()):
+        if value is None:
+            continue
+        name = f'{prefix}_{_metric_name(gauge)}'
+        lines += [f'# TYPE {name} gauge', f'{name} {value}']
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port=const.METRICS_PORT, host=const.METRICS_HOST, extra=None):
+    """
+    Serves the metrics on /metrics from a daemon thread.
+
+    Parameters:
+    port (int): The port to listen on.
+    host (str): The interface to listen on.
+    extra (callable): Returns the gauges added to every page, see prometheus_text.
+
+    Returns:
+    ThreadingHTTPServer: The running server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(extra() if extra else None).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scraped every few seconds, the access log would drown the ingestion logs
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+    print(f'Metrics served on http://{host}:{server.server_address[1]}/metrics')
+    return server
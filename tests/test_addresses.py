@@ -0,0 +1,56 @@
+import pandas as pd
+import addresses
+
+A, B, C, D = ('0x' + digit * 40 for digit in 'abcd')
+
+
+def snapshot_frame(*snapshots):
+    # (block, base, added, removed) tuples, the addresses packed like the stores keep them
+    return pd.DataFrame([{'block': block, 'base': base, 'added': addresses.pack(added),
+                          'removed': addresses.pack(removed)} for block, base, added, removed in snapshots])
+
+
+def test_pack_round_trip():
+    packed = addresses.pack([A, B, '0x' + '00' * 19 + '01'])
+
+    assert len(packed) == 60
+    assert addresses.unpack(packed) == [A, B, '0x' + '00' * 19 + '01']
+    assert addresses.unpack(addresses.pack([])) == []
+
+
+def test_diff_keeps_the_list_order():
+    added, removed = addresses.diff([A, B, C], [C, D, A, D])
+
+    assert added == [D]
+    assert removed == [B]
+
+
+def test_replay_applies_the_deltas_since_the_last_base():
+    snapshots = snapshot_frame((1, True, [A, B], []),
+                               (2, False, [C], [A]),
+                               (3, True, [D], []),
+                               (4, False, [A, B], [D]),
+                               (5, False, [D], [B]))
+
+    assert addresses.replay(snapshots.iloc[:2]) == [B, C]
+    assert addresses.replay(snapshots) == [A, D]
+    assert addresses.replay(snapshots.iloc[:0]) == []
+
+
+def test_replay_of_the_diffs_rebuilds_every_set():
+    sets = [[A], [A, B, C], [C], [C, D, A], [], [B]]
+    snapshots, previous = [], []
+    for block, current in enumerate(sets):
+        added, removed = addresses.diff(previous, current)
+        snapshots.append((block, block == 0, added, removed))
+        previous = current
+
+        assert addresses.replay(snapshot_frame(*snapshots)) == current
+
+
+def test_rebase_is_due_once_the_deltas_outgrow_the_set():
+    snapshots = snapshot_frame((1, True, [A, B, C, D], []), (2, False, [A], [B]))
+
+    assert addresses.is_rebase_due(snapshot_frame(), 0, 0)
+    assert not addresses.is_rebase_due(snapshots, 2, 4, ratio=1)
+    assert addresses.is_rebase_due(snapshots, 3, 4, ratio=1)
@@ -0,0 +1,29 @@
+import blocktime
+import const
+
+
+def test_finality_is_measured_against_the_chain_tip(tmp_path, monkeypatch):
+    monkeypatch.setattr(blocktime, '_TIP', {'block': 0, 'checked_at': 0.0})
+    cache = blocktime.BlockTimestampCache(str(tmp_path / 'block_times.sqlite'))
+    tip = 20_000_000
+    tip_reads = []
+
+    def fetch_tip():
+        tip_reads.append(tip)
+        return tip
+
+    # An old range ending on its highest requested block is final, the chain moved on long ago
+    old = [10_000_000 + i for i in range(0, 100, 10)]
+    timestamps = blocktime.get_block_timestamps(old, lambda block_number: block_number * 12, workers=2,
+                                                interpolate=False, cache=cache, fetch_tip=fetch_tip)
+    assert timestamps == {block_number: block_number * 12 for block_number in old}
+    assert cache.get_many(old) == timestamps
+
+    # Blocks within the finality depth of the tip are read but not cached
+    recent = [tip - const.FINALITY_DEPTH, tip - 1]
+    blocktime.get_block_timestamps(recent, lambda block_number: block_number * 12, workers=2, interpolate=False,
+                                   cache=cache, fetch_tip=fetch_tip)
+    assert cache.get_many(recent) == {recent[0]: recent[0] * 12}
+
+    # The tip is read again at most once per block time
+    assert len(tip_reads) == 1
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import charts
+import const
+
+ASSET = const.STRATEGY_NAME[0]
+
+
+def master_frame(rows):
+    time = pd.date_range('2021-01-01', periods=rows, freq='4h')
+    values = np.linspace(1, 2, rows)
+    return pd.DataFrame({'block': np.arange(rows), 'time': time, f'reserveSize{ASSET}': values * 1e6,
+                         f'currentBorrow{ASSET}': values * 5e5, f'utilization{ASSET}': values / 4})
+
+
+def test_large_series_is_decimated_and_drawn_as_svg():
+    rows = const.CHART_WEBGL_THRESHOLD + 1
+    fig = charts.usage_metrics_figure.__wrapped__(0, ASSET, None, master_frame(rows))
+
+    assert all(type(trace) is go.Scatter for trace in fig.data)
+    assert all(len(trace.x) <= const.CHART_MAX_POINTS for trace in fig.data)
+    # The decimated series still spans the whole history
+    assert fig.data[0].x[0] == pd.Timestamp('2021-01-01')
+    assert fig.data[0].x[-1] == master_frame(rows)['time'].iloc[-1]
+
+
+def test_large_series_kept_whole_is_drawn_with_webgl(monkeypatch):
+    monkeypatch.setattr(const, 'CHART_DECIMATION', None)
+    rows = const.CHART_WEBGL_THRESHOLD + 1
+    fig = charts.usage_metrics_figure.__wrapped__(0, ASSET, None, master_frame(rows))
+
+    assert all(isinstance(trace, go.Scattergl) for trace in fig.data)
+    assert all(len(trace.x) == rows for trace in fig.data)
+
+
+def test_small_series_is_kept_whole_as_svg():
+    rows = const.CHART_MAX_POINTS // 2
+    fig = charts.usage_metrics_figure.__wrapped__(0, ASSET, None, master_frame(rows))
+
+    assert all(type(trace) is go.Scatter for trace in fig.data)
+    assert all(len(trace.x) == rows for trace in fig.data)
+
+
+def test_time_window_keeps_the_last_days():
+    df = master_frame(6 * 100)
+
+    window = charts.time_window(df, 30)
+
+    assert window['time'].iloc[0] == df['time'].iloc[-1] - pd.Timedelta(days=30)
+    assert window['time'].iloc[-1] == df['time'].iloc[-1]
+    assert charts.time_window(df, None) is df
@@ -0,0 +1,20 @@
+import concurrency
+import telemetry
+
+
+def test_map_blocks_keeps_the_order_and_records_the_failures():
+    def fetch(block_number):
+        if block_number == 300:
+            raise ConnectionError('RPC unreachable')
+        return block_number * 2
+
+    telemetry.reset()
+
+    assert concurrency.map_blocks(fetch, [100, 200, 300, 400], workers=3) == [200, 400, None, 800]
+
+    metrics = telemetry.snapshot()
+    assert metrics['counters']['block_fetch_failures'] == 1
+    [failure] = metrics['failures']
+    assert failure['block'] == 300
+    assert failure['fetch'].endswith('fetch')
+    assert 'RPC unreachable' in failure['error']
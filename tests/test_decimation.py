@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+import decimation
+
+
+def noisy_series(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.arange(n, dtype=float), np.cumsum(rng.normal(size=n))
+
+
+def test_lttb_keeps_the_endpoints_and_the_target_count():
+    x, y = noisy_series(10000)
+
+    kept = decimation.lttb_indices(x, y, 500)
+
+    assert len(kept) == 500
+    assert kept[0] == 0 and kept[-1] == len(x) - 1
+    assert np.all(np.diff(kept) > 0)
+
+
+def test_lttb_keeps_a_spike():
+    x, y = np.arange(5000, dtype=float), np.zeros(5000)
+    y[2345] = 100.0
+
+    assert 2345 in decimation.lttb_indices(x, y, 100)
+
+
+def test_lttb_keeps_a_short_series_whole():
+    x, y = noisy_series(50)
+
+    assert decimation.lttb_indices(x, y, 100).tolist() == list(range(50))
+    assert decimation.lttb_indices(x, y, 2).tolist() == list(range(50))
+
+
+def test_minmax_keeps_the_extremes_within_the_target():
+    _, y = noisy_series(10000, seed=1)
+
+    kept = decimation.minmax_indices(y, 500)
+
+    assert len(kept) <= 500
+    assert kept[0] == 0 and kept[-1] == len(y) - 1
+    assert y.argmin() in kept and y.argmax() in kept
+    assert np.all(np.diff(kept) > 0)
+
+
+def test_decimate_leaves_out_the_missing_values():
+    x = pd.Series(pd.date_range('2024-01-01', periods=3000, freq='4h'))
+    y = pd.Series(np.linspace(0, 1, 3000))
+    y.iloc[::7] = np.nan
+    x.iloc[5] = pd.NaT
+
+    for method in ('lttb', 'minmax'):
+        kept_x, kept_y = decimation.decimate(x, y, target=200, method=method)
+        assert len(kept_x) <= 200
+        assert not kept_x.isna().any() and not kept_y.isna().any()
+        assert kept_x.is_monotonic_increasing
+
+
+def test_decimate_without_a_method_keeps_every_point():
+    x, y = pd.Series(np.arange(3000.0)), pd.Series(np.arange(3000.0))
+
+    kept_x, kept_y = decimation.decimate(x, y, target=200, method=None)
+
+    assert kept_x is x and kept_y is y
+    with pytest.raises(ValueError):
+        decimation.decimate(x, y, target=200, method='median')
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import pytest
+import const
+import gaps
+import ltvhistory
+import utils
+
+USERS = ['0x' + 'a1' * 20, '0x' + 'b2' * 20, '0x' + 'c3' * 19 + '00']
+
+
+def position_frame(borrow, collateral, names=const.STRATEGY_NAME):
+    columns = {'user': USERS}
+    for name in names:
+        columns[f'{name}_assetBalance'] = [0.0] * len(USERS)
+        columns[f'{name}_borrowBalance'] = borrow
+        columns[f'{name}_collateralBalance'] = collateral
+    return pd.DataFrame(columns)
+
+
+def strategy_row(names=const.STRATEGY_NAME):
+    return pd.Series({**{f'lowExchangeRate{name}': 1.0 for name in names}, **{f'maxLTV{name}': 80.0 for name in names}})
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The history, the retry queue and the failure log are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_position_rows_keep_the_users_with_a_debt(workdir):
+    rows = ltvhistory.position_rows(100, position_frame([10.0, 0.0, 5.0], [20.0, 1.0, 0.0]), strategy_row())
+
+    assert len(rows) == 2 * len(const.STRATEGY_NAME)
+    first = rows[rows['strategy'] == const.STRATEGY_NAME[0]]
+    assert first['ltv'].tolist() == [0.5, np.inf]
+    # The trailing zero byte of the third address survives the round trip through the binary column
+    ltvhistory.write_partition(rows, [100])
+    assert sorted(ltvhistory.load_user_ltv()['user'].unique()) == [USERS[0], USERS[2]]
+
+
+def test_risk_distribution_keeps_the_positions_without_collateral(workdir):
+    name = const.STRATEGY_NAME[0]
+    # Ratios 0.25, 0.75 and 1.25 of the liquidation LTV, and a debt without collateral
+    rows = ltvhistory.position_rows(100, position_frame([2.0, 6.0, 10.0], [10.0, 10.0, 10.0]), strategy_row())
+    no_collateral = ltvhistory.position_rows(100, position_frame([7.0, 0.0, 0.0], [0.0, 0.0, 0.0]), strategy_row())
+    ltvhistory.write_partition(pd.concat([rows, no_collateral], ignore_index=True), [100])
+
+    distribution = ltvhistory.risk_distribution(name, bins=[0, 0.5, 1])
+
+    assert list(distribution.columns) == ['0%-50%', '50%-100%', '100%+', ltvhistory.NO_COLLATERAL_BUCKET]
+    assert distribution.loc[100].tolist() == [2.0, 6.0, 10.0, 7.0]
+    # Every debt is in a bucket
+    assert distribution.loc[100].sum() == 25.0
+
+
+def test_load_user_ltv_filters_on_strategy_names(workdir):
+    ltvhistory.write_partition(
+        ltvhistory.position_rows(100, position_frame([1.0, 1.0, 1.0], [2.0, 2.0, 2.0]), strategy_row()), [100])
+
+    df = ltvhistory.load_user_ltv(strategy_names=[const.STRATEGY_NAME[1]])
+
+    assert set(df['strategy']) == {const.STRATEGY_NAME[1]}
+    assert df['ltv_ratio'].tolist() == [0.5 / 0.8] * 3
+
+
+def test_compact_merges_the_partitions(workdir):
+    # Nothing to merge in an empty history
+    ltvhistory.compact()
+    for block in (100, 200, 300):
+        ltvhistory.write_partition(
+            ltvhistory.position_rows(block, position_frame([1.0, 1.0, 1.0], [2.0, 2.0, 2.0]), strategy_row()), [block])
+    before = ltvhistory.load_user_ltv()
+
+    ltvhistory.compact()
+
+    assert len(ltvhistory.partitions()) == 1
+    assert ltvhistory.stored_blocks() == {100, 200, 300}
+    pd.testing.assert_frame_equal(ltvhistory.load_user_ltv(), before)
+
+
+def test_failed_compaction_keeps_the_history(workdir, monkeypatch):
+    for block in (100, 200):
+        ltvhistory.write_partition(
+            ltvhistory.position_rows(block, position_frame([1.0, 1.0, 1.0], [2.0, 2.0, 2.0]), strategy_row()), [block])
+
+    def full_disk(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(ltvhistory.pq, 'write_table', full_disk)
+    with pytest.raises(OSError):
+        ltvhistory.compact()
+
+    assert ltvhistory.stored_blocks() == {100, 200}
+    assert len(ltvhistory.load_user_ltv()) == 2 * 3 * len(const.STRATEGY_NAME)
+
+
+def test_load_reads_the_merged_rows_once(workdir):
+    rows = ltvhistory.position_rows(100, position_frame([1.0, 1.0, 1.0], [2.0, 2.0, 2.0]), strategy_row())
+    ltvhistory.write_partition(rows, [100])
+    # The merged partition of a compaction that has not removed the old ones yet
+    ltvhistory.write_partition(rows, [100, 200])
+
+    assert len(ltvhistory.load_user_ltv()) == len(rows)
+
+
+class FakeBackend:
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def load_address_snapshots(self):
+        return pd.DataFrame({'block': [min(self.blocks)]})
+
+    def stored_blocks(self, table):
+        return set(self.blocks)
+
+    def load_strategy(self, columns, start_block, end_block):
+        return pd.DataFrame([{'block': block, **strategy_row()} for block in self.blocks])
+
+    def load_address_log(self, block):
+        return pd.DataFrame({'block': [block], 'user_address_list': [USERS]})
+
+
+def test_update_skips_stored_blocks_and_parks_failing_ones(workdir, monkeypatch):
+    reads = []
+
+    def build_user_position_frame(user_address_list, block):
+        reads.append(block)
+        # Block 300 always fails
+        return position_frame([1.0, np.nan if block == 300 else 1.0, 1.0], [2.0, 2.0, 2.0])
+
+    monkeypatch.setattr(utils, 'build_user_position_frame', build_user_position_frame)
+    backend = FakeBackend([100, 200, 300])
+
+    assert ltvhistory.update_user_ltv_history(limit=10, backend=backend) == [100, 200]
+    assert ltvhistory.stored_blocks() == {100, 200}
+
+    # The stored blocks are not read again, the failing one until it runs out of attempts
+    reads.clear()
+    for _ in range(const.GAP_MAX_ATTEMPTS + 2):
+        assert ltvhistory.update_user_ltv_history(limit=10, backend=backend) == []
+    assert reads == [300] * (const.GAP_MAX_ATTEMPTS - 1)
+    assert gaps.is_parked(gaps.load_retry_queue(), 'user_ltv', 300, names=[ltvhistory.RETRY_NAME])
@@ -0,0 +1,35 @@
+import standin
+
+
+def rate_limit_decisions(faults, requests=200):
+    return [faults.is_rate_limited('/rpc/a') for _ in range(requests)]
+
+
+def test_rate_limit_is_drawn_from_the_seed_and_the_request_count():
+    decisions = rate_limit_decisions(standin.Faults(rate_limit_rate=0.25, seed=7))
+
+    assert decisions == rate_limit_decisions(standin.Faults(rate_limit_rate=0.25, seed=7))
+    assert decisions != rate_limit_decisions(standin.Faults(rate_limit_rate=0.25, seed=8))
+    assert 0.15 < sum(decisions) / len(decisions) < 0.35
+    assert not any(rate_limit_decisions(standin.Faults()))
+
+
+def test_retried_request_gets_a_new_draw():
+    faults = standin.Faults(error_rate=0.5, seed=1)
+    key = ('POST', '/rpc/a', '', standin._hash(b'{"method": "eth_call"}'))
+
+    decisions = [faults.is_error(key) for _ in range(50)]
+
+    # The same retries fail alike in another run, while the retries of one run are not all answered alike
+    replay = standin.Faults(error_rate=0.5, seed=1)
+    assert decisions == [replay.is_error(key) for _ in range(50)]
+    assert len(set(decisions)) == 2
+
+
+def test_occurrences_are_bounded():
+    faults = standin.Faults(revert_rate=0.5, memory=100)
+
+    for i in range(1000):
+        faults.is_revert(('0x' + '00' * 20, standin._hash(i.to_bytes(32, 'big')), 19000000))
+
+    assert len(faults.occurrences) == 100
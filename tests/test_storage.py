@@ -0,0 +1,157 @@
+import os
+import pandas as pd
+import pytest
+import addresses
+import blocktime
+import const
+import storage
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STRATEGY_CSV = os.path.join(REPO, const.STRATEGY_CSV)
+PPS_CSV = os.path.join(REPO, const.PPS_CSV)
+
+USDC = const.STRATEGY_NAME[0]
+A, B, C = ('0x' + digit * 40 for digit in 'abc')
+
+
+@pytest.fixture(params=['parquet', 'sqlite'])
+def backend(request, tmp_path, monkeypatch):
+    # The Parquet address log is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    if request.param == 'parquet':
+        return storage.ParquetBackend(root=str(tmp_path / 'data'))
+    return storage.SqliteBackend(path=str(tmp_path / 'sturdy.sqlite'),
+                                 block_times=blocktime.BlockTimestampCache(str(tmp_path / 'block_times.sqlite')))
+
+
+def test_csv_round_trip(backend):
+    storage.migrate_from_csv(backend, strategy_csv=STRATEGY_CSV, pps_csv=PPS_CSV)
+    strategy = pd.read_csv(STRATEGY_CSV)
+    pps = pd.read_csv(PPS_CSV)
+
+    loaded = backend.load_strategy()
+    assert loaded['block'].tolist() == sorted(strategy['block'])
+    assert loaded['time'].tolist() == pd.to_datetime(strategy['time']).tolist()
+    for column in (f'totalAsset{USDC}', f'maxLTV{USDC}', f'collateralSymbol{USDC}'):
+        pd.testing.assert_series_equal(loaded[column], strategy[column], check_dtype=False)
+
+    loaded_pps = backend.load_pps()
+    assert list(loaded_pps.columns) == list(pps.columns)
+    # The rounded floats of the CSV are stored as the nearest integer
+    pd.testing.assert_frame_equal(loaded_pps, pps.round(), check_dtype=False)
+
+    assert backend.latest_block() == strategy['block'].max()
+    assert backend.latest_block('pps') == pps['block'].max()
+    assert not backend.is_empty()
+
+
+def test_load_selects_the_columns_and_the_block_range(backend):
+    storage.migrate_from_csv(backend, strategy_csv=STRATEGY_CSV, pps_csv=PPS_CSV)
+    blocks = sorted(pd.read_csv(STRATEGY_CSV)['block'])
+    start_block, end_block = blocks[100], blocks[199]
+
+    loaded = backend.load_strategy(columns=[f'totalBorrow{USDC}'], start_block=start_block, end_block=end_block)
+
+    assert list(loaded.columns) == ['block', f'totalBorrow{USDC}']
+    assert loaded['block'].tolist() == blocks[100:200]
+    assert backend.stored_blocks('strategy') == set(blocks)
+
+
+def test_rewritten_block_keeps_the_latest_write(backend):
+    pps = pd.read_csv(PPS_CSV).head(20)
+    backend.append_pps(pps)
+    if isinstance(backend, storage.ParquetBackend):
+        backend.compact('pps')
+
+    # A re-fill of the first block, its partition name sorts before the compacted one covering it
+    backend.append_pps(pps.iloc[[0]].assign(**{f'pps{USDC}': 7e18}))
+
+    loaded = backend.load_pps()
+    assert loaded['block'].tolist() == pps['block'].tolist()
+    assert loaded.loc[0, f'pps{USDC}'] == 7e18
+    assert loaded.loc[1, f'pps{USDC}'] == round(pps.loc[1, f'pps{USDC}'])
+
+
+def test_address_log_round_trip(backend):
+    assert backend.load_address_log().empty
+
+    backend.append_address_log(100, [A, B])
+    backend.append_address_log(200, [B.upper().replace('0X', '0x'), C])
+    backend.append_address_log(300, [C])
+
+    assert backend.has_address_log()
+    assert backend.load_address_log(99).empty
+    assert backend.load_address_log(150)['user_address_list'].iloc[0] == [A, B]
+    assert backend.load_address_log(250)['user_address_list'].iloc[0] == [B, C]
+    latest = backend.load_address_log()
+    assert latest['block'].iloc[0] == 300
+    assert latest['user_address_list'].iloc[0] == [C]
+
+
+def test_compact_merges_into_one_partition(tmp_path):
+    backend = storage.ParquetBackend(root=str(tmp_path / 'data'))
+    pps = pd.read_csv(PPS_CSV).head(30)
+    for rows in (pps.iloc[:10], pps.iloc[10:20], pps.iloc[20:]):
+        backend.append_pps(rows)
+
+    backend.compact('pps')
+
+    assert all(len(backend.partitions('pps', name)) == 1 for name in const.STRATEGY_NAME)
+    pd.testing.assert_frame_equal(backend.load_pps(), pps.round(), check_dtype=False)
+
+
+def test_failed_compaction_keeps_the_partitions(tmp_path, monkeypatch):
+    backend = storage.ParquetBackend(root=str(tmp_path / 'data'))
+    pps = pd.read_csv(PPS_CSV).head(20)
+    backend.append_pps(pps.iloc[:10])
+    backend.append_pps(pps.iloc[10:])
+
+    def full_disk(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(storage.pq, 'write_table', full_disk)
+    with pytest.raises(OSError):
+        backend.compact('pps')
+
+    assert len(backend.partitions('pps', USDC)) == 2
+    pd.testing.assert_frame_equal(backend.load_pps(), pps.round(), check_dtype=False)
+
+
+def test_address_snapshots_are_appended_as_partitions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(const, 'PARQUET_MAX_PARTITIONS', 4)
+    backend = storage.ParquetBackend(root=str(tmp_path / 'data'))
+    sets = [[A], [A, B], [B], [B, C], [C], [A, C]]
+
+    backend.append_address_log(100, sets[0])
+    first_partition = backend.address_log_partitions()[0][2]
+    written_at = os.stat(first_partition).st_mtime_ns
+    for block, address_set in enumerate(sets[1:4], start=2):
+        backend.append_address_log(block * 100, address_set)
+
+    # The stored snapshots are left as they are
+    assert len(backend.address_log_partitions()) == 4
+    assert os.stat(first_partition).st_mtime_ns == written_at
+
+    for block, address_set in enumerate(sets[4:], start=5):
+        backend.append_address_log(block * 100, address_set)
+
+    # Compacted once past the limit, every snapshot is kept
+    assert len(backend.address_log_partitions()) < 4
+    assert backend.load_address_snapshots()['block'].tolist() == [100, 200, 300, 400, 500, 600]
+    for block, address_set in enumerate(sets, start=1):
+        assert set(backend.load_address_log(block * 100)['user_address_list'].iloc[0]) == set(address_set)
+
+
+def test_single_file_address_log_is_migrated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    snapshots = pd.DataFrame({'block': [100, 200], 'base': [True, False],
+                              'added': [addresses.pack([A, B]), addresses.pack([C])],
+                              'removed': [b'', addresses.pack([A])]})
+    storage.pq.write_table(storage.pa.Table.from_pandas(snapshots, schema=storage.ADDRESS_SNAPSHOT_SCHEMA,
+                                                        preserve_index=False), const.ADDRESS_LOG_FILE)
+    backend = storage.ParquetBackend(root=str(tmp_path / 'data'))
+
+    assert backend.load_address_log()['user_address_list'].iloc[0] == [B, C]
+    assert not os.path.exists(const.ADDRESS_LOG_FILE)
+    assert len(backend.address_log_partitions()) == 1
@@ -0,0 +1,217 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import const
+import storage
+import telemetry
+import utils
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECONDS_PER_YEAR = 365.2425 * utils.SECONDS_PER_DAY
+APY = 0.05
+
+
+def pps_frame(times, names=const.STRATEGY_NAME):
+    # Every pps grows at a constant APY, the APR of every window is then the same
+    seconds = (times - times[0]).total_seconds().to_numpy()
+    columns = {'block': np.arange(len(times)) * const.BLOCK_INTERVAL, 'time': times}
+    for name in names:
+        columns[f'pps{name}'] = 1e18 * (1 + APY) ** (seconds / SECONDS_PER_YEAR)
+    return pd.DataFrame(columns)
+
+
+def expected_apr(apy=APY):
+    return utils.APR_COMPOUNDING * ((1 + apy) ** (1 / utils.APR_COMPOUNDING) - 1)
+
+
+def reference_apr(df, column, window):
+    # Row by row: the latest timestamped sample at or before the lookback, within the tolerance
+    values, aprs = df[column].to_numpy() / 1e18, []
+    times = (df['time'] - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+    for i, time in enumerate(times):
+        target = time - window * utils.SECONDS_PER_DAY
+        candidates = [j for j in range(len(times)) if times[j] <= target]
+        if np.isnan(time) or not candidates or target - times[candidates[-1]] > const.APR_WINDOW_TOLERANCE:
+            aprs.append(np.nan)
+            continue
+        lag = candidates[-1]
+        apy = (values[i] / values[lag]) ** (365.2425 * utils.SECONDS_PER_DAY / (time - times[lag])) - 1
+        aprs.append(utils.APR_COMPOUNDING * ((apy + 1) ** (1 / utils.APR_COMPOUNDING)) - utils.APR_COMPOUNDING)
+    return np.array(aprs)
+
+
+def test_process_dataframe_annualizes_every_window():
+    df = pps_frame(pd.date_range('2024-01-01', periods=6 * 120, freq='4h'))
+
+    processed = utils.process_dataframe(df)
+
+    name = const.STRATEGY_NAME[0]
+    assert processed[f'pps{name}'].iloc[-1] == pytest.approx(df[f'pps{name}'].iloc[-1] / 1e18)
+    for window in const.APR_WINDOWS:
+        apr = processed[utils.apr_column(f'pps{name}', window)]
+        # Empty until the history covers the window
+        assert apr.iloc[:6 * window].isna().all()
+        np.testing.assert_allclose(apr.iloc[6 * window:], expected_apr(), rtol=1e-9)
+
+
+def test_process_dataframe_matches_a_row_by_row_lookup():
+    # Irregular sample times, with a two week hole in the history
+    rng = np.random.default_rng(3)
+    offsets = np.cumsum(rng.uniform(1, 8, size=700)) * 3600
+    offsets = offsets[(offsets < 40 * utils.SECONDS_PER_DAY) | (offsets > 54 * utils.SECONDS_PER_DAY)]
+    df = pps_frame(pd.Timestamp('2024-01-01') + pd.to_timedelta(offsets, unit='s'))
+    name = const.STRATEGY_NAME[-1]
+    df[f'pps{name}'] *= 1 + rng.normal(scale=1e-4, size=len(df))
+
+    processed = utils.process_dataframe(df)
+
+    for window in const.APR_WINDOWS:
+        np.testing.assert_allclose(processed[utils.apr_column(f'pps{name}', window)],
+                                   reference_apr(df, f'pps{name}', window), rtol=1e-9)
+
+
+def test_process_dataframe_counts_the_gaps():
+    df = pps_frame(pd.date_range('2024-01-01', periods=6 * 60, freq='4h'))
+    # Three days without a sample, 7 days before the last rows
+    df = df[~df['time'].between(pd.Timestamp('2024-02-20'), pd.Timestamp('2024-02-23'))]
+    telemetry.reset()
+
+    processed = utils.process_dataframe(df, windows=[7])
+
+    gaps = processed[utils.apr_column(f'pps{const.STRATEGY_NAME[0]}', 7)].iloc[6 * 7:].isna().sum()
+    assert gaps > 0
+    assert telemetry.snapshot()['counters']['apr_gap_rows_7d'] == gaps
+
+
+def test_process_dataframe_without_timestamps():
+    df = pps_frame(pd.date_range('2024-01-01', periods=100, freq='4h')).assign(time=pd.NaT)
+
+    processed = utils.process_dataframe(df)
+
+    assert len(processed) == 100
+    for window in const.APR_WINDOWS:
+        assert processed[utils.apr_column(f'pps{const.STRATEGY_NAME[0]}', window)].isna().all()
+
+
+def silo_frame(blocks, times, names=const.STRATEGY_NAME):
+    columns = {'block': blocks, 'time': times}
+    for i, name in enumerate(names):
+        columns.update({f'totalAsset{name}': 1000.0 * (i + 1), f'totalBorrow{name}': 250.0 * (i + 1),
+                        f'newCurrentRateInfo{name}': 1e18 * 0.1 / 31536000, f'feeToProtocolRate{name}': 10000,
+                        f'lowExchangeRate{name}': 0.9, f'highExchangeRate{name}': 1.1,
+                        f'virtualPrice{name}': 1.0, f'maxLTV{name}': 85.0})
+    return pd.DataFrame(columns)
+
+
+def test_compute_master_data():
+    pps = pps_frame(pd.date_range('2024-01-01', periods=6 * 100, freq='4h'))
+    silo = silo_frame(pps['block'], pps['time'])
+
+    master_data = utils.compute_master_data(utils.process_dataframe(pps), silo)
+
+    assert list(master_data.columns) == utils.master_data_output_columns()
+    last = master_data.iloc[-1]
+    for i, name in enumerate(const.STRATEGY_NAME):
+        assert last[f'reserveSize{name}'] == 1000.0 * (i + 1)
+        assert last[f'utilization{name}'] == pytest.approx(0.25)
+        assert last[f'borrowApy_{name}'] == pytest.approx(0.1)
+        assert last[f'supplyApy_{name}'] == pytest.approx(0.1 * 0.9 * 0.25)
+        assert last[f'collateralApr_{name}'] == pytest.approx(expected_apr())
+        assert last[f'spread{name}'] == pytest.approx(expected_apr() - 0.1)
+        assert last[f'oracleNormalized{name}'] == pytest.approx(0.9 * pps[f'pps{name}'].iloc[-1] / 1e18)
+    # The APR is missing before the 30 day lookback, and so is the spread
+    assert master_data[f'spread{const.STRATEGY_NAME[0]}'].iloc[:6 * 30].isna().all()
+
+
+@pytest.fixture
+def csv_backend(tmp_path, monkeypatch):
+    # A Parquet store of the CSV history in the temporary directory, read through the storage of utils
+    monkeypatch.chdir(tmp_path)
+    backend = storage.ParquetBackend(root=str(tmp_path / 'data'))
+    monkeypatch.setattr(storage, 'get_backend', lambda name=None: backend)
+    # Block times without the RPC, one block per slot
+    monkeypatch.setattr(utils, 'add_block_time', lambda df, workers=None: df.assign(
+        time=pd.to_datetime(1700000000 + (df['block'] - const.BLOCK_START) * const.BLOCK_TIME, unit='s')))
+    return backend
+
+
+def test_incremental_master_data_matches_a_full_recompute(csv_backend, monkeypatch):
+    computed_rows = []
+    compute_master_data = utils.compute_master_data
+
+    def counted_compute_master_data(pps_df, silo_df):
+        computed_rows.append(len(silo_df))
+        return compute_master_data(pps_df, silo_df)
+
+    monkeypatch.setattr(utils, 'compute_master_data', counted_compute_master_data)
+    strategy = pd.read_csv(os.path.join(REPO, const.STRATEGY_CSV))
+    pps = pd.read_csv(os.path.join(REPO, const.PPS_CSV))
+    cutoffs = np.quantile(strategy['block'], [0.5, 0.8]).astype(int)
+
+    for start_block, end_block in zip([None, *cutoffs + 1], [*cutoffs, None]):
+        csv_backend.append_strategy(storage._select_block_range(strategy, start_block, end_block))
+        csv_backend.append_pps(storage._select_block_range(pps, start_block, end_block))
+        incremental = utils.update_master_data('incremental.csv', incremental=True)
+        assert incremental['block'].max() == csv_backend.latest_block()
+        # Only the rows of the new blocks are computed once the table exists
+        assert computed_rows[-1] == len(storage._select_block_range(strategy, start_block, end_block))
+
+    full = utils.update_master_data('full.csv', incremental=False)
+
+    assert len(full) == len(csv_backend.load_strategy(columns=['block']))
+    pd.testing.assert_frame_equal(utils.load_master_data('incremental.csv'), utils.load_master_data('full.csv'))
+
+
+def test_recompute_from_replaces_the_rows_of_a_filled_gap(csv_backend):
+    strategy = pd.read_csv(os.path.join(REPO, const.STRATEGY_CSV))
+    csv_backend.append_strategy(strategy)
+    csv_backend.append_pps(pd.read_csv(os.path.join(REPO, const.PPS_CSV)))
+    utils.update_master_data('master.csv')
+
+    # A re-fetched block changes the reserve of a strategy
+    block = int(strategy['block'].iloc[-10])
+    name = const.STRATEGY_NAME[0]
+    csv_backend.append_strategy(strategy[strategy['block'] == block].assign(**{f'totalAsset{name}': 123.0}))
+
+    assert utils.update_master_data('master.csv')[f'reserveSize{name}'].eq(123.0).sum() == 0
+    master_data = utils.update_master_data('master.csv', recompute_from=block)
+    assert master_data.loc[master_data['block'] == block, f'reserveSize{name}'].tolist() == [123.0]
+    pd.testing.assert_frame_equal(utils.load_master_data('master.csv'),
+                                  utils.update_master_data('full.csv', incremental=False))
+
+
+def test_block_snapshot_reads_the_pair_of_the_block(monkeypatch):
+    strategy, oracle, pool, vault = ('0x' + digit * 40 for digit in '1234')
+    latest_pair, old_pair = '0x' + '5' * 40, '0x' + '6' * 40
+    rates = {latest_pair: 1, old_pair: 2}
+    batches = []
+
+    def aggregate3(calls, block):
+        batches.append([(target, fn.name) for target, _, fn in calls])
+        outputs = {'getStrategy': lambda target: (strategy, old_pair, tuple(range(20))),
+                   'getPrices': lambda target: (0, 10 ** 18),
+                   'previewAddInterest': lambda target: (0, 0, 0, (0, 0, 0, rates[target])),
+                   'currentRateInfo': lambda target: (0, rates[target] * 1000),
+                   'get_virtual_price': lambda target: 10 ** 18,
+                   'pricePerShare': lambda target: 2 * 10 ** 18}
+        return [(True, outputs[fn.name](target)) for target, _, fn in calls]
+
+    monkeypatch.setattr(utils.multicall, 'aggregate3', aggregate3)
+    monkeypatch.setattr(utils, 'get_strategy_pair', lambda strategy_address, data_provider_contract: latest_pair)
+
+    [strategy_row], [pps_row] = utils.get_block_snapshot(100, strategy_list=[strategy], oracle_list=[oracle],
+                                                         pool_address_list=[pool], collateral_list=[vault])
+
+    # Only the pair calls are sent again, to the pair of the block
+    assert batches[1] == [(old_pair, 'previewAddInterest'), (old_pair, 'currentRateInfo')]
+    assert strategy_row['newCurrentRateInfo'] == 2
+    assert strategy_row['feeToProtocolRate'] == 2000
+    assert pps_row == {'block': 100, 'pps': 2 * 10 ** 18}
+
+    # The same pair as the latest block needs a single batch
+    batches.clear()
+    monkeypatch.setattr(utils, 'get_strategy_pair', lambda strategy_address, data_provider_contract: old_pair)
+    utils.get_block_snapshot(100, strategy_list=[strategy], oracle_list=[oracle], pool_address_list=[pool],
+                             collateral_list=[vault])
+    assert len(batches) == 1
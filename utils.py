@@ -1,154 +1,106 @@
-from web3 import Web3, HTTPProvider
+from web3 import Web3
 import const
 import pandas as pd
-from requests import get, post
-import time
+import numpy as np
 import datetime
 import streamlit as st
 import os
-import random
 import ast
-
-#### INFURA
-
-# Get the keys from the environment variable
-INFURA_KEYS = os.environ.get("INFURA_KEYS")
-
-if INFURA_KEYS is None:
-    raise ValueError("INFURA_KEYS is not set")
-
-# Split the keys into a list
-INFURA_KEYS_LIST = INFURA_KEYS.split(',')
-
-# Select a key at random
-INFURA_KEY = random.choice(INFURA_KEYS_LIST)
-
-#### DUNE
-
-# Get the keys from the environment variable
-DUNE_KEYS = os.environ.get("DUNE_KEYS")
-
-if DUNE_KEYS is None:
-    raise ValueError("DUNE_KEYS is not set")
-
-# Split the keys into a list
-DUNE_KEYS_LIST = DUNE_KEYS.split(',')
-
-# Select a key at random
-DUNE_API_KEY = random.choice(DUNE_KEYS_LIST)
-
-HEADER = {"x-dune-api-key": DUNE_API_KEY}
-
+import multicall
+import concurrency
+import storage
+import blocktime
+import clients
+import dune
+import contracts
+import telemetry
 
 #######################################################################################################################
 # Functions to fetch data from Dune
 #######################################################################################################################
 
-# Use this function to generate a URL to call the API.
-def make_api_url(module, action, ID):
-    url = "https://api.dune.com/api/v1/" + module + "/" + ID + "/" + action
-    return url
-
-
-# Takes in the query ID and engine size (default - "medium").
-# Returns the execution ID of the instance which is executing the query.
-def execute_query(query_id, engine="free"):
-    url = make_api_url("query", "execute", query_id)
-    params = {
-        "performance": engine,
-    }
-    response = post(url, headers=HEADER, params=params)
-    execution_id = response.json()['execution_id']
-    return execution_id
-
-
-# Takes in an execution ID from the above function.
-# Returns the status response object.
-def get_query_status(execution_id):
-    url = make_api_url("execution", "status", execution_id)
-    response = get(url, headers=HEADER)
-    return response
-
-
-# Takes in an execution ID from the above function.
-# Returns the results response object
-def get_query_results(execution_id):
-    url = make_api_url("execution", "results", execution_id)
-    response = get(url, headers=HEADER)
-    return response
-
+@telemetry.timed()
+def execute_query_and_get_addresses(query_id, engine="free"):
+    # The latest result is used when it is recent enough, the query is only executed otherwise
+    return dune.get_addresses(query_id, engine)
 
-# Takes in an execution ID from the above function.
-# Cancels the ongoing execution of the query. Returns the response object.
-def cancel_query_execution(execution_id):
-    url = make_api_url("execution", "cancel", execution_id)
-    response = get(url, headers=HEADER)
-    return response
 
+#######################################################################################################################
 
-def execute_query_and_get_addresses(query_id, engine="free"):
-    # Execute query
-    execution_id = execute_query(query_id, engine)
+# Pair events that change the lending, borrowing or collateral position of an account. Every indexed address of these
+# events is an account to re-read
+PAIR_USER_EVENTS = [
+    'AddCollateral(address,address,uint256)',
+    'RemoveCollateral(address,uint256,address,address)',
+    'BorrowAsset(address,address,uint256,uint256)',
+    'RepayAsset(address,address,uint256,uint256)',
+    'Liquidate(address,uint256,uint256,uint256,uint256,uint256,uint256)',
+    'LeveragedPosition(address,address,uint256,uint256,uint256,uint256)',
+    'RepayAssetWithCollateral(address,address,uint256,uint256,uint256)',
+    'Deposit(address,address,uint256,uint256)',
+    'Withdraw(address,address,address,uint256,uint256)',
+    'Transfer(address,address,uint256)'
+]
+PAIR_USER_EVENT_TOPICS = [Web3.to_hex(Web3.keccak(text=event)) for event in PAIR_USER_EVENTS]
+
+
+def get_user_position(user_address, data_provider_address=const.DATA_PROVIDER, block='latest'):
+    # Shared contract instance for the data provider
+    data_provider_contract = contracts.get_contract(data_provider_address, 'getUserPositions')
+
+    data = data_provider_contract.functions.getUserPositions(contracts.to_checksum_address(user_address)).call(
+        block_identifier=block)
 
-    # # Get query status
-    # response = get_query_status(execution_id)
+    return data
 
-    response = get_query_results(execution_id)
-    res_json = response.json()
 
-    # Check if the query execution is completed
-    while res_json['state'] != 'QUERY_STATE_COMPLETED':
-        # Pause for a short while before checking again
-        time.sleep(1)
-        res_json = get_query_results(execution_id).json()
+@telemetry.timed()
+def get_user_positions(user_address_list, block, data_provider_address=const.DATA_PROVIDER,
+                       batch_size=const.USER_SCAN_BATCH_SIZE, workers=const.USER_SCAN_WORKERS):
+    """
+    Reads getUserPositions for every address, packing batch_size calls per aggregate3 and running the batches
+    concurrently.
 
-    # Extract addresses from the response
-    addresses = [row['address'] for row in res_json['result']['rows']]
+    Parameters:
+    user_address_list (list): The user addresses.
+    block (int): The block every position is read at, so that all the batches see the same state.
+    data_provider_address (str): The aggregator data provider address.
+    batch_size (int): The number of getUserPositions calls per aggregate3 call.
+    workers (int): The maximum number of batches in flight.
 
-    return addresses
+    Returns:
+    list: The getUserPositions result of every address, in order. None when the call failed.
+    """
+    if not const.MULTICALL_BATCHING:
+        def fetch_position(user_address):
+            return get_user_position(user_address, data_provider_address, int(block))
 
+        return concurrency.map_blocks(fetch_position, user_address_list, workers)
 
-#######################################################################################################################
+    def fetch_batch(start):
+        calls = [multicall.encode_call(data_provider_address, 'getUserPositions', [user_address])
+                 for user_address in user_address_list[start:start + batch_size]]
+        return [value for _, value in multicall.aggregate3(calls, block)]
 
-# w3 = Web3(HTTPProvider(f"https://eth-mainnet.g.alchemy.com/v2/{ALCHEMY_KEY}"))
-w3 = Web3(HTTPProvider(f"https://mainnet.infura.io/v3/{INFURA_KEY}"))
-
-
-def get_user_position(user_address, data_provider_address=const.DATA_PROVIDER):
-    # Convert data_provider_address to checksum format
-    data_provider_address = Web3.to_checksum_address(data_provider_address)
-    abi = [{"inputs": [{"internalType": "address", "name": "user", "type": "address"}], "name": "getUserPositions",
-            "outputs": [{"components": [{"components": [{"internalType": "address", "name": "vault", "type": "address"},
-                                                        {"internalType": "uint256", "name": "balance",
-                                                         "type": "uint256"}],
-                                         "internalType": "struct IAggregatorDataProvider.UserVaultData[]",
-                                         "name": "userVaultData", "type": "tuple[]"}, {"components": [
-                {"internalType": "address", "name": "strategy", "type": "address"},
-                {"internalType": "uint256", "name": "assetBalance", "type": "uint256"},
-                {"internalType": "uint256", "name": "borrowBalance", "type": "uint256"},
-                {"internalType": "uint256", "name": "collateralBalance", "type": "uint256"}],
-                                            "internalType": "struct IAggregatorDataProvider.UserStrategyData[]",
-                                            "name": "userStrategyData",
-                                            "type": "tuple[]"}],
-                         "internalType": "struct IAggregatorDataProvider.AggregatedUserData", "name": "arg_0",
-                         "type": "tuple"}], "stateMutability": "view", "type": "function"}]
-
-    # Instantiate the contract
-    data_provider_contract = w3.eth.contract(address=data_provider_address, abi=abi)
-
-    data = data_provider_contract.functions.getUserPositions(Web3.to_checksum_address(user_address)).call()
+    # A batch whose aggregate3 call failed leaves all of its users as None
+    positions = []
+    for start, batch in zip(range(0, len(user_address_list), batch_size),
+                            concurrency.map_blocks(fetch_batch, range(0, len(user_address_list), batch_size),
+                                                   workers)):
+        positions += batch if batch is not None else [None] * len(user_address_list[start:start + batch_size])
 
-    return data
+    return positions
 
 
-def update_and_save_address_list(loaded_address_log, triggered_block, file_path='address_log.csv'):
+@telemetry.timed()
+def update_and_save_address_list(loaded_address_log, triggered_block, user_address_list=None):
     """
-    Updates the address log DataFrame with a new row and saves it to a CSV file.
+    Updates the address log DataFrame with a new row and saves it to the storage backend.
 
     Parameters:
     loaded_address_log (DataFrame): The original address log DataFrame.
     triggered_block (int): The block to be added to the DataFrame.
-    file_path (str): The path of the CSV file to save the updated DataFrame to.
+    user_address_list (list): The addresses of a Dune refresh already done, the query is executed when None.
 
     Returns:
     DataFrame: The updated address log DataFrame.
@@ -159,7 +111,8 @@ def update_and_save_address_list(loaded_address_log, triggered_block, file_path=
     try:
         address_log_df = loaded_address_log.copy()
 
-        user_address_list = execute_query_and_get_addresses(const.QUERY_ID)
+        if user_address_list is None:
+            user_address_list = execute_query_and_get_addresses(const.QUERY_ID)
 
         # Creating a new DataFrame with the new data
         new_row = pd.DataFrame({'block': [triggered_block], 'user_address_list': [user_address_list]})
@@ -167,7 +120,7 @@ def update_and_save_address_list(loaded_address_log, triggered_block, file_path=
         # Concatenating the new row with the existing DataFrame
         address_log_df = pd.concat([address_log_df, new_row], ignore_index=True)
 
-        address_log_df.to_csv(file_path, index=False)
+        storage.get_backend().append_address_log(triggered_block, user_address_list)
 
         return address_log_df
     except Exception as e:
@@ -176,7 +129,8 @@ def update_and_save_address_list(loaded_address_log, triggered_block, file_path=
 
 
 
-def get_user_position_data(user_address_df):
+@telemetry.timed()
+def get_user_position_data(user_address_df, block=None):
 
     # Find the maximum value in the "block" column
     max_block_value = user_address_df['block'].max()
@@ -186,70 +140,154 @@ def get_user_position_data(user_address_df):
 
     user_address_list = max_block_row['user_address_list'].iloc[0]
 
-    # Convert the string back to a list
-    user_address_list = ast.literal_eval(user_address_list)
+    # Convert the string back to a list, a row appended in this process still holds the list itself
+    if isinstance(user_address_list, str):
+        user_address_list = ast.literal_eval(user_address_list)
 
     #  user_address_list = execute_query_and_get_addresses(const.QUERY_ID)
+    if block is None:
+        block = clients.get_web3().eth.block_number
+
+    return build_user_position_frame(user_address_list, block)
+
+
+@telemetry.timed()
+def build_user_position_frame(user_address_list, block):
     data_name = ['assetBalance', 'borrowBalance', 'collateralBalance']
-    column_name = ['user']
 
+    positions = get_user_positions(user_address_list, block)
+
+    # Preallocated columns, filled in place. A user whose call failed keeps NaN balances
+    values = np.full((len(user_address_list), len(const.STRATEGY_NAME), len(data_name)), np.nan)
+    for i, strategy_data in enumerate(positions):
+        if strategy_data is None:
+            continue
+        for j in range(len(const.STRATEGY_NAME)):
+            values[i, j] = strategy_data[1][j][1:4]
+
+    failed = sum(strategy_data is None for strategy_data in positions)
+    if failed:
+        telemetry.count('user_position_failures', failed)
+        telemetry.log('user_positions_failed', block=block, failed=failed, users=len(positions))
+
+    columns = {'user': list(user_address_list)}
     for i in range(len(const.STRATEGY_NAME)):
         for j in range(len(data_name)):
-            column_name.append(f'{const.STRATEGY_NAME[i]}_{data_name[j]}')
-
-    df = pd.DataFrame(columns=column_name)
-
-    for i in range(len(user_address_list)):
-        # Call the getStrategy function with the provided strategy address and block number
-        strategy_data = get_user_position(user_address_list[i])
-        # Create a new row for each user
-        df.loc[i] = [
-            user_address_list[i],
-            strategy_data[1][0][1] / 1e18, strategy_data[1][0][2] / 1e18, strategy_data[1][0][3] / 1e18,
-            strategy_data[1][1][1] / 1e18, strategy_data[1][1][2] / 1e18, strategy_data[1][1][3] / 1e18,
-            strategy_data[1][2][1] / 1e18, strategy_data[1][2][2] / 1e18, strategy_data[1][2][3] / 1e18,
-            strategy_data[1][3][1] / 1e18, strategy_data[1][3][2] / 1e18, strategy_data[1][3][3] / 1e18
-        ]
+            columns[f'{const.STRATEGY_NAME[i]}_{data_name[j]}'] = values[:, i, j] / 1e18
 
-    return df
+    return pd.DataFrame(columns)
 
 
-def get_price_low(oracle_address, block=w3.eth.block_number):
-    abi = [{"inputs": [], "name": "getPrices",
-            "outputs": [{"internalType": "bool", "name": "_isBadData", "type": "bool"},
-                        {"internalType": "uint256", "name": "_priceLow", "type": "uint256"},
-                        {"internalType": "uint256", "name": "_priceHigh", "type": "uint256"}],
-            "stateMutability": "view", "type": "function"}]
-    address = Web3.to_checksum_address(oracle_address)
+@telemetry.timed()
+def get_pair_event_addresses(from_block, to_block, strategy_list=const.STRATEGY_LIST,
+                             block_range=const.USER_LOG_BLOCK_RANGE):
+    """
+    Collects the accounts touched by a position changing event of the strategy pairs.
 
-    contract = w3.eth.contract(address=address, abi=abi)
+    Parameters:
+    from_block (int): The first block to scan.
+    to_block (int): The last block to scan, included.
+    strategy_list (list): The strategies whose pairs are scanned.
+    block_range (int): The number of blocks per eth_getLogs request.
 
-    prices = contract.functions.getPrices().call(block_identifier=int(block))
+    Returns:
+    set: The lowercase addresses found in the indexed address topics of the events.
+    """
+    pair_addresses = [get_strategy_pair(strategy_address) for strategy_address in strategy_list]
+    # The protocol contracts show up in the topics of the Deposit and Transfer events, they hold no position
+    ignored = {'0x' + '00' * 20, const.DATA_PROVIDER.lower()} | {
+        address.lower() for address in pair_addresses + const.STRATEGY_LIST + const.COLLATERAL_LIST}
+
+    w3 = clients.get_web3()
+    addresses = set()
+    # Sequential on purpose, a failed range must fail the refresh rather than silently skip users
+    for start in range(int(from_block), int(to_block) + 1, block_range):
+        logs = w3.eth.get_logs({'fromBlock': start, 'toBlock': min(start + block_range - 1, int(to_block)),
+                                'address': pair_addresses, 'topics': [PAIR_USER_EVENT_TOPICS]})
+        for log in logs:
+            for topic in log['topics'][1:]:
+                addresses.add('0x' + Web3.to_hex(topic)[-40:].lower())
+
+    return addresses - ignored
+
+
+@telemetry.timed()
+def refresh_user_positions(user_position_df, user_address_df, from_block, to_block):
+    """
+    Updates a persisted position table with the users that changed since the last scan.
+
+    Parameters:
+    user_position_df (DataFrame): The position table of the last scan, as built by get_user_position_data.
+    user_address_df (DataFrame): The address log, the users of its latest row missing from the table are added.
+    from_block (int): The first block not covered by the last scan.
+    to_block (int): The block the positions are read at.
+
+    Returns:
+    DataFrame: The position table at to_block. Users touched by an event and not yet listed by Dune are included.
+    """
+    user_address_list = user_address_df.loc[user_address_df['block'] == user_address_df['block'].max(),
+                                            'user_address_list'].iloc[0]
+    if isinstance(user_address_list, str):
+        user_address_list = ast.literal_eval(user_address_list)
+
+    known_users = set(user_position_df['user'].str.lower())
+    changed_users = get_pair_event_addresses(from_block, to_block)
+    stale_users = changed_users | {user.lower() for user in user_address_list if user.lower() not in known_users}
+
+    telemetry.count('user_positions_refreshed', len(stale_users))
+    telemetry.log('user_positions_refresh', refreshed=len(stale_users), users=len(known_users | stale_users))
+    if not stale_users:
+        return user_position_df
+
+    refresh_list = [user for user in user_position_df['user'] if user.lower() in stale_users]
+    refresh_list += sorted(stale_users - known_users)
+    refreshed_df = build_user_position_frame(refresh_list, to_block)
+
+    # Users already in the table are updated in place and new ones appended. update() skips NaN, so a user whose
+    # call failed keeps its last known position
+    user_position_df = user_position_df.set_index(user_position_df['user'].str.lower())
+    refreshed_df = refreshed_df.set_index(refreshed_df['user'].str.lower())
+    user_position_df = pd.concat([user_position_df, refreshed_df[~refreshed_df.index.isin(user_position_df.index)]])
+    user_position_df.update(refreshed_df.drop(columns='user'))
+
+    return user_position_df.reset_index(drop=True)
+
+
+@telemetry.timed()
+def get_price_low(oracle_address, block=None):
+    contract = contracts.get_contract(oracle_address, 'getPrices')
+
+    # The default is resolved at call time, a default argument would be the block of the module import
+    prices = contract.functions.getPrices().call(block_identifier='latest' if block is None else int(block))
 
     price_low = prices[1] / 1e18
 
     return price_low
 
 
-def get_virtual_price(pool_address, block=w3.eth.block_number):
-    abi = [{"stateMutability": "view",
-            "type": "function",
-            "name": "get_virtual_price",
-            "inputs": [],
-            "outputs": [{"name": "arg_0", "type": "uint256"}]}]
-    address = Web3.to_checksum_address(pool_address)
+@telemetry.timed()
+def get_virtual_price(pool_address, block=None):
+    contract = contracts.get_contract(pool_address, 'get_virtual_price')
 
-    contract = w3.eth.contract(address=address, abi=abi)
-
-    prices = contract.functions.get_virtual_price().call(block_identifier=int(block))
+    prices = contract.functions.get_virtual_price().call(block_identifier='latest' if block is None else int(block))
 
     virtual_price = prices / 1e18
 
     return virtual_price
 
 
-def compute_user_ltv(sturdy_data_strategy_file, user_address_df, oracle_address_list=const.ORACLE_ADDRESS_LIST):
-    user_position_df = get_user_position_data(user_address_df)
+@telemetry.timed()
+def compute_user_ltv(sturdy_data_strategy_file, user_address_df, oracle_address_list=const.ORACLE_ADDRESS_LIST,
+                     block=None, user_position_df=None):
+    # The positions and the prices are read at the same block
+    if block is None:
+        block = clients.get_web3().eth.block_number
+
+    # A position table refreshed by refresh_user_positions skips the full scan
+    if user_position_df is None:
+        user_position_df = get_user_position_data(user_address_df, block)
+    else:
+        user_position_df = user_position_df.copy()
 
     # Find the maximum value in the "block" column
     max_block_value = sturdy_data_strategy_file['block'].max()
@@ -263,7 +301,7 @@ def compute_user_ltv(sturdy_data_strategy_file, user_address_df, oracle_address_
         max_ltv_col_name = f'maxLTV{const.STRATEGY_NAME[i]}'
         max_ltv = max_block_row[max_ltv_col_name].iloc[0]
 
-        price_low = get_price_low(const.ORACLE_ADDRESS_LIST[i])
+        price_low = get_price_low(oracle_address_list[i], block)
 
         user_position_df[f'{const.STRATEGY_NAME[i]}_LTV'] = user_position_df[
                                                                 f'{const.STRATEGY_NAME[i]}_borrowBalance'] * price_low / \
@@ -277,7 +315,7 @@ def compute_user_ltv(sturdy_data_strategy_file, user_address_df, oracle_address_
 
 
 def accumulate_block_with_no_data(latest_block_with_data):
-    latest_block_number = w3.eth.block_number
+    latest_block_number = clients.get_web3().eth.block_number
     historic_block_list = []
 
     start_block_number = closest_lower_value(latest_block_with_data) + const.BLOCK_INTERVAL
@@ -307,35 +345,10 @@ def closest_lower_value(latest_block_with_data, starting_number=const.BLOCK_STAR
 
 
 # Strategy Pair Calls
+@telemetry.timed()
 def pair_call_interest(address, block):
-    # Convert the address to checksum format
-    pair_address = Web3.to_checksum_address(address)
-
-    # ABI for the pricePerShare function
-    function_abi = [{"inputs": [], "name": "previewAddInterest",
-                     "outputs": [{"internalType": "uint256", "name": "_interestEarned", "type": "uint256"},
-                                 {"internalType": "uint256", "name": "_feesAmount", "type": "uint256"},
-                                 {"internalType": "uint256", "name": "_feesShare", "type": "uint256"}, {
-                                     "components": [{"internalType": "uint32", "name": "lastBlock", "type": "uint32"},
-                                                    {"internalType": "uint32", "name": "feeToProtocolRate",
-                                                     "type": "uint32"},
-                                                    {"internalType": "uint64", "name": "lastTimestamp",
-                                                     "type": "uint64"},
-                                                    {"internalType": "uint64", "name": "ratePerSec", "type": "uint64"},
-                                                    {"internalType": "uint64", "name": "fullUtilizationRate",
-                                                     "type": "uint64"}],
-                                     "internalType": "struct SturdyPairCore.CurrentRateInfo",
-                                     "name": "_newCurrentRateInfo", "type": "tuple"}, {
-                                     "components": [{"internalType": "uint128", "name": "amount", "type": "uint128"},
-                                                    {"internalType": "uint128", "name": "shares", "type": "uint128"}],
-                                     "internalType": "struct VaultAccount", "name": "_totalAsset", "type": "tuple"}, {
-                                     "components": [{"internalType": "uint128", "name": "amount", "type": "uint128"},
-                                                    {"internalType": "uint128", "name": "shares", "type": "uint128"}],
-                                     "internalType": "struct VaultAccount", "name": "_totalBorrow", "type": "tuple"}],
-                     "stateMutability": "view", "type": "function"}]
-
     # Contract instance for the provided address and ABI
-    contract = w3.eth.contract(address=pair_address, abi=function_abi)
+    contract = contracts.get_contract(address, 'previewAddInterest')
 
     # Call the pricePerShare function with the provided block
     newCurrentRateInfo = contract.functions.previewAddInterest().call(block_identifier=int(block))
@@ -346,21 +359,10 @@ def pair_call_interest(address, block):
     return rate_per_sec
 
 
+@telemetry.timed()
 def pair_call_feerate(address, block):
-    # Convert the address to checksum format
-    pair_address = Web3.to_checksum_address(address)
-
-    # ABI for the currentRateInfo function
-    function_abi = [{"inputs": [], "name": "currentRateInfo",
-                     "outputs": [{"internalType": "uint32", "name": "lastBlock", "type": "uint32"},
-                                 {"internalType": "uint32", "name": "feeToProtocolRate", "type": "uint32"},
-                                 {"internalType": "uint64", "name": "lastTimestamp", "type": "uint64"},
-                                 {"internalType": "uint64", "name": "ratePerSec", "type": "uint64"},
-                                 {"internalType": "uint64", "name": "fullUtilizationRate", "type": "uint64"}],
-                     "stateMutability": "view", "type": "function"}]
-
     # Contract instance for the provided address and ABI
-    contract = w3.eth.contract(address=pair_address, abi=function_abi)
+    contract = contracts.get_contract(address, 'currentRateInfo')
 
     # Call the currentRateInfo function with the provided block
     current_rate_info = contract.functions.currentRateInfo().call(block_identifier=int(block))
@@ -395,68 +397,24 @@ def pair_call_feerate(address, block):
 
 
 # Data aggregator Calls
+@telemetry.timed()
 def get_strategy_data(strategy_address, oracle_address, pool_address, block_number,
                       data_provider_contract=const.DATA_PROVIDER):
-    # Convert the data provider address to checksum format
-    data_provider_address = Web3.to_checksum_address(data_provider_contract)
-
-    get_strategy_abi = [
-        {"inputs": [{"internalType": "address", "name": "_strategy", "type": "address"}], "name": "getStrategy",
-         "outputs": [{"components": [{"internalType": "address", "name": "deployedAt", "type": "address"},
-                                     {"internalType": "address", "name": "pair", "type": "address"}, {
-                                         "components": [{"internalType": "address", "name": "asset", "type": "address"},
-                                                        {"internalType": "string", "name": "assetSymbol",
-                                                         "type": "string"},
-                                                        {"internalType": "uint256", "name": "assetDecimals",
-                                                         "type": "uint256"},
-                                                        {"internalType": "address", "name": "collateral",
-                                                         "type": "address"},
-                                                        {"internalType": "string", "name": "collateralSymbol",
-                                                         "type": "string"},
-                                                        {"internalType": "uint256", "name": "collateralDecimals",
-                                                         "type": "uint256"},
-                                                        {"internalType": "address", "name": "rateContract",
-                                                         "type": "address"},
-                                                        {"internalType": "address", "name": "oracle",
-                                                         "type": "address"},
-                                                        {"internalType": "uint256", "name": "depositLimit",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint64", "name": "ratePerSec",
-                                                         "type": "uint64"},
-                                                        {"internalType": "uint64", "name": "fullUtilizationRate",
-                                                         "type": "uint64"},
-                                                        {"internalType": "uint32", "name": "feeToProtocolRate",
-                                                         "type": "uint32"},
-                                                        {"internalType": "uint32", "name": "maxOacleDeviation",
-                                                         "type": "uint32"},
-                                                        {"internalType": "uint256", "name": "lowExchangeRate",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "highExchangeRate",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "maxLTV",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "protocolLiquidationFee",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "totalAsset",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "totalCollateral",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "totalBorrow",
-                                                         "type": "uint256"},
-                                                        {"internalType": "uint256", "name": "version",
-                                                         "type": "uint256"}],
-                                         "internalType": "struct IAggregatorDataProvider.StrategyPairData",
-                                         "name": "pairData", "type": "tuple"}],
-                      "internalType": "struct IAggregatorDataProvider.StrategyData", "name": "arg_0", "type": "tuple"}],
-         "stateMutability": "view", "type": "function"}]
-
     # Contract instance for the data provider
-    data_provider_contract = w3.eth.contract(address=data_provider_address, abi=get_strategy_abi)
+    data_provider_contract = contracts.get_contract(data_provider_contract, 'getStrategy')
 
     # Call the getStrategy function with the provided strategy address and block number
     strategy_data = data_provider_contract.functions.getStrategy(strategy_address).call(
         block_identifier=int(block_number))
 
+    return build_strategy_row(block_number, strategy_data,
+                              get_price_low(oracle_address, block_number),
+                              pair_call_interest(strategy_data[1], int(block_number)),
+                              pair_call_feerate(strategy_data[1], int(block_number)),
+                              get_virtual_price(pool_address, block_number))
+
+
+def build_strategy_row(block_number, strategy_data, price_low, rate_per_sec, fee_to_protocol_rate, virtual_price):
     # Extract relevant data from the returned tuple
     data = {
         'block': int(block_number),
@@ -464,21 +422,29 @@ def get_strategy_data(strategy_address, oracle_address, pool_address, block_numb
         'collateralSymbol': strategy_data[2][4],
         'ratePerSec': strategy_data[2][9],
         'fullUtilizationRate': strategy_data[2][10],
-        'lowExchangeRate': get_price_low(oracle_address, block_number),
+        'lowExchangeRate': price_low,
         'highExchangeRate': strategy_data[2][14] / 1e18,
         'maxLTV': strategy_data[2][15] / 1e3,
         'totalAsset': strategy_data[2][17] / 1e18,
         'totalCollateral': strategy_data[2][18] / 1e18,
         'totalBorrow': strategy_data[2][19] / 1e18,
-        'newCurrentRateInfo': pair_call_interest(strategy_data[1], int(block_number)),
-        'feeToProtocolRate': pair_call_feerate(strategy_data[1], int(block_number)),
-        'virtualPrice': get_virtual_price(pool_address, block_number)
+        'newCurrentRateInfo': rate_per_sec,
+        'feeToProtocolRate': fee_to_protocol_rate,
+        'virtualPrice': virtual_price
     }
 
     return data
 
 
-def get_strategy_data_for_blocks(strategy_address, oracle_address, pool_address, block_numbers):
+@telemetry.timed()
+def get_strategy_data_for_blocks(strategy_address, oracle_address, pool_address, block_numbers,
+                                 workers=const.FETCH_WORKERS):
+    if workers > 1:
+        results = concurrency.map_blocks(
+            lambda block_number: get_strategy_data(strategy_address, oracle_address, pool_address,
+                                                   int(block_number)), block_numbers, workers)
+        return pd.DataFrame([result for result in results if result is not None])
+
     strategy_data_list = []
 
     for block_number in block_numbers:
@@ -486,20 +452,25 @@ def get_strategy_data_for_blocks(strategy_address, oracle_address, pool_address,
             strategy_data = get_strategy_data(strategy_address, oracle_address, pool_address, int(block_number))
             strategy_data_list.append(strategy_data)
         except Exception as e:
-            # print(f"Error fetching data for block {block_number}: {e}")
+            concurrency.record_failure(get_strategy_data, block_number, e)
             continue
 
     return pd.DataFrame(strategy_data_list)
 
 
+@telemetry.timed()
 def merge_strategy_data(historic_block_list, strategy_list=const.STRATEGY_LIST, oracle_list=const.ORACLE_ADDRESS_LIST,
                         pool_address_list=const.CURVE_POOL_LIST,
-                        strategy_names=const.STRATEGY_NAME):
+                        strategy_names=const.STRATEGY_NAME, strategy_frames=None):
     data_list = []
 
     for i in range(len(strategy_list)):
-        strategy_data = get_strategy_data_for_blocks(strategy_list[i], oracle_list[i], pool_address_list[i],
-                                                     historic_block_list)
+        # Frames prefetched by get_batched_data_for_blocks skip the per-strategy RPC loop
+        if strategy_frames is not None:
+            strategy_data = strategy_frames[i]
+        else:
+            strategy_data = get_strategy_data_for_blocks(strategy_list[i], oracle_list[i], pool_address_list[i],
+                                                         historic_block_list)
         strategy_data = strategy_data.add_suffix(strategy_names[i])
         strategy_data = strategy_data.rename(columns={f'block{strategy_names[i]}': 'block'})
         data_list.append(strategy_data)
@@ -519,21 +490,10 @@ def merge_strategy_data(historic_block_list, strategy_list=const.STRATEGY_LIST,
 
 
 # Yearn Calls
+@telemetry.timed()
 def fetch_pps(address, block):
-    # Convert the address to checksum format
-    yearn_address = Web3.to_checksum_address(address)
-
-    # ABI for the pricePerShare function
-    pricePerShare_abi = [{
-        "stateMutability": "view",
-        "type": "function",
-        "name": "pricePerShare",
-        "inputs": [],
-        "outputs": [{"name": "arg_0", "type": "uint256"}]
-    }]
-
     # Contract instance for the provided address and ABI
-    yearn_pps = w3.eth.contract(address=yearn_address, abi=pricePerShare_abi)
+    yearn_pps = contracts.get_contract(address, 'pricePerShare')
 
     # Call the pricePerShare function with the provided block
     pps = yearn_pps.functions.pricePerShare().call(block_identifier=int(block))
@@ -546,7 +506,13 @@ def fetch_pps(address, block):
     return data
 
 
-def get_pps_data_for_blocks(collateral_address, block_numbers):
+@telemetry.timed()
+def get_pps_data_for_blocks(collateral_address, block_numbers, workers=const.FETCH_WORKERS):
+    if workers > 1:
+        results = concurrency.map_blocks(lambda block_number: fetch_pps(collateral_address, int(block_number)),
+                                         block_numbers, workers)
+        return pd.DataFrame([result for result in results if result is not None])
+
     pps_data_list = []
 
     for block_number in block_numbers:
@@ -554,16 +520,22 @@ def get_pps_data_for_blocks(collateral_address, block_numbers):
             pps_data = fetch_pps(collateral_address, int(block_number))
             pps_data_list.append(pps_data)
         except Exception as e:
+            concurrency.record_failure(fetch_pps, block_number, e)
             continue
 
     return pd.DataFrame(pps_data_list)
 
 
-def merge_pps_data(historic_block_list_pps, collateral_list=const.COLLATERAL_LIST, strategy_names=const.STRATEGY_NAME):
+@telemetry.timed()
+def merge_pps_data(historic_block_list_pps, collateral_list=const.COLLATERAL_LIST, strategy_names=const.STRATEGY_NAME,
+                   pps_frames=None):
     pps_data_list = []
 
     for i in range(len(collateral_list)):
-        pps_data = get_pps_data_for_blocks(collateral_list[i], historic_block_list_pps)
+        if pps_frames is not None:
+            pps_data = pps_frames[i]
+        else:
+            pps_data = get_pps_data_for_blocks(collateral_list[i], historic_block_list_pps)
         pps_data = pps_data.add_suffix(strategy_names[i])
         pps_data = pps_data.rename(columns={f'block{strategy_names[i]}': 'block'})
         pps_data_list.append(pps_data)
@@ -578,146 +550,479 @@ def merge_pps_data(historic_block_list_pps, collateral_list=const.COLLATERAL_LIS
     return merged_pps_df
 
 
-def process_dataframe(df):
-    # Create a copy of the DataFrame
-    processed_df = df.copy()
+#######################################################################################################################
+# Multicall batching
+#######################################################################################################################
+
+# Pair addresses of the strategies at the latest block, resolved once per process. get_block_snapshot checks them
+# against the pair getStrategy returns at the snapshot block
+_STRATEGY_PAIRS = {}
 
-    # Number of columns
-    num_columns = len(processed_df.columns)
 
-    # Create new columns by shifting existing columns by 180 rows
-    for i in range(1, num_columns):
-        new_column_name = f'{processed_df.columns[i]}_lagged'
-        processed_df[new_column_name] = processed_df.iloc[:, i].shift(180)
+def get_strategy_pair(strategy_address, data_provider_contract=const.DATA_PROVIDER):
+    if strategy_address not in _STRATEGY_PAIRS:
+        contract = contracts.get_contract(data_provider_contract, 'getStrategy')
+        _STRATEGY_PAIRS[strategy_address] = contract.functions.getStrategy(strategy_address).call()[1]
 
-    # Divide every column except the first one by 1e18
-    for column in processed_df.columns[1:]:
-        processed_df[column] /= 1e18
+    return _STRATEGY_PAIRS[strategy_address]
 
-    # Calculate ROI for each column
-    for i in range(1, num_columns):
-        days = 30
-        new_column_name = f'{processed_df.columns[i]}_APY'
-        processed_df[new_column_name] = (1 + (
-                (processed_df[processed_df.columns[i]] - processed_df[f'{processed_df.columns[i]}_lagged']) /
-                processed_df[f'{processed_df.columns[i]}_lagged'])) ** (365.2425 / days) - 1
 
-    # Calculate APR for each column
-    for i in range(1, num_columns):
-        compounding = 52
-        new_column_name = f'{processed_df.columns[i]}_APR'
-        processed_df[new_column_name] = compounding * (
-                (processed_df[f'{processed_df.columns[i]}_APY'] + 1) ** (1 / compounding)) - compounding
+@telemetry.timed()
+def get_block_snapshot(block_number, strategy_list=const.STRATEGY_LIST, oracle_list=const.ORACLE_ADDRESS_LIST,
+                       pool_address_list=const.CURVE_POOL_LIST, collateral_list=const.COLLATERAL_LIST,
+                       data_provider_contract=const.DATA_PROVIDER):
+    """
+    Fetches the data of every strategy and every collateral pricePerShare at a block in one aggregate3 call.
 
-    new_df = pd.DataFrame()
-    new_df['block'] = processed_df['block']
+    Parameters:
+    block_number (int): The block to snapshot.
+    strategy_list (list): The strategy addresses.
+    oracle_list (list): The oracle addresses, index-aligned with strategy_list.
+    pool_address_list (list): The Curve pool addresses, index-aligned with strategy_list.
+    collateral_list (list): The Yearn collateral vault addresses.
+    data_provider_contract (str): The aggregator data provider address.
 
-    for i in range(1, num_columns):
-        new_df[f'{processed_df.columns[i]}'] = processed_df[f'{processed_df.columns[i]}']
-        # new_df[f'{processed_df.columns[i]}_APY'] = processed_df[f'{processed_df.columns[i]}_APY']
-        new_df[f'{processed_df.columns[i]}_APR'] = processed_df[f'{processed_df.columns[i]}_APR']
+    Returns:
+    tuple: A list with one get_strategy_data dict per strategy and a list with one fetch_pps dict per collateral.
+    An entry is None when any of its calls failed at this block.
+    """
+    calls = []
 
-    return new_df
+    # The pair calls cannot wait for the getStrategy of the same batch, they go to the pair of the latest block
+    pair_addresses = [get_strategy_pair(strategy_address, data_provider_contract) for strategy_address in strategy_list]
+    for i in range(len(strategy_list)):
+        calls.append(multicall.encode_call(data_provider_contract, 'getStrategy', [strategy_list[i]]))
+        calls.append(multicall.encode_call(oracle_list[i], 'getPrices'))
+        calls.append(multicall.encode_call(pair_addresses[i], 'previewAddInterest'))
+        calls.append(multicall.encode_call(pair_addresses[i], 'currentRateInfo'))
+        calls.append(multicall.encode_call(pool_address_list[i], 'get_virtual_price'))
+
+    for collateral_address in collateral_list:
+        calls.append(multicall.encode_call(collateral_address, 'pricePerShare'))
+
+    results = multicall.aggregate3(calls, block_number)
+
+    # A strategy that had another pair at the block, e.g. before a pair migration, has its pair calls sent again to
+    # the pair getStrategy returned at the block. A strategy not deployed yet fails its getStrategy instead
+    moved = [i for i in range(len(strategy_list)) if results[i * 5][0] and
+             results[i * 5][1][1].lower() != pair_addresses[i].lower()]
+    if moved:
+        pair_calls = [multicall.encode_call(results[i * 5][1][1], abi_name)
+                      for i in moved for abi_name in ('previewAddInterest', 'currentRateInfo')]
+        pair_results = multicall.aggregate3(pair_calls, block_number)
+        for j, i in enumerate(moved):
+            results[i * 5 + 2:i * 5 + 4] = pair_results[j * 2:j * 2 + 2]
+
+    strategy_rows = []
+    for i in range(len(strategy_list)):
+        strategy_results = results[i * 5:(i + 1) * 5]
 
+        if not all(success for success, _ in strategy_results):
+            strategy_rows.append(None)
+            continue
 
-def compute_master_data(pps_df, silo_df, strategy_name=const.STRATEGY_NAME):
-    # df = pd.DataFrame()
+        strategy_data, prices, new_current_rate_info, current_rate_info, virtual_price = \
+            [value for _, value in strategy_results]
+        strategy_rows.append(build_strategy_row(block_number, strategy_data, prices[1] / 1e18,
+                                                new_current_rate_info[3][3], current_rate_info[1],
+                                                virtual_price / 1e18))
+
+    pps_rows = []
+    for success, pps in results[len(strategy_list) * 5:]:
+        pps_rows.append({'block': int(block_number), 'pps': pps} if success else None)
+
+    return strategy_rows, pps_rows
+
+
+@telemetry.timed()
+def get_batched_data_for_blocks(block_numbers, strategy_list=const.STRATEGY_LIST,
+                                collateral_list=const.COLLATERAL_LIST, workers=const.FETCH_WORKERS):
+    def fetch(block_number):
+        return get_block_snapshot(int(block_number), strategy_list=strategy_list, collateral_list=collateral_list)
+
+    if workers > 1:
+        snapshots = concurrency.map_blocks(fetch, block_numbers, workers)
+    else:
+        snapshots = []
+        for block_number in block_numbers:
+            try:
+                snapshots.append(fetch(block_number))
+            except Exception as e:
+                concurrency.record_failure(get_block_snapshot, block_number, e)
+                continue
+
+    strategy_data_lists = [[] for _ in strategy_list]
+    pps_data_lists = [[] for _ in collateral_list]
+
+    for snapshot in snapshots:
+        if snapshot is None:
+            continue
+
+        strategy_rows, pps_rows = snapshot
+
+        for i, strategy_row in enumerate(strategy_rows):
+            if strategy_row is not None:
+                strategy_data_lists[i].append(strategy_row)
+
+        for i, pps_row in enumerate(pps_rows):
+            if pps_row is not None:
+                pps_data_lists[i].append(pps_row)
+
+    strategy_frames = [pd.DataFrame(strategy_data_list) for strategy_data_list in strategy_data_lists]
+    pps_frames = [pd.DataFrame(pps_data_list) for pps_data_list in pps_data_lists]
+
+    return strategy_frames, pps_frames
+
+
+APR_COMPOUNDING = 52
+SECONDS_PER_DAY = 86400
+
+
+def apr_column(column, window):
+    # The 30 day APR keeps the name it had before the other windows were added
+    return f'{column}_APR' if window == 30 else f'{column}_APR_{window}d'
+
+
+def collateral_apr_column(asset, window=30):
+    return f'collateralApr_{asset}' if window == 30 else f'collateralApr{window}d_{asset}'
 
+
+@telemetry.timed()
+def process_dataframe(df, windows=const.APR_WINDOWS):
+    """
+    Computes the APR of every pps series over each lookback window, matched on block timestamps.
+
+    Parameters:
+    df (DataFrame): The pps table with its 'time' column, see add_block_time.
+    windows (list): The lookback windows in days.
+
+    Returns:
+    DataFrame: The block, and for every series its value and its APR over each window.
+    """
+    # Every column but block and time is a pps series, processed as one (block x collateral) array
+    value_columns = [column for column in df.columns if column not in ('block', 'time')]
+    values = df[value_columns].to_numpy(dtype='float64') / 1e18
+    times = (pd.to_datetime(df['time']) - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
+    # Sorted index of the samples with a timestamp, searched for the lagged sample of every row
+    has_time = ~np.isnan(times)
+    sample_times, sample_values = times[has_time], values[has_time]
+
+    aprs = {}
+    for window in windows:
+        # Without a single timestamped sample, e.g. every timestamp lookup of the window failed, nothing is lagged
+        if not len(sample_times):
+            aprs[window] = np.full(values.shape, np.nan)
+            continue
+
+        target_times = times - window * SECONDS_PER_DAY
+        lag_index = np.searchsorted(sample_times, target_times, side='right') - 1
+        found = (lag_index >= 0) & has_time
+        lag_index = np.clip(lag_index, 0, None)
+        lag_times = np.where(found, sample_times[lag_index], np.nan)
+
+        # The latest sample at or before the target, as long as it is not older than the tolerance
+        with np.errstate(invalid='ignore'):
+            found &= target_times - lag_times <= const.APR_WINDOW_TOLERANCE
+            # Rows after the start of the history that still have no sample point at a gap in the pps table
+            gaps = int(np.sum(~found & has_time & (target_times >= sample_times[0])))
+        if gaps:
+            # Counted in the run status and the diagnostics panel, their APR is left empty
+            telemetry.count(f'apr_gap_rows_{window}d', gaps)
+            telemetry.log('apr_gaps', window=window, rows=gaps)
+        lagged = np.where(found[:, None], sample_values[lag_index], np.nan)
+
+        # Annualized over the time actually elapsed since the lagged sample
+        days = (times - lag_times) / SECONDS_PER_DAY
+        with np.errstate(divide='ignore', invalid='ignore'):
+            apy = (1 + ((values - lagged) / lagged)) ** (365.2425 / days[:, None]) - 1
+            aprs[window] = APR_COMPOUNDING * ((apy + 1) ** (1 / APR_COMPOUNDING)) - APR_COMPOUNDING
+
+    # Built in a single allocation, each series followed by its APRs
+    columns = {'block': df['block'].to_numpy()}
+    for i, column in enumerate(value_columns):
+        columns[column] = values[:, i]
+        for window in windows:
+            columns[apr_column(column, window)] = aprs[window][:, i]
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+@telemetry.timed()
+def add_block_time(df, workers=const.FETCH_WORKERS):
+    # The pps table has no time column, the block timestamp cache gives it without re-reading known blocks
+    return pd.merge(df, generate_time_series(df['block'].tolist(), workers=workers), on='block', how='left')
+
+
+# Columns of compute_master_data for each strategy, the strategy name is appended to the prefix
+MASTER_DATA_METRICS = ['reserveSize', 'currentBorrow', 'utilization', 'collateralApr_'] + \
+                      [f'collateralApr{window}d_' for window in const.APR_WINDOWS if window != 30] + \
+                      ['borrowApy_', 'supplyApy_', 'spread', 'oracleLow', 'oracleHigh', 'oracleNormalized', 'maxLTV']
+
+
+@telemetry.timed()
+def compute_master_data(pps_df, silo_df, strategy_name=const.STRATEGY_NAME):
     df = pd.merge(silo_df, pps_df, on='block', how='left')
     df.rename(columns={f'block_x': 'block'}, inplace=True)
 
-    # df.drop(columns=['block_y'], inplace=True)
+    def field(prefix, suffix=''):
+        # (block x strategy) array of a field
+        return np.column_stack([df[f'{prefix}{name}{suffix}'].to_numpy(dtype='float64') for name in strategy_name])
 
-    output_data = pd.DataFrame()
+    total_asset = field('totalAsset')
+    total_borrow = field('totalBorrow')
+    low_exchange_rate = field('lowExchangeRate')
 
-    output_data['block'] = df['block']
-    output_data['time'] = df['time']
-
-    for i in range(4):
-        output_data[f'reserveSize{strategy_name[i]}'] = df[f'totalAsset{strategy_name[i]}']
-        output_data[f'currentBorrow{strategy_name[i]}'] = df[f'totalBorrow{strategy_name[i]}']
-        output_data[f'utilization{strategy_name[i]}'] = df[f'totalBorrow{strategy_name[i]}'] / df[
-            f'totalAsset{strategy_name[i]}']
-        output_data[f'collateralApr_{strategy_name[i]}'] = df[f'pps{strategy_name[i]}_APR']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        utilization = total_borrow / total_asset
+        collateral_apr = field('pps', '_APR')
+        window_aprs = {f'collateralApr{window}d_': field('pps', f'_APR_{window}d')
+                       for window in const.APR_WINDOWS if window != 30}
         # borrow_apy = new_current_rate * 31536000 / rate_precision * 100
-        output_data[f'borrowApy_{strategy_name[i]}'] = df[f'newCurrentRateInfo{strategy_name[i]}'] * 31536000 / 1e18
+        borrow_apy = field('newCurrentRateInfo') * 31536000 / 1e18
         # supply_apy = borrow_apy * (1 - fee_to_protocol_rate / fee_precision ) * utilization_rate / 100
-        output_data[f'supplyApy_{strategy_name[i]}'] = output_data[f'borrowApy_{strategy_name[i]}'] * (
-                1 - df[f'feeToProtocolRate{strategy_name[i]}'] / 100000) * output_data[
-                                                           f'utilization{strategy_name[i]}']
-        output_data[f'spread{strategy_name[i]}'] = output_data[f'collateralApr_{strategy_name[i]}'] - output_data[
-            f'borrowApy_{strategy_name[i]}']
-        output_data[f'oracleLow{strategy_name[i]}'] = df[f'lowExchangeRate{strategy_name[i]}']
-        output_data[f'oracleHigh{strategy_name[i]}'] = df[f'highExchangeRate{strategy_name[i]}']
-        output_data[f'oracleNormalized{strategy_name[i]}'] = df[f'lowExchangeRate{strategy_name[i]}'] * df[
-            f'pps{strategy_name[i]}'] / df[f'virtualPrice{strategy_name[i]}']
-        output_data[f'maxLTV{strategy_name[i]}'] = df[f'maxLTV{strategy_name[i]}']
-
-    return output_data
-
-
-def load_data():
-    save_strategy_data = pd.read_csv('sturdyDataStrategyV1.csv')
-    save_pps_data = pd.read_csv('sturdyDataPpsV1.csv')
-    address_log = pd.read_csv('address_log.csv')
+        supply_apy = borrow_apy * (1 - field('feeToProtocolRate') / 100000) * utilization
+        spread = collateral_apr - borrow_apy
+        oracle_normalized = low_exchange_rate * field('pps') / field('virtualPrice')
+
+    metrics = {
+        'utilization': utilization,
+        'collateralApr_': collateral_apr,
+        'borrowApy_': borrow_apy,
+        'supplyApy_': supply_apy,
+        'spread': spread,
+        'oracleNormalized': oracle_normalized,
+        **window_aprs
+    }
+    # Passed through with the dtype they are stored with
+    copied_fields = {'reserveSize': 'totalAsset', 'currentBorrow': 'totalBorrow', 'oracleLow': 'lowExchangeRate',
+                     'oracleHigh': 'highExchangeRate', 'maxLTV': 'maxLTV'}
+
+    output_data = {'block': df['block'].to_numpy(), 'time': df['time'].to_numpy()}
+    for i, name in enumerate(strategy_name):
+        for metric in MASTER_DATA_METRICS:
+            if metric in copied_fields:
+                output_data[f'{metric}{name}'] = df[f'{copied_fields[metric]}{name}'].to_numpy()
+            else:
+                output_data[f'{metric}{name}'] = metrics[metric][:, i]
+
+    return pd.DataFrame(output_data)
+
+
+# Strategy fields read by compute_master_data, the charts never need the rest of the strategy table
+MASTER_DATA_FIELDS = ['totalAsset', 'totalBorrow', 'newCurrentRateInfo', 'feeToProtocolRate', 'lowExchangeRate',
+                      'highExchangeRate', 'virtualPrice', 'maxLTV']
+
+
+def master_data_output_columns(strategy_names=const.STRATEGY_NAME):
+    return ['block', 'time'] + [f'{metric}{name}' for name in strategy_names for metric in MASTER_DATA_METRICS]
+
+
+def master_data_columns(strategy_names=const.STRATEGY_NAME):
+    return ['block', 'time'] + [f'{field}{name}' for name in strategy_names for field in MASTER_DATA_FIELDS]
+
+
+def load_pps_window(first_block, backend=None):
+    """
+    Loads the pps rows from first_block on, preceded by the rows the APR windows of first_block look back to.
+
+    Parameters:
+    first_block (int): The first block whose APR is needed.
+    backend (StorageBackend): The store to read, the configured one by default.
+
+    Returns:
+    DataFrame: The pps rows of the window, with their 'time' column.
+    """
+    backend = backend or storage.get_backend()
+
+    # A block never takes less than BLOCK_TIME, so this many blocks span at least the longest lookback
+    lookback = max(const.APR_WINDOWS) * SECONDS_PER_DAY + const.APR_WINDOW_TOLERANCE
+    pps_window = backend.load_pps(start_block=first_block - lookback // const.BLOCK_TIME - 1)
+
+    return add_block_time(pps_window.reset_index(drop=True))
+
+
+@telemetry.timed()
+def update_master_data(file_path=const.MASTER_DATA_FILE, incremental=const.MASTER_DATA_INCREMENTAL,
+                       recompute_from=None):
+    """
+    Brings the persisted master table up to the latest stored block.
+
+    Parameters:
+    file_path (str): The path of the CSV file holding the master table.
+    incremental (bool): Compute the rows of the new blocks only, instead of the whole history.
+    recompute_from (int): Also compute again the rows from this block on, e.g. after a gap was filled.
+
+    Returns:
+    DataFrame: The updated master table.
+    """
+    backend = storage.get_backend()
+
+    master_data = load_master_data(file_path) if incremental else None
+
+    # A table saved with other metrics, e.g. before an APR window was added, is computed again from scratch
+    if master_data is not None and list(master_data.columns) != master_data_output_columns():
+        master_data = None
+
+    if master_data is not None and recompute_from is not None:
+        master_data = master_data[master_data['block'] < recompute_from]
+        if master_data.empty:
+            master_data = None
+
+    if master_data is None:
+        saved_strategy_data = backend.load_strategy(columns=master_data_columns())
+        master_data = compute_master_data(process_dataframe(add_block_time(backend.load_pps())),
+                                          saved_strategy_data)
+    else:
+        # Only the strategy rows after the last computed block, with the pps window their APR needs
+        new_strategy_data = backend.load_strategy(columns=master_data_columns(),
+                                                  start_block=int(master_data['block'].max()) + 1)
+        if new_strategy_data.empty:
+            return master_data
+
+        pps_window = load_pps_window(int(new_strategy_data['block'].min()), backend=backend)
+        new_master_data = compute_master_data(process_dataframe(pps_window), new_strategy_data)
+        master_data = pd.concat([master_data, new_master_data], ignore_index=True)
+
+    save_csv(master_data, file_path)
+
+    return master_data
+
+
+@telemetry.timed()
+def load_master_data(file_path=const.MASTER_DATA_FILE):
+    if not os.path.exists(file_path):
+        return None
+    # round_trip reads back the exact floats to_csv wrote, so the table does not drift from a full recompute
+    return pd.read_csv(file_path, parse_dates=['time'], float_precision='round_trip')
+
+
+@telemetry.timed()
+def load_data(strategy_columns=None, start_block=None, end_block=None):
+    backend = storage.get_backend()
+    save_strategy_data = backend.load_strategy(columns=strategy_columns, start_block=start_block,
+                                               end_block=end_block)
+    save_pps_data = backend.load_pps(start_block=start_block, end_block=end_block)
+    address_log = load_address_log()
     return save_strategy_data, save_pps_data, address_log
 
 
-def get_data_for_blocks(historic_block_list, save_strategy_data, save_pps_data):
-    new_strategy_data = merge_strategy_data(historic_block_list=historic_block_list)
-    save_strategy_data = save_strategy_data.copy()
-    save_strategy_data = pd.concat([save_strategy_data, new_strategy_data], ignore_index=True)
+@telemetry.timed()
+def load_address_log(block=None):
+    # The user address set as of the block, the latest one by default
+    return storage.get_backend().load_address_log(block)
 
-    new_pps_data = merge_pps_data(historic_block_list_pps=historic_block_list)
-    save_pps_data = save_pps_data.copy()
-    save_pps_data = pd.concat([save_pps_data, new_pps_data], ignore_index=True)
 
-    save_data(save_strategy_data, save_pps_data)
+@telemetry.timed()
+def load_user_table(file_path=const.USER_TABLE_FILE):
+    # The user table is computed by the ingestion worker, the page only reads the last committed one
+    if not os.path.exists(file_path):
+        return None
+    return pd.read_csv(file_path)
 
-    return save_strategy_data, save_pps_data
 
+@telemetry.timed()
+def load_user_positions(file_path=const.USER_POSITION_FILE):
+    return pd.read_csv(file_path)
 
-def save_data(save_strategy_data, save_pps_data):
-    save_strategy_data.to_csv('sturdyDataStrategyV1.csv', index=False)
-    save_pps_data.to_csv('sturdyDataPpsV1.csv', index=False)
 
+@telemetry.timed()
+def get_data_for_blocks(historic_block_list, workers=const.FETCH_WORKERS):
+    # One aggregate3 call per block serves both the strategy and the pps tables
+    if const.MULTICALL_BATCHING:
+        strategy_frames, pps_frames = get_batched_data_for_blocks(historic_block_list, workers=workers)
+    else:
+        strategy_frames, pps_frames = None, None
 
-# Function to convert block number to date
-def block_number_to_date(block_number):
+    new_strategy_data = merge_strategy_data(historic_block_list=historic_block_list, strategy_frames=strategy_frames)
+    new_pps_data = merge_pps_data(historic_block_list_pps=historic_block_list, pps_frames=pps_frames)
+
+    save_data(new_strategy_data, new_pps_data)
+
+    return new_strategy_data, new_pps_data
+
+
+@telemetry.timed()
+def save_data(new_strategy_data, new_pps_data):
+    # Only the new rows are written, the backend never rewrites the stored history
+    backend = storage.get_backend()
+    backend.append_strategy(new_strategy_data)
+    backend.append_pps(new_pps_data)
+
+
+def save_csv(df, file_path):
+    # Write to a temporary file first and swap it in, so a reader never sees a half written file
+    tmp_file_path = f'{file_path}.tmp'
+    df.to_csv(tmp_file_path, index=False)
+    os.replace(tmp_file_path, file_path)
+
+
+# Function to read the timestamp of a block from the chain
+@telemetry.timed()
+def get_block_timestamp(block_number):
     try:
         # Get block information
-        block = w3.eth.get_block(int(block_number))  # Convert block number to int
+        block = clients.get_web3().eth.get_block(int(block_number))  # Convert block number to int
 
         # Check if block exists
         if not block:
             return
 
-        # Convert timestamp to date
-        timestamp = block.timestamp
-        date = datetime.datetime.utcfromtimestamp(timestamp)
-
-        return date  # Return the date object
+        return block.timestamp
 
     except Exception as e:
         print('Error:', e)
         return None
 
 
-def generate_time_series(historic_block_list):
-    # Initialize lists to store block numbers and corresponding times
-    block_numbers = []
-    times = []
+# Function to read the chain tip, against which the finality of a block timestamp is measured
+def get_chain_tip():
+    return clients.get_web3().eth.block_number
+
+
+# Function to convert block number to date
+def block_number_to_date(block_number):
+    # Served from the block timestamp cache when the block was read before
+    timestamps = blocktime.get_block_timestamps([block_number], get_block_timestamp, interpolate=False,
+                                                fetch_tip=get_chain_tip)
+    timestamp = timestamps[int(block_number)]
+
+    if timestamp is None:
+        return None
+
+    # Convert timestamp to date
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
 
-    # Iterate over the historic_block_list
-    for block_number in historic_block_list:
-        # Call block_number_to_date function to get the time for each block number
-        time = block_number_to_date(block_number)
+@telemetry.timed()
+def generate_time_series(historic_block_list, workers=const.FETCH_WORKERS,
+                         interpolate=const.BLOCK_TIME_INTERPOLATION):
+    # Cached blocks cost no RPC call, and with interpolation only the anchors needed for the error bound are read
+    timestamps = blocktime.get_block_timestamps(historic_block_list, get_block_timestamp, workers=workers,
+                                                interpolate=interpolate, fetch_tip=get_chain_tip)
 
-        # Append block number and time to the lists
-        block_numbers.append(block_number)
-        times.append(time)
+    times = [None if timestamps[int(block_number)] is None
+             else datetime.datetime.utcfromtimestamp(timestamps[int(block_number)])
+             for block_number in historic_block_list]
 
     # Create a DataFrame from the lists
-    df = pd.DataFrame({'block': block_numbers, 'time': times})
+    df = pd.DataFrame({'block': list(historic_block_list), 'time': times})
+
+    return df
+
+#######################################################################################################################
+# Render cache
+#######################################################################################################################
+
+# The page functions below are keyed on the latest ingested block only. Every session and rerun on the same snapshot
+# shares one result, and the next ingestion run invalidates them by moving the block.
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_master_data_snapshot(snapshot_block):
+    # The master table is kept up to date by the ingestion worker, the page only reads it
+    return load_master_data()
+
 
-    return df
\ No newline at end of file
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_user_table_snapshot(snapshot_block):
+    return load_user_table()
@@ -0,0 +1,269 @@
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+import utils
+import clients
+import dune
+import storage
+import strategies
+import gaps
+import ltvhistory
+import telemetry
+import const
+
+
+def run_ingestion(workers=const.FETCH_WORKERS, wait_for_dune=False):
+    """
+    Runs one refresh of the stores: new blocks, Dune addresses and the user table.
+
+    Parameters:
+    workers (int): The number of blocks fetched concurrently during the backfill.
+    wait_for_dune (bool): Wait for the Dune refresh instead of collecting it in a later run.
+
+    Returns:
+    dict: The status of the run, also written to const.INGESTION_STATUS_FILE.
+    """
+    started_at = time.perf_counter()
+    counters_before = telemetry.snapshot()['counters']
+    stages = {}
+
+    backend = storage.get_backend()
+    address_log = utils.load_address_log()
+
+    # Get the latest Block Number to check if enough time has passed to accumulate data for new Blocks
+    latest_block_with_data = backend.latest_block()
+
+    historic_block_list = utils.accumulate_block_with_no_data(latest_block_with_data)
+
+    latest_address_block = address_log['block'].max()
+
+    with stage(stages, 'dune'):
+        if int(latest_address_block) + 3600 < int(max(historic_block_list)):
+            # False while the refresh of an earlier run is still in flight
+            dune_usage = int(dune.start_refresh(int(max(historic_block_list))))
+        else:
+            dune_usage = 0
+
+        # The addresses of a refresh, started by this run or an earlier one, are stored once Dune answered. The run
+        # only waits on Dune when asked to
+        address_log = collect_addresses(address_log, wait=wait_for_dune)
+
+    with stage(stages, 'backfill'):
+        if clients.get_web3().eth.block_number - const.BLOCK_INTERVAL > latest_block_with_data:
+            utils.get_data_for_blocks(historic_block_list, workers=workers)
+            latest_block_with_data = backend.latest_block()
+
+    # Blocks that failed in an earlier run are re-fetched, the forward loop above never looks back
+    with stage(stages, 'gap_fill'):
+        filled_blocks = gaps.fill_gaps(workers=workers) if const.GAP_FILL else []
+
+    # Computes the master rows of the new blocks, or the whole table on the first run. The rows after a filled gap
+    # are computed again, their APR lookbacks may now find the filled pps samples
+    with stage(stages, 'master_data'):
+        utils.update_master_data(recompute_from=min(filled_blocks) if filled_blocks else None)
+
+    with stage(stages, 'user_scan'):
+        # compute_user_ltv only needs the maxLTV of the latest block
+        latest_strategy_data = backend.load_strategy(
+            columns=strategies.columns(['maxLTV']), start_block=latest_block_with_data)
+        user_scan_block = int(max(historic_block_list))
+        user_position_df, user_full_scan_block = scan_user_positions(address_log, user_scan_block)
+        user_table = utils.compute_user_ltv(latest_strategy_data, address_log, block=user_scan_block,
+                                            user_position_df=user_position_df)
+        utils.save_csv(user_table, const.USER_TABLE_FILE)
+
+    # The positions of the new blocks, and of older ones until the history is backfilled
+    with stage(stages, 'user_ltv_history'):
+        user_ltv_blocks = ltvhistory.update_user_ltv_history() if const.USER_LTV_HISTORY else []
+
+    counters = telemetry.snapshot()['counters']
+
+    status = {
+        'updated_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+        'latest_block_with_data': int(latest_block_with_data),
+        'current_block': int(max(historic_block_list)),
+        'latest_address_block': int(address_log['block'].max()),
+        'dune_usage': dune_usage,
+        'user_scan_block': user_scan_block,
+        'user_full_scan_block': user_full_scan_block,
+        'gap_blocks_filled': len(filled_blocks),
+        'user_ltv_blocks': len(user_ltv_blocks),
+        'seconds': round(time.perf_counter() - started_at, 3),
+        'stages': stages,
+        # What this run cost, the totals of the process are on the metrics endpoint
+        'counters': {name: value - counters_before.get(name, 0) for name, value in counters.items()
+                     if value != counters_before.get(name, 0)},
+        'error': None
+    }
+    write_status(status)
+    telemetry.log('ingestion_run', **status)
+
+    return status
+
+
+@contextmanager
+def stage(stages, name):
+    # The seconds of a stage go to the run status and the process totals, failed or not
+    timer = telemetry.timer(f'ingestion.{name}')
+    try:
+        with timer:
+            yield
+    finally:
+        stages[name] = round(timer.seconds, 3)
+        telemetry.log('ingestion_stage', stage=name, seconds=stages[name])
+
+
+def collect_addresses(address_log, wait=False):
+    try:
+        refreshed = dune.collect_refresh(wait)
+    except Exception as e:
+        # The log keeps its last addresses, the next run starts another refresh
+        print(f"Dune refresh failed: {e}")
+        return address_log
+
+    if refreshed is None:
+        return address_log
+
+    triggered_block, user_address_list = refreshed
+    return utils.update_and_save_address_list(loaded_address_log=address_log, triggered_block=triggered_block,
+                                              user_address_list=user_address_list)
+
+
+def scan_user_positions(address_log, user_scan_block, full_scan_interval=const.USER_SCAN_FULL_INTERVAL):
+    """
+    Reads the positions of the users at the scan block, only those touched by an event since the last scan when
+    the last full scan is recent enough.
+
+    Parameters:
+    address_log (DataFrame): The address log.
+    user_scan_block (int): The block the positions are read at.
+    full_scan_interval (int): The blocks after which every user is read again. Borrow and asset balances grow with
+    interest without any event, an incremental scan alone would leave them stale.
+
+    Returns:
+    tuple: The position table and the block of the last full scan.
+    """
+    # The last committed status holds the block the persisted position table was read at
+    last_status = read_status() or {}
+    last_scan_block = last_status.get('user_scan_block')
+    last_full_scan_block = last_status.get('user_full_scan_block')
+
+    incremental = const.USER_SCAN_INCREMENTAL and last_scan_block is not None and \
+        last_full_scan_block is not None and user_scan_block - last_full_scan_block < full_scan_interval and \
+        os.path.exists(const.USER_POSITION_FILE)
+
+    if incremental:
+        user_position_df = utils.refresh_user_positions(utils.load_user_positions(), address_log,
+                                                        from_block=last_scan_block + 1, to_block=user_scan_block)
+    else:
+        user_position_df = utils.get_user_position_data(address_log, user_scan_block)
+        last_full_scan_block = user_scan_block
+
+    utils.save_csv(user_position_df, const.USER_POSITION_FILE)
+
+    return user_position_df, last_full_scan_block
+
+
+def write_status(status, file_path=const.INGESTION_STATUS_FILE):
+    # Written last and swapped in atomically, the status marks the snapshot as committed
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_file_path, file_path)
+
+
+def read_status(file_path=const.INGESTION_STATUS_FILE):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def run_forever(interval=const.INGESTION_INTERVAL, workers=const.FETCH_WORKERS):
+    while True:
+        try:
+            status = run_ingestion(workers=workers)
+            print(f"Ingestion done up to block {status['latest_block_with_data']}")
+        except Exception as e:
+            # Keep the last committed snapshot and record the failure, the next run retries
+            traceback.print_exc()
+            status = read_status() or {}
+            status['error'] = f'{datetime.datetime.utcnow().isoformat(timespec="seconds")}: {e}'
+            write_status(status)
+            telemetry.log('ingestion_failed', error=str(e))
+
+        time.sleep(interval)
+
+
+def status_gauges():
+    # Read from the committed status, so the endpoint also reports on a run that failed since
+    status = read_status() or {}
+    updated_at = status.get('updated_at')
+    return {
+        'latest_block_with_data': status.get('latest_block_with_data'),
+        'current_block': status.get('current_block'),
+        'latest_address_block': status.get('latest_address_block'),
+        'user_scan_block': status.get('user_scan_block'),
+        'user_full_scan_block': status.get('user_full_scan_block'),
+        'last_ingestion_seconds': status.get('seconds'),
+        'last_ingestion_timestamp': datetime.datetime.fromisoformat(updated_at).replace(
+            tzinfo=datetime.timezone.utc).timestamp() if updated_at else None,
+        'ingestion_failed': int(bool(status.get('error'))) if status else None
+    }
+
+
+# The thread and the metrics server are started at most once per process, whatever the number of Streamlit sessions
+# and reruns
+_worker_thread = None
+_metrics_server = None
+_worker_lock = threading.Lock()
+
+
+def start_metrics_server(port=const.METRICS_PORT):
+    global _metrics_server
+
+    with _worker_lock:
+        if _metrics_server is None and port is not None:
+            _metrics_server = telemetry.start_metrics_server(port, extra=status_gauges)
+
+    return _metrics_server
+
+
+def start_background_worker(interval=const.INGESTION_INTERVAL, workers=const.FETCH_WORKERS):
+    global _worker_thread
+
+    start_metrics_server()
+
+    with _worker_lock:
+        if _worker_thread is None or not _worker_thread.is_alive():
+            _worker_thread = threading.Thread(target=run_forever, args=(interval, workers), daemon=True,
+                                              name='ingestion-worker')
+            _worker_thread.start()
+
+    return _worker_thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keeps the Sturdy aggregator data stores up to date.')
+    parser.add_argument('--interval', type=int, default=const.INGESTION_INTERVAL,
+                        help='Seconds between two ingestion runs')
+    parser.add_argument('--workers', type=int, default=const.FETCH_WORKERS,
+                        help='Number of blocks fetched concurrently during a backfill')
+    parser.add_argument('--once', action='store_true', help='Run a single ingestion and exit')
+    parser.add_argument('--metrics-port', type=int, default=const.METRICS_PORT,
+                        help='Serve the Prometheus metrics of the worker on this port')
+    parser.add_argument('--json-logs', action='store_true', help='Print the stage timings as JSON lines')
+    args = parser.parse_args()
+
+    const.JSON_LOGS = const.JSON_LOGS or args.json_logs
+    start_metrics_server(args.metrics_port)
+
+    if args.once:
+        print(run_ingestion(workers=args.workers, wait_for_dune=True))
+    else:
+        run_forever(args.interval, args.workers)